@@ -0,0 +1,66 @@
+"""
+Run the same slow cell on N notebooks at once and measure event loop lag.
+
+With the async kernel client the N cells overlap, so wall time stays close to a
+single cell's duration and the loop keeps ticking while they run.
+
+Usage (from notebook-backend, with the backend .env in place):
+    python -m benchmarks.concurrent_execution --notebooks 8 --seconds 2
+"""
+import argparse
+import asyncio
+import time
+from jupyter_client import AsyncKernelManager
+from helpers.notebook.notebook import NotebookUtils
+
+
+async def start_notebook(index: int, kernel_name: str) -> NotebookUtils:
+    # Skip the conda env setup, this benchmark only measures kernel I/O.
+    nb = NotebookUtils(f"bench_{index}")
+    nb.kernel_manager = AsyncKernelManager(kernel_name=kernel_name)
+    await nb.kernel_manager.start_kernel()
+    nb.kernel_client = nb.kernel_manager.client()
+    nb.kernel_client.start_channels()
+    await nb.kernel_client.wait_for_ready()
+    return nb
+
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.05) -> float:
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def main(notebooks: int, seconds: float, kernel_name: str):
+    nbs = await asyncio.gather(*(start_notebook(i, kernel_name) for i in range(notebooks)))
+    code = f"import time\ntime.sleep({seconds})\nprint('done')"
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(nb.execute_code(code=code) for nb in nbs))
+    wall = time.perf_counter() - start
+    stop.set()
+    worst_lag = await lag_task
+
+    print(f"notebooks:           {notebooks}")
+    print(f"cell duration:       {seconds:.2f}s")
+    print(f"serial estimate:     {notebooks * seconds:.2f}s")
+    print(f"concurrent wall:     {wall:.2f}s")
+    print(f"worst loop lag:      {worst_lag * 1000:.1f}ms")
+
+    for nb in nbs:
+        nb.kernel_client.stop_channels()
+        await nb.kernel_manager.shutdown_kernel(now=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notebooks", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--kernel-name", default="python3")
+    args = parser.parse_args()
+    asyncio.run(main(args.notebooks, args.seconds, args.kernel_name))
@@ -0,0 +1,51 @@
+"""
+Compare creating a notebook env from scratch with cloning the golden base env.
+
+Reports wall time and the disk each new env adds. du is run on the base env and
+the new env together so hardlinked files are only counted for the base.
+
+Usage (from notebook-backend, conda on PATH):
+    python -m benchmarks.env_creation --runs 3
+"""
+import argparse
+import sh
+import time
+from helpers.notebook.base_env import BASE_ENV_NAME, ensure_base_env
+from helpers.notebook.env_registry import CondaEnvRegistry
+
+
+def added_disk_bytes(base_env_path: str, env_path: str) -> int:
+    lines = str(sh.du("-s", "-B1", base_env_path, env_path)).splitlines()
+    return int(lines[-1].split()[0])
+
+
+def create_fresh(env_name: str):
+    sh.conda("create", "-n", env_name, "python=3.9", "ipykernel", "-y")
+
+
+def create_clone(env_name: str):
+    sh.conda("create", "-n", env_name, "--clone", BASE_ENV_NAME, "--offline", "-y")
+
+
+def run(label: str, create, runs: int, base_env_path: str):
+    registry = CondaEnvRegistry.get_registry()
+    timings, sizes = [], []
+    for i in range(runs):
+        env_name = f"venv_kernel_bench_{label}_{i}"
+        start = time.perf_counter()
+        create(env_name)
+        timings.append(time.perf_counter() - start)
+        registry.refresh()
+        sizes.append(added_disk_bytes(base_env_path, registry.get(env_name)))
+        sh.conda("env", "remove", "-n", env_name, "-y")
+    print(f"{label:<6} avg {sum(timings) / runs:7.1f}s   avg added disk {sum(sizes) / runs / 1024 / 1024:8.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    base_env_path = ensure_base_env()
+    run("fresh", create_fresh, args.runs, base_env_path)
+    run("clone", create_clone, args.runs, base_env_path)
@@ -0,0 +1,80 @@
+"""
+Compare the Lambda image built from the env's full `pip list --format=freeze`
+with the one built from requirements inferred from the notebook's imports.
+
+With --docker both images are built from the deploy Dockerfile and their sizes
+come from `docker image inspect`. Without it the requirements are installed
+with `pip install --target` and the size on disk is reported, which tracks the
+site-packages layer of the image.
+
+Usage (from notebook-backend, with the backend .env in place):
+    python -m benchmarks.lambda_requirements --code notebook.py --python /path/to/env/bin/python
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from helpers.lambda_generator.requirements import REQUIREMENTS_SNIPPET, format_requirements, imported_modules
+
+DOCKERFILE_SAMPLE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'helpers', 'lambda_generator', 'helpers', 'scripts', 'dockerfile_sample')
+
+
+def freeze(python: str) -> str:
+    return subprocess.check_output([python, '-m', 'pip', 'list', '--format=freeze'], text=True)
+
+
+def inferred(python: str, code: str) -> str:
+    modules = sorted(module for module in imported_modules(code) if module not in sys.stdlib_module_names)
+    output = subprocess.check_output([python, '-c', REQUIREMENTS_SNIPPET % {'modules': modules}], text=True)
+    return format_requirements([tuple(requirement) for requirement in json.loads(output)['requirements']])
+
+
+def disk_bytes(path: str) -> int:
+    return int(subprocess.check_output(['du', '-s', '-B1', path]).split()[0])
+
+
+def measure_target(python: str, requirements: str, workdir: str) -> int:
+    with open(os.path.join(workdir, 'requirements.txt'), 'w') as f:
+        f.write(requirements)
+    target = os.path.join(workdir, 'site-packages')
+    subprocess.run(
+        [python, '-m', 'pip', 'install', '-q', '--no-cache-dir', '--target', target, '-r', os.path.join(workdir, 'requirements.txt')],
+        check=True,
+    )
+    return disk_bytes(target)
+
+
+def measure_docker(label: str, requirements: str, code: str, workdir: str) -> int:
+    with open(os.path.join(workdir, 'requirements.txt'), 'w') as f:
+        f.write(requirements)
+    with open(os.path.join(workdir, 'lambda_function.py'), 'w') as f:
+        f.write(code)
+    shutil.copy(DOCKERFILE_SAMPLE, os.path.join(workdir, 'Dockerfile'))
+    tag = f"lambda-requirements-bench:{label}"
+    subprocess.run(['docker', 'build', '-q', '-t', tag, workdir], check=True)
+    size = int(subprocess.check_output(['docker', 'image', 'inspect', '-f', '{{.Size}}', tag], text=True))
+    subprocess.run(['docker', 'image', 'rm', tag], check=True, stdout=subprocess.DEVNULL)
+    return size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--code", required=True, help="file with the notebook's code")
+    parser.add_argument("--python", default=sys.executable, help="python of the notebook's env")
+    parser.add_argument("--docker", action="store_true")
+    args = parser.parse_args()
+
+    code = open(args.code).read()
+    for label, requirements in (('freeze', freeze(args.python)), ('inferred', inferred(args.python, code))):
+        workdir = tempfile.mkdtemp(prefix=f"lambda_{label}_")
+        try:
+            start = time.perf_counter()
+            size = measure_docker(label, requirements, code, workdir) if args.docker else measure_target(args.python, requirements, workdir)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"{label:<9} {len(requirements.splitlines()):4d} packages   {size / 1024 / 1024:8.1f} MB   build {elapsed:6.1f}s")
@@ -0,0 +1,150 @@
+"""
+Compare raw JSON notebook objects with the compressed storage format: bytes
+stored in S3, transfer time at a given bandwidth, and the CPU spent encoding
+on save and decoding on load.
+
+Notebooks are generated in the shape the frontend saves (id, type, code,
+output, executionCount) at typical sizes:
+  small     20 code cells, short text outputs
+  medium    60 cells with printed dataframes and logs
+  outputs   40 cells, a third of them with HTML tables or base64 PNG plots
+--file adds a real notebook: a saved cells list or an .ipynb.
+
+Usage (from notebook-backend):
+    python -m benchmarks.notebook_storage --mbps 100 --file notebooks/testground.ipynb
+"""
+import json
+import time
+import base64
+import random
+import argparse
+from helpers.aws.s3 import notebook_codec
+
+CODE_LINES = [
+    "import pandas as pd",
+    "import numpy as np",
+    "df = pd.read_csv('s3://data/events.csv')",
+    "df = df[df['status'] == 'active']",
+    "summary = df.groupby('country')['revenue'].agg(['sum', 'mean', 'count'])",
+    "print(summary.sort_values('sum', ascending=False).head(20))",
+    "for user_id, rows in df.groupby('user_id'):",
+    "    totals[user_id] = rows['amount'].sum()",
+    "model.fit(X_train, y_train)",
+    "print(f'accuracy: {model.score(X_test, y_test):.3f}')",
+    "plt.plot(history['loss'], label='loss')",
+    "response = requests.get(url, params={'page': page}, timeout=30)",
+]
+
+
+def code_cell(rng: random.Random, index: int, output: str) -> dict:
+    return {
+        'id': f"cell-{index}-{rng.getrandbits(32):08x}",
+        'type': 'code',
+        'code': '\n'.join(rng.choice(CODE_LINES) for _ in range(rng.randint(3, 15))),
+        'output': output,
+        'executionCount': index + 1,
+    }
+
+
+def text_table(rng: random.Random, rows: int) -> str:
+    lines = ["country      revenue_sum   revenue_mean   count"]
+    for _ in range(rows):
+        lines.append(f"{rng.choice(['US', 'DE', 'IN', 'BR', 'FR', 'JP']):<12} {rng.uniform(0, 1e6):>12.2f} {rng.uniform(0, 500):>14.2f} {rng.randint(1, 9999):>7}")
+    return '\n'.join(lines)
+
+
+def html_table(rng: random.Random, rows: int) -> str:
+    body = ''.join(
+        f"<tr><th>{i}</th><td>{rng.randint(0, 99999)}</td><td>{rng.uniform(0, 1):.6f}</td><td>{rng.choice(['active', 'churned', 'trial'])}</td></tr>"
+        for i in range(rows)
+    )
+    return f'<table border="1" class="dataframe"><thead><tr><th></th><th>id</th><th>score</th><th>status</th></tr></thead><tbody>{body}</tbody></table>'
+
+
+def png_plot(rng: random.Random, size: int) -> str:
+    # PNG data is already deflated, so random bytes stand in for it fairly.
+    return "data:image/png;base64," + base64.b64encode(rng.randbytes(size)).decode()
+
+
+def generate(kind: str, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    cells = []
+    if kind == 'small':
+        for i in range(20):
+            cells.append(code_cell(rng, i, text_table(rng, 2) if i % 3 == 0 else ''))
+    elif kind == 'medium':
+        for i in range(60):
+            output = text_table(rng, rng.randint(10, 40)) if i % 2 else '\n'.join(f"epoch {e}: loss {rng.random():.4f}" for e in range(rng.randint(5, 50)))
+            cells.append(code_cell(rng, i, output))
+    elif kind == 'outputs':
+        for i in range(40):
+            if i % 6 == 0:
+                output = png_plot(rng, rng.randint(20_000, 60_000))
+            elif i % 6 == 3:
+                output = html_table(rng, rng.randint(50, 200))
+            else:
+                output = text_table(rng, rng.randint(5, 20))
+            cells.append(code_cell(rng, i, output))
+    else:
+        raise ValueError(kind)
+    return cells
+
+
+def load_file(path: str) -> list:
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return data
+    # .ipynb: flatten each cell's source and text outputs the way the frontend keeps them.
+    cells = []
+    for index, cell in enumerate(data.get('cells', [])):
+        outputs = []
+        for output in cell.get('outputs', []):
+            text = output.get('text') or output.get('data', {}).get('text/plain') or ''
+            outputs.append(''.join(text) if isinstance(text, list) else text)
+        cells.append({
+            'id': cell.get('id', f"cell-{index}"),
+            'type': cell.get('cell_type', 'code'),
+            'code': ''.join(cell.get('source', [])),
+            'output': ''.join(outputs),
+            'executionCount': cell.get('execution_count'),
+        })
+    return cells
+
+
+def timed(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", action="append", default=[], help="saved cells list or .ipynb")
+    parser.add_argument("--mbps", type=float, default=100, help="bandwidth used for the transfer estimate")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    notebooks = [(kind, generate(kind)) for kind in ('small', 'medium', 'outputs')]
+    notebooks += [(path, load_file(path)) for path in args.file]
+    codecs = [('none', None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+    if notebook_codec.zstandard is not None:
+        codecs += [('zstd', 3), ('zstd', 10)]
+
+    print(f"{'notebook':<28} {'codec':<8} {'stored':>10} {'ratio':>6} {'transfer':>9} {'encode':>9} {'decode':>9}")
+    for name, cells in notebooks:
+        text = json.dumps(cells)
+        for codec, level in codecs:
+            data = notebook_codec.encode(text, codec=codec, level=level)
+            assert notebook_codec.decode(data) == text
+            encode_s = timed(lambda: notebook_codec.encode(text, codec=codec, level=level), args.repeat)
+            decode_s = timed(lambda: notebook_codec.decode(data), args.repeat)
+            transfer_s = len(data) * 8 / (args.mbps * 1e6)
+            label = codec if level is None else f"{codec}-{level}"
+            print(
+                f"{name[-28:]:<28} {label:<8} {len(data) / 1024:>8.1f}KB {len(text.encode()) / len(data):>5.1f}x "
+                f"{transfer_s * 1000:>7.1f}ms {encode_s * 1000:>7.2f}ms {decode_s * 1000:>7.2f}ms"
+            )
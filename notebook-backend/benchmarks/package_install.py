@@ -0,0 +1,93 @@
+"""
+Install the same packages into N notebook envs, then install them again, the
+way every PostHog setup runs `!pip install pydantic requests`.
+
+Modes:
+  isolated  pip with a cache per env, as if every notebook env were on its own
+  shared    `!pip install` through MagicCommandHandler: shared cache, satisfied
+            requirements skipped
+  uv        same as shared, with PACKAGE_INSTALLER=uv (needs uv on PATH)
+
+Envs are plain venvs so the benchmark runs without conda; pip inside them
+behaves the same as in a venv_kernel_* env.
+
+Usage (from notebook-backend):
+    python -m benchmarks.package_install --notebooks 20 --packages "pydantic requests"
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from helpers.notebook import package_installer
+from helpers.notebook.magic_command import MagicCommandHandler
+
+
+def disk_bytes(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    return int(subprocess.check_output(['du', '-s', '-B1', path]).split()[0])
+
+
+def create_envs(root: str, count: int):
+    paths = []
+    for i in range(count):
+        path = os.path.join(root, f"venv_kernel_bench_{i}")
+        subprocess.run([sys.executable, '-m', 'venv', path], check=True)
+        paths.append(path)
+    return paths
+
+
+async def install_isolated(env_path: str, packages: list, cache_root: str) -> str:
+    handler = MagicCommandHandler(env_path)
+    env = {'PIP_CACHE_DIR': os.path.join(cache_root, os.path.basename(env_path)), 'PIP_DISABLE_PIP_VERSION_CHECK': '1'}
+    output = ""
+    async for chunk in handler._run('pip', [handler.pip_path, 'install', *packages], env=env):
+        output += chunk
+    return output
+
+
+async def install_magic(env_path: str, packages: list, cache_root: str) -> str:
+    return await MagicCommandHandler(env_path).execute(f"!pip install {' '.join(packages)}")
+
+
+async def run(mode: str, notebooks: int, packages: list):
+    root = tempfile.mkdtemp(prefix=f"bench_{mode}_")
+    cache_root = os.path.join(root, 'cache')
+    package_installer.PACKAGE_CACHE_DIR = cache_root
+    package_installer.PACKAGE_INSTALLER = 'uv' if mode == 'uv' else 'pip'
+    install = install_isolated if mode == 'isolated' else install_magic
+    try:
+        envs = create_envs(root, notebooks)
+        results = []
+        for label in ('first', 'repeat'):
+            start = time.perf_counter()
+            for env_path in envs:
+                output = await install(env_path, packages, cache_root)
+                if 'failed with exit code' in output:
+                    raise RuntimeError(output)
+            results.append(time.perf_counter() - start)
+        print(
+            f"{mode:<9} first {results[0]:7.1f}s ({results[0] / notebooks:5.2f}s/nb)   "
+            f"repeat {results[1]:6.1f}s ({results[1] / notebooks:5.2f}s/nb)   "
+            f"cache {disk_bytes(cache_root) / 1024 / 1024:7.1f} MB"
+        )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notebooks", type=int, default=20)
+    parser.add_argument("--packages", default="pydantic requests")
+    parser.add_argument("--modes", default="isolated,shared,uv")
+    args = parser.parse_args()
+
+    for mode in args.modes.split(','):
+        if mode == 'uv' and not shutil.which('uv'):
+            print("uv       skipped, uv not on PATH")
+            continue
+        asyncio.run(run(mode, args.notebooks, args.packages.split()))
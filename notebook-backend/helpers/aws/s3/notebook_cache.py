@@ -0,0 +1,155 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Optional
+from helpers.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Bytes of notebook JSON kept in memory, least recently used dropped first.
+NOTEBOOK_CACHE_MAX_BYTES = int(os.environ.get('NOTEBOOK_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Optional second tier on local disk, so a restarted worker can still revalidate
+# instead of downloading. Empty disables it.
+NOTEBOOK_CACHE_DIR = os.environ.get('NOTEBOOK_CACHE_DIR', '')
+NOTEBOOK_CACHE_DISK_MAX_BYTES = int(os.environ.get('NOTEBOOK_CACHE_DISK_MAX_BYTES', 1024 * 1024 * 1024))
+
+cache_requests = registry.counter(
+    'notebook_cache_requests_total',
+    'Notebook loads by cache result: memory or disk (revalidated, not downloaded), stale (changed in S3) or miss',
+    ('result',),
+)
+cache_bytes_saved = registry.counter('notebook_cache_bytes_saved_total', 'S3 bytes not downloaded because the cached copy was current')
+
+
+@dataclass
+class CachedNotebook:
+    etag: str
+    body: str
+    # Size of the object in S3, which is compressed when the body isn't.
+    stored_bytes: int = 0
+    # Which tier answered get(): 'memory' or 'disk'.
+    source: str = 'memory'
+
+
+class NotebookCache:
+    """
+    S3 notebook bodies and their ETags, keyed by object key. The cache never
+    answers on its own: callers revalidate the ETag with a conditional GET and
+    use the cached body only when S3 says it is unchanged. Safe to use from
+    the threads boto3 calls run in.
+    """
+
+    def __init__(self, max_bytes: int = None, directory: str = None, disk_max_bytes: int = None):
+        self.max_bytes = max_bytes if max_bytes is not None else NOTEBOOK_CACHE_MAX_BYTES
+        self.directory = directory if directory is not None else NOTEBOOK_CACHE_DIR
+        self.disk_max_bytes = disk_max_bytes if disk_max_bytes is not None else NOTEBOOK_CACHE_DISK_MAX_BYTES
+        self._entries: "OrderedDict[str, CachedNotebook]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def hit_ratio(self) -> float:
+        """Share of loads answered from the cache since startup."""
+        hits = cache_requests.value(result='memory') + cache_requests.value(result='disk')
+        total = hits + cache_requests.value(result='stale') + cache_requests.value(result='miss')
+        return hits / total if total else 0.0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+    def get(self, key: str) -> Optional[CachedNotebook]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            # The disk tier is pruned oldest mtime first.
+            os.utime(path)
+            entry = CachedNotebook(etag=data['etag'], body=data['body'], stored_bytes=data.get('stored_bytes', 0))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable notebook cache file for {key}: {e}")
+            return None
+        self._remember(key, entry)
+        return replace(entry, source='disk')
+
+    def put(self, key: str, etag: Optional[str], body: str, stored_bytes: int = 0):
+        if not etag:
+            return
+        entry = CachedNotebook(etag=etag, body=body, stored_bytes=stored_bytes)
+        self._remember(key, entry)
+        if self.directory:
+            try:
+                self._write_disk(key, entry)
+            except OSError as e:
+                logger.warning(f"Could not write notebook cache file for {key}: {e}")
+
+    def invalidate(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry.body)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _remember(self, key: str, entry: CachedNotebook):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous.body)
+            # A notebook bigger than the whole cache would only evict everything else.
+            if len(entry.body) > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._bytes += len(entry.body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+
+    def _write_disk(self, key: str, entry: CachedNotebook):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'etag': entry.etag, 'body': entry.body, 'stored_bytes': entry.stored_bytes}, f)
+        # Readers in other workers see the old file or the new one, never half of one.
+        os.replace(tmp_path, path)
+        self._prune_disk()
+
+    def _prune_disk(self):
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
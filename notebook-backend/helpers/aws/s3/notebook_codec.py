@@ -0,0 +1,78 @@
+import os
+import gzip
+import logging
+from functools import lru_cache
+from helpers.metrics import registry
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Compressed notebooks start with MAGIC and a codec byte, then the compressed
+# JSON. Raw JSON objects written before this format start with '[' or '{', so
+# both kinds decode without any metadata.
+MAGIC = b'NBZ\x00'
+CODEC_IDS = {'gzip': 1, 'zstd': 2}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+
+# gzip, zstd (needs the zstandard package, falls back to gzip without it) or
+# none to keep writing raw JSON.
+NOTEBOOK_STORAGE_CODEC = os.environ.get('NOTEBOOK_STORAGE_CODEC', 'gzip')
+# Empty uses the codec's default: 6 for gzip, 3 for zstd.
+NOTEBOOK_STORAGE_LEVEL = os.environ.get('NOTEBOOK_STORAGE_LEVEL', '')
+
+storage_bytes = registry.counter('notebook_storage_bytes_total', 'Notebook bytes written, before and after compression', ('kind',))
+
+
+def resolve_codec(codec: str = None) -> str:
+    return _resolve_codec((codec or NOTEBOOK_STORAGE_CODEC).lower())
+
+
+@lru_cache(maxsize=None)
+def _resolve_codec(codec: str) -> str:
+    # Cached so a missing zstandard is warned about once, not on every save.
+    if codec == 'zstd' and zstandard is None:
+        logger.warning("NOTEBOOK_STORAGE_CODEC=zstd but zstandard isn't installed; using gzip")
+        return 'gzip'
+    if codec not in CODEC_IDS and codec != 'none':
+        raise ValueError(f"Unknown notebook storage codec '{codec}'")
+    return codec
+
+
+def encode(text: str, codec: str = None, level: int = None) -> bytes:
+    """Notebook JSON as stored in S3. CPU-bound, so call it off the event loop."""
+    codec = resolve_codec(codec)
+    if level is None and NOTEBOOK_STORAGE_LEVEL:
+        level = int(NOTEBOOK_STORAGE_LEVEL)
+    raw = text.encode('utf-8')
+    if codec == 'none':
+        data = raw
+    elif codec == 'gzip':
+        # mtime=0 so the same notebook always compresses to the same bytes.
+        data = MAGIC + bytes([CODEC_IDS['gzip']]) + gzip.compress(raw, compresslevel=level if level is not None else 6, mtime=0)
+    else:
+        compressor = zstandard.ZstdCompressor(level=level if level is not None else 3)
+        data = MAGIC + bytes([CODEC_IDS['zstd']]) + compressor.compress(raw)
+    storage_bytes.inc(len(raw), kind='raw')
+    storage_bytes.inc(len(data), kind='stored')
+    return data
+
+
+def decode(data: bytes) -> str:
+    """Notebook JSON from a stored object, compressed or raw."""
+    if not data.startswith(MAGIC):
+        return data.decode('utf-8')
+    codec = CODEC_NAMES.get(data[len(MAGIC)] if len(data) > len(MAGIC) else None)
+    payload = data[len(MAGIC) + 1:]
+    if codec == 'gzip':
+        return gzip.decompress(payload).decode('utf-8')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Notebook is zstd-compressed but zstandard isn't installed")
+        # stream_reader handles frames written without a content size.
+        with zstandard.ZstdDecompressor().stream_reader(payload) as reader:
+            return reader.read().decode('utf-8')
+    raise ValueError("Unknown notebook storage codec in header")
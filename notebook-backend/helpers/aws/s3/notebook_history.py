@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from botocore.exceptions import ClientError
+from helpers.aws.s3 import notebook_codec
+from helpers.metrics import registry, s3_request_seconds
+
+logger = logging.getLogger(__name__)
+
+NOTEBOOK_HISTORY_ENABLED = os.environ.get('NOTEBOOK_HISTORY_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Parallel cell uploads and downloads per snapshot or restore.
+NOTEBOOK_HISTORY_CONCURRENCY = int(os.environ.get('NOTEBOOK_HISTORY_CONCURRENCY', 8))
+# Latest manifests kept in memory, so a snapshot knows which cells are stored
+# without listing the notebook's versions.
+NOTEBOOK_HISTORY_HEADS_MAX = 1000
+
+# Millisecond timestamp first, so S3's lexicographic listing is chronological.
+VERSION_ID = re.compile(r'^\d{13}-[0-9a-f]{12}$')
+
+history_versions = registry.counter('notebook_history_versions_total', 'Notebook versions recorded')
+history_cells = registry.counter('notebook_history_cells_total', 'Cells in recorded versions, uploaded or already stored', ('result',))
+history_bytes_uploaded = registry.counter('notebook_history_bytes_uploaded_total', 'Bytes uploaded for notebook versions, cells and manifests')
+
+
+def cell_hash(cell: dict) -> str:
+    return hashlib.sha256(json.dumps(cell, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class NotebookHistory:
+    """
+    Version history of notebooks in S3, content-addressed so that storage
+    grows with the edits rather than with the number of saves:
+
+        notebooks/{user_id}/cells/{sha256}.json                      one cell, stored once
+        notebooks/{user_id}/versions/{notebook_id}/{version_id}.json manifest of cell hashes
+
+    Cells are shared by all of a user's notebooks, so a copied notebook costs
+    only its manifest. Nothing is ever overwritten; restoring a version
+    records it again as the newest one.
+
+    The latest manifest of each notebook is cached with the ETag of the
+    notebook object it was recorded for. Other workers save notebooks too, so
+    callers drop the cached head (forget_head) when the object's ETag is no
+    longer that one.
+    """
+
+    def __init__(self, client, bucket_name: str):
+        self.client = client
+        self.bucket_name = bucket_name
+        # (user_id, notebook_id) -> (version_id, cell hashes, notebook ETag) of
+        # the latest version. The ETag is None when the head was read from S3.
+        self._heads: "OrderedDict[Tuple[str, str], Tuple[str, List[str], Optional[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cell_key(user_id: str, digest: str) -> str:
+        return f"notebooks/{user_id}/cells/{digest}.json"
+
+    @staticmethod
+    def _versions_prefix(user_id: str, notebook_id: str) -> str:
+        return f"notebooks/{user_id}/versions/{notebook_id}/"
+
+    def _put(self, key: str, text: str, operation: str):
+        body = notebook_codec.encode(text)
+        with s3_request_seconds.time(operation=operation):
+            self.client.put_object(Bucket=self.bucket_name, Key=key, Body=body)
+        history_bytes_uploaded.inc(len(body))
+
+    def _get(self, key: str, operation: str) -> Optional[str]:
+        try:
+            with s3_request_seconds.time(operation=operation):
+                data = self.client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return notebook_codec.decode(data)
+
+    def list_versions(self, user_id: str, notebook_id: str) -> List[dict]:
+        """The notebook's versions, newest first."""
+        prefix = self._versions_prefix(user_id, notebook_id)
+        versions = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        with s3_request_seconds.time(operation='list_notebook_versions'):
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                for item in page.get('Contents', []):
+                    version_id = item['Key'][len(prefix):-len('.json')]
+                    if VERSION_ID.match(version_id):
+                        versions.append({
+                            'version_id': version_id,
+                            'created_at': int(version_id[:13]) / 1000,
+                            'size': item['Size'],
+                        })
+        versions.sort(key=lambda version: version['version_id'], reverse=True)
+        return versions
+
+    def get_manifest(self, user_id: str, notebook_id: str, version_id: str) -> Optional[dict]:
+        if not VERSION_ID.match(version_id):
+            raise ValueError(f"Invalid version id '{version_id}'")
+        text = self._get(f"{self._versions_prefix(user_id, notebook_id)}{version_id}.json", 'get_notebook_version')
+        return json.loads(text) if text is not None else None
+
+    def load_version(self, user_id: str, notebook_id: str, version_id: str) -> Optional[List[dict]]:
+        """The cells of a version, or None if there is no such version."""
+        manifest = self.get_manifest(user_id, notebook_id, version_id)
+        if manifest is None:
+            return None
+        digests = list(dict.fromkeys(manifest['cells']))
+        with ThreadPoolExecutor(max_workers=NOTEBOOK_HISTORY_CONCURRENCY) as executor:
+            texts = executor.map(lambda digest: self._get(self._cell_key(user_id, digest), 'get_notebook_cell'), digests)
+            cells = dict(zip(digests, texts))
+        missing = [digest for digest, text in cells.items() if text is None]
+        if missing:
+            raise RuntimeError(f"Version {version_id} of notebook {notebook_id} references {len(missing)} missing cells")
+        return [json.loads(cells[digest]) for digest in manifest['cells']]
+
+    def head_etag(self, user_id: str, notebook_id: str) -> Optional[str]:
+        """ETag of the notebook object the cached head was recorded for, if known."""
+        with self._lock:
+            head = self._heads.get((user_id, notebook_id))
+        return head[2] if head is not None else None
+
+    def forget_head(self, user_id: str, notebook_id: str):
+        with self._lock:
+            self._heads.pop((user_id, notebook_id), None)
+
+    def _head(self, user_id: str, notebook_id: str) -> Optional[Tuple[str, List[str], Optional[str]]]:
+        key = (user_id, notebook_id)
+        with self._lock:
+            head = self._heads.get(key)
+            if head is not None:
+                self._heads.move_to_end(key)
+                return head
+        versions = self.list_versions(user_id, notebook_id)
+        if not versions:
+            return None
+        manifest = self.get_manifest(user_id, notebook_id, versions[0]['version_id'])
+        if manifest is None:
+            return None
+        head = (manifest['version_id'], manifest['cells'], None)
+        self._remember_head(user_id, notebook_id, head)
+        return head
+
+    def _remember_head(self, user_id: str, notebook_id: str, head: Tuple[str, List[str], Optional[str]]):
+        key = (user_id, notebook_id)
+        with self._lock:
+            self._heads[key] = head
+            self._heads.move_to_end(key)
+            while len(self._heads) > NOTEBOOK_HISTORY_HEADS_MAX:
+                self._heads.popitem(last=False)
+
+    def snapshot(self, notebook_id: str, user_id: str, cells: List[dict], etag: Optional[str] = None) -> Optional[dict]:
+        """
+        Record the cells as a new version, uploading only cells the latest
+        version doesn't have. `etag` is the notebook object's ETag after the
+        save. Returns the manifest, or None if nothing changed.
+        """
+        digests = [cell_hash(cell) for cell in cells]
+        head = self._head(user_id, notebook_id)
+        if head is not None and head[1] == digests:
+            self._remember_head(user_id, notebook_id, (head[0], head[1], etag))
+            return None
+
+        stored = set(head[1]) if head is not None else set()
+        # Cells are immutable under their hash, so re-uploading one another
+        # notebook already stored is harmless, just not free.
+        uploads: Dict[str, dict] = {}
+        for digest, cell in zip(digests, cells):
+            if digest not in stored:
+                uploads.setdefault(digest, cell)
+        with ThreadPoolExecutor(max_workers=NOTEBOOK_HISTORY_CONCURRENCY) as executor:
+            list(executor.map(
+                lambda item: self._put(self._cell_key(user_id, item[0]), json.dumps(item[1]), 'put_notebook_cell'),
+                uploads.items(),
+            ))
+
+        created_at = time.time()
+        version_id = f"{int(created_at * 1000):013d}-{hashlib.sha256(''.join(digests).encode()).hexdigest()[:12]}"
+        manifest = {
+            'version_id': version_id,
+            'notebook_id': notebook_id,
+            'user_id': user_id,
+            'parent': head[0] if head is not None else None,
+            'created_at': created_at,
+            'cells': digests,
+        }
+        self._put(f"{self._versions_prefix(user_id, notebook_id)}{version_id}.json", json.dumps(manifest), 'put_notebook_version')
+        self._remember_head(user_id, notebook_id, (version_id, digests, etag))
+
+        history_versions.inc()
+        history_cells.inc(len(uploads), result='uploaded')
+        history_cells.inc(len(digests) - len(uploads), result='reused')
+        logger.info(f"Recorded version {version_id} of notebook {notebook_id}: {len(uploads)} of {len(digests)} cells uploaded")
+        return manifest
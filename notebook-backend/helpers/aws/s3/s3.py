@@ -1,9 +1,16 @@
 import boto3
 import os
 import json
+import logging
+from botocore.exceptions import ClientError
 from supabase import Client
+from helpers.aws.s3 import notebook_codec
+from helpers.aws.s3.notebook_cache import NotebookCache, cache_bytes_saved, cache_requests
+from helpers.aws.s3.notebook_history import NOTEBOOK_HISTORY_ENABLED, NotebookHistory
+from helpers.metrics import s3_request_seconds, supabase_request_seconds
 from helpers.supabase.client import get_supabase_client
 supabase: Client = get_supabase_client()
+logger = logging.getLogger(__name__)
 
 ##Init boto3
 s3 = boto3.client('s3', 
@@ -12,6 +19,8 @@ s3 = boto3.client('s3',
     region_name=os.environ.get('AWS_DEFAULT_REGION')
 )
 bucket_name = 'notebook-lambda-generator'
+notebook_cache = NotebookCache()
+notebook_history = NotebookHistory(s3, bucket_name)
 
 
 # TODO: Save the notebook to s3.
@@ -20,15 +29,33 @@ def save_or_update_notebook(notebook_id: str, user_id: str, notebook: dict, buck
         raise ValueError("Notebook ID is required")
     if not user_id:
         raise ValueError("User ID is required")
-    if not notebook:
-        raise ValueError("Notebook is required")    
+    # [] is a valid notebook, one whose cells were all deleted.
+    if notebook is None:
+        raise ValueError("Notebook is required")
     
     try:
         file_path = f"notebooks/{user_id}/{notebook_id}.json"
+        # The next load downloads the new content instead of revalidating stale bytes.
+        notebook_cache.invalidate(file_path)
         # Check if notebook exists and get its content if it does        
         # Save or update notebook to S3
-        aws_response = s3.put_object(Bucket=bucket_name, Key=file_path, Body=json.dumps(notebook))
-        print("AWS Response:", aws_response)
+        body = notebook_codec.encode(json.dumps(notebook))
+        aws_response = None
+        head_etag = notebook_history.head_etag(user_id, notebook_id) if NOTEBOOK_HISTORY_ENABLED else None
+        if head_etag:
+            # Conditional on the object the cached history head was recorded
+            # for; a mismatch means another worker saved the notebook since.
+            try:
+                with s3_request_seconds.time(operation='put_notebook'):
+                    aws_response = s3.put_object(Bucket=bucket_name, Key=file_path, Body=body, IfMatch=head_etag)
+            except ClientError as e:
+                if not _precondition_failed(e):
+                    raise
+                notebook_history.forget_head(user_id, notebook_id)
+        if aws_response is None:
+            with s3_request_seconds.time(operation='put_notebook'):
+                aws_response = s3.put_object(Bucket=bucket_name, Key=file_path, Body=body)
+        logger.debug(f"AWS Response: {aws_response}")
 
         if aws_response['ResponseMetadata']['HTTPStatusCode'] != 200:
             raise Exception("Failed to save notebook to S3")
@@ -37,12 +64,20 @@ def save_or_update_notebook(notebook_id: str, user_id: str, notebook: dict, buck
         url = f"https://{bucket_name}.s3.amazonaws.com/{file_path}"
         
         # Save URL to Supabase based on notebook_id and user_id
-        supabase.table('notebooks').upsert({
-            'id': notebook_id, 
-            'user_id': user_id,
-            's3_url': url,
-            'updated_at': 'now()'
-        }).execute()
+        with supabase_request_seconds.time(operation='upsert_notebook'):
+            supabase.table('notebooks').upsert({
+                'id': notebook_id, 
+                'user_id': user_id,
+                's3_url': url,
+                'updated_at': 'now()'
+            }).execute()
+
+        if NOTEBOOK_HISTORY_ENABLED:
+            try:
+                notebook_history.snapshot(notebook_id, user_id, notebook, etag=aws_response.get('ETag'))
+            except Exception as e:
+                # The notebook itself is saved; only this version is missing from its history.
+                logger.error(f"Failed to record a version of notebook {notebook_id}: {e}")
         
         return {
             'statusCode': 200,
@@ -57,14 +92,43 @@ def save_or_update_notebook(notebook_id: str, user_id: str, notebook: dict, buck
             'url': None
         }
     
+def _precondition_failed(error: ClientError) -> bool:
+    # 404: the object was deleted since, which is a change too.
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in (404, 409, 412) \
+        or error.response.get('Error', {}).get('Code') in ('NoSuchKey', 'PreconditionFailed', 'ConditionalRequestConflict')
+
+
+def _not_modified(error: ClientError) -> bool:
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304 \
+        or error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+
 # TODO: Load the notebook from s3.
 def load_notebook(s3_url: str):
     try:
-        response = s3.get_object(Bucket=bucket_name, Key=s3_url)
-        print("Response:", len(response))
-        # logger.info(f"Response: {response}")
+        # Revalidate a cached copy with a conditional GET; S3 answers 304
+        # without a body when it is still current.
+        cached = notebook_cache.get(s3_url)
+        try:
+            with s3_request_seconds.time(operation='get_notebook'):
+                if cached is not None:
+                    response = s3.get_object(Bucket=bucket_name, Key=s3_url, IfNoneMatch=cached.etag)
+                else:
+                    response = s3.get_object(Bucket=bucket_name, Key=s3_url)
+                data = response.get('Body').read()
+            # Compressed and raw JSON objects both decode here.
+            body = notebook_codec.decode(data)
+        except ClientError as e:
+            if cached is None or not _not_modified(e):
+                raise
+            cache_requests.inc(result='memory' if cached.source == 'memory' else 'disk')
+            cache_bytes_saved.inc(cached.stored_bytes or len(cached.body))
+            body = cached.body
+        else:
+            cache_requests.inc(result='stale' if cached is not None else 'miss')
+            notebook_cache.put(s3_url, response.get('ETag'), body, stored_bytes=len(data))
         return {
-            'response': response.get('Body').read().decode('utf-8'),
+            'response': body,
             'statusCode': 200,
             'message': 'Notebook loaded successfully'
         }
@@ -13,6 +13,7 @@ class ECRManager:
         self.registry_url = f"{self.account_id}.dkr.ecr.{self.region}.amazonaws.com"
         self.repository_name = repository_name
         self.file_base_path = file_base_path
+        self.image_size = None
 
     def get_auth_credentials(self):
         """Get ECR authentication credentials"""
@@ -118,6 +119,10 @@ class ECRManager:
         repository_uri = self.get_repository_uri(self.repository_name)
         return f"{repository_uri}:{tag}"
 
+    def get_local_image_size(self, image_uri):
+        """Uncompressed size in bytes of a locally built image"""
+        return int(str(sh.docker.image.inspect('-f', '{{.Size}}', image_uri)).strip())
+
     def build_and_push_image(self, tag='latest', dockerfile_path='.'):
         """Build and push image to ECR"""
         try:
@@ -136,6 +141,9 @@ class ECRManager:
                 '-t', image_uri,
                 dockerfile_path)
             
+            self.image_size = self.get_local_image_size(image_uri)
+            print(f"Built image {image_uri}: {self.image_size / 1024 / 1024:.1f} MB")
+            
             # Push image
             sh.docker.push(image_uri)
             
@@ -98,6 +98,7 @@ class LambdaGenerator:
     def prepare_container(self):
         with open(os.path.join(self.base_folder_path, 'requirements.txt'), 'w') as f:
             f.write(self.dependencies)
+        logger.info(f"requirements.txt has {len(self.dependencies.splitlines())} packages")
             
         docker_file_sample = open(os.path.join(self.helper_script_path, 'dockerfile_sample'), 'r').read()
         
@@ -109,7 +110,7 @@ class LambdaGenerator:
     def build_and_push_container(self):
         logger.info("Starting container build and push")
         self.image_uri = self.ecr_manager.build_and_push_image()
-        logger.info(f"Container built and pushed with URI: {self.image_uri}")
+        logger.info(f"Container built and pushed with URI: {self.image_uri} ({self.ecr_manager.image_size / 1024 / 1024:.1f} MB)")
 
     def create_lambda_fn(self):
         """
@@ -0,0 +1,124 @@
+import re
+import ast
+import sys
+import json
+import logging
+from typing import Dict, List, Set, Tuple
+from helpers.notebook.notebook import NotebookUtils
+
+logger = logging.getLogger(__name__)
+
+# Kernel-side helper, run through NotebookUtils.run_silent so the mapping comes
+# from the env the notebook actually ran in. packages_distributions is new in
+# Python 3.10; on older envs the mapping is built from top_level.txt or the
+# distribution's file list.
+REQUIREMENTS_SNIPPET = '''
+def __nb_requirements(modules):
+    import json, sys
+    from importlib import metadata
+    try:
+        mapping = metadata.packages_distributions()
+    except AttributeError:
+        mapping = {}
+        for dist in metadata.distributions():
+            names = (dist.read_text('top_level.txt') or '').split()
+            if not names:
+                for path in dist.files or []:
+                    top = path.parts[0]
+                    if top.endswith(('.dist-info', '.egg-info')) or top == '..':
+                        continue
+                    name = top[:-3] if top.endswith('.py') else top
+                    if name.isidentifier() and name not in names:
+                        names.append(name)
+            for name in names:
+                mapping.setdefault(name, []).append(dist.metadata['Name'])
+    stdlib = set(getattr(sys, 'stdlib_module_names', ())) | set(sys.builtin_module_names)
+    requirements, unresolved = {}, []
+    for module in modules:
+        if module in stdlib:
+            continue
+        dists = mapping.get(module)
+        if not dists:
+            unresolved.append(module)
+            continue
+        for dist in dists:
+            requirements[dist.lower()] = (dist, metadata.version(dist))
+    sys.stdout.write(json.dumps({
+        'requirements': sorted(requirements.values()),
+        'unresolved': sorted(unresolved),
+    }))
+__nb_requirements(%(modules)r)
+del __nb_requirements
+'''
+
+# `name==1.0`, `name[extra]==1.0` or `name @ url`, as pip freeze writes them.
+_REQUIREMENT_LINE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*(\[[A-Za-z0-9._,-]*\])?\s*(===?\s*\S+|@\s*\S+)$')
+_IMPORT_LINE = re.compile(r'^\s*(?:from\s+([\w.]+)\s+import\b|import\s+([\w.,\s]+?)(?:\s+as\s+\w+)?\s*$)')
+
+
+def _strip_magics(code: str) -> str:
+    # `!pip install ...` and `%timeit` lines aren't Python.
+    return '\n'.join('' if line.lstrip().startswith(('!', '%')) else line for line in code.splitlines())
+
+
+def imported_modules(code: str) -> Set[str]:
+    """Top-level names of the modules `code` imports, including importlib.import_module('x')."""
+    code = _strip_magics(code)
+    modules = set()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # Fall back to a line scan so one broken cell doesn't hide every import.
+        for line in code.splitlines():
+            match = _IMPORT_LINE.match(line)
+            if match and match.group(1):
+                modules.add(match.group(1))
+            elif match:
+                modules.update(part.split()[0] for part in match.group(2).split(',') if part.strip())
+        return {module.split('.')[0] for module in modules if not module.startswith('.')}
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.add(node.module)
+        elif isinstance(node, ast.Call) and node.args and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+            func = node.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, 'id', None)
+            if name in ('import_module', '__import__'):
+                modules.add(node.args[0].value)
+    return {module.split('.')[0] for module in modules}
+
+
+def format_requirements(requirements: List[Tuple[str, str]]) -> str:
+    return ''.join(f"{name}=={version}\n" for name, version in requirements)
+
+
+def freeze_requirements(output: str) -> str:
+    """
+    requirements.txt content from `pip list --format=freeze` output, keeping
+    only requirement lines; warnings and status messages that came along
+    with it are dropped.
+    """
+    lines = [line.strip() for line in output.splitlines()]
+    return ''.join(f"{line}\n" for line in lines if _REQUIREMENT_LINE.match(line))
+
+
+async def infer_requirements(nb: NotebookUtils, code: str) -> Tuple[str, Dict]:
+    """
+    requirements.txt content with only the distributions that provide the
+    modules `code` imports, pinned to the versions installed in the kernel.
+    Returns (requirements, report).
+    """
+    modules = sorted(module for module in imported_modules(code) if module not in sys.stdlib_module_names)
+    output = await nb.run_silent(REQUIREMENTS_SNIPPET % {'modules': modules})
+    result = json.loads(output)
+    requirements = [tuple(requirement) for requirement in result['requirements']]
+    report = {
+        'imports': modules,
+        'requirements': [f"{name}=={version}" for name, version in requirements],
+        # Modules defined in the notebook itself, or not installed.
+        'unresolved': result['unresolved'],
+    }
+    logger.info(f"Inferred {len(requirements)} requirements for notebook {nb.notebook_id} from {len(modules)} imports; unresolved: {result['unresolved']}")
+    return format_requirements(requirements), report
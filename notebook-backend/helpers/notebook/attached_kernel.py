@@ -0,0 +1,71 @@
+import os
+import signal
+import asyncio
+import logging
+from typing import Optional
+from jupyter_client.asynchronous import AsyncKernelClient
+from helpers.notebook.session_registry import pid_alive
+
+logger = logging.getLogger(__name__)
+
+
+def connection_info_to_json(info: dict) -> dict:
+    """Connection info as returned by get_connection_info, made JSON-safe."""
+    info = dict(info)
+    if isinstance(info.get('key'), bytes):
+        info['key'] = info['key'].decode('utf-8')
+    return info
+
+
+class AttachedKernelManager:
+    """
+    Stands in for AsyncKernelManager when the kernel process was started by
+    someone else (another worker, or a kernel host) and we only have its
+    connection info. Interrupts use SIGINT when the pid is local and an
+    interrupt_request on the control channel otherwise.
+    """
+
+    def __init__(self, kernel_client: AsyncKernelClient, pid: Optional[int] = None, local: bool = True):
+        self.kernel_client = kernel_client
+        self.pid = pid
+        self.local = local
+        self._alive = True
+
+    @property
+    def has_kernel(self) -> bool:
+        return self._alive
+
+    async def is_alive(self) -> bool:
+        """Whether the kernel still runs: its pid when local, its heartbeat otherwise."""
+        if not self._alive:
+            return False
+        if self.local and self.pid:
+            return pid_alive(self.pid)
+        return await self.kernel_client.is_alive()
+
+    async def interrupt_kernel(self):
+        if self.local and self.pid:
+            os.kill(self.pid, signal.SIGINT)
+            return
+        msg = self.kernel_client.session.msg('interrupt_request', content={})
+        self.kernel_client.control_channel.send(msg)
+
+    async def shutdown_kernel(self, now: bool = False, restart: bool = False):
+        # NotebookUtils stops the client's channels before shutting down, so
+        # send the request from a fresh client.
+        client = AsyncKernelClient()
+        client.load_connection_info(self.kernel_client.get_connection_info())
+        client.start_channels(shell=False, iopub=False, stdin=False, hb=False, control=True)
+        client.shutdown(restart=restart)
+        await asyncio.sleep(0.1)
+        client.stop_channels()
+        if self.local and self.pid and now:
+            await asyncio.sleep(1)
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self._alive = False
+
+    def get_connection_info(self, session: bool = False) -> dict:
+        return self.kernel_client.get_connection_info(session=session)
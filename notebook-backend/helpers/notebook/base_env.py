@@ -0,0 +1,70 @@
+import os
+import sh
+import sys
+import time
+import logging
+import threading
+from typing import Optional
+from helpers.notebook.env_registry import CondaEnvRegistry
+
+logger = logging.getLogger(__name__)
+
+BASE_ENV_NAME = os.environ.get('BASE_ENV_NAME') or 'venv_kernel_base'
+# Common data stack preinstalled in the golden env that notebook envs are cloned from.
+# An empty value (as in .env.template) keeps the default: an env without
+# python and ipykernel couldn't run a kernel.
+BASE_ENV_PACKAGES = (
+    os.environ.get('BASE_ENV_PACKAGES')
+    or 'python=3.9 ipykernel numpy pandas matplotlib requests pydantic'
+).split()
+
+_base_env_lock = threading.Lock()
+
+
+def ensure_base_env() -> Optional[str]:
+    """
+    Create the golden base env once and return its path.
+    Returns None if it cannot be built, callers then fall back to a fresh env.
+    """
+    registry = CondaEnvRegistry.get_registry()
+    with _base_env_lock:
+        base_env_path = registry.get(BASE_ENV_NAME)
+        if base_env_path:
+            return base_env_path
+        # Another process may have built it since the registry was loaded.
+        registry.refresh()
+        base_env_path = registry.get(BASE_ENV_NAME)
+        if base_env_path:
+            return base_env_path
+
+        start = time.perf_counter()
+        try:
+            sh.conda("create", "-n", BASE_ENV_NAME, *BASE_ENV_PACKAGES, "-y", _out=sys.stdout, _err=sys.stderr)
+        except sh.ErrorReturnCode as e:
+            logger.error(f"Failed to create base env {BASE_ENV_NAME}: {e}")
+            return None
+        registry.refresh()
+        logger.info(f"Created base env {BASE_ENV_NAME} in {time.perf_counter() - start:.1f}s")
+        return registry.get(BASE_ENV_NAME)
+
+
+def clone_base_env(env_name: str) -> bool:
+    """
+    Clone the base env into env_name. conda hardlinks package files when the
+    envs share a filesystem, so a clone needs no solve, no download and
+    little extra disk.
+    """
+    if not ensure_base_env():
+        return False
+
+    start = time.perf_counter()
+    try:
+        sh.conda(
+            "create", "-n", env_name, "--clone", BASE_ENV_NAME, "--offline", "-y",
+            _out=sys.stdout, _err=sys.stderr
+        )
+    except sh.ErrorReturnCode as e:
+        logger.error(f"Failed to clone {BASE_ENV_NAME} into {env_name}: {e}")
+        return False
+    logger.info(f"Cloned {BASE_ENV_NAME} into {env_name} in {time.perf_counter() - start:.1f}s")
+    return True
@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import time
+import hashlib
+import asyncio
+import logging
+import tempfile
+from typing import List, Optional
+from helpers.notebook.notebook import NotebookUtils
+from helpers.notebook.dependency_graph import analyze_cell
+from helpers.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CELL_CACHE_DIR = os.environ.get('CELL_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'notebook_cell_cache')
+CELL_CACHE_MAX_BYTES = int(os.environ.get('CELL_CACHE_MAX_BYTES', 5 * 1024 * 1024 * 1024))
+
+cache_requests = registry.counter('notebook_cell_cache_requests_total', 'Cell cache lookups', ('result',))
+cache_evictions = registry.counter('notebook_cell_cache_evictions_total', 'Cell cache entries evicted to stay under the size limit')
+
+# Kernel-side helpers. They run through NotebookUtils.run_silent, define
+# nothing in the user namespace and report back as JSON on stdout.
+# Functions and classes pickle by reference (module + name), so their
+# fingerprint hashes what they'd run instead: bytecode, constants, names,
+# defaults and closures, and for classes the bases and the attributes
+# defined in the class body.
+FINGERPRINT_SNIPPET = '''
+def __nb_cache_fingerprint(names):
+    import hashlib, json, pickle, sys, types
+    ns = get_ipython().user_ns
+
+    def code_digest(h, code):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                code_digest(h, const)
+            else:
+                h.update(repr(const).encode())
+
+    def digest(h, value, seen):
+        if id(value) in seen:
+            h.update(b'cycle')
+            return
+        if isinstance(value, (types.FunctionType, type)):
+            seen = seen | {id(value)}
+        if isinstance(value, types.ModuleType):
+            h.update(('module:' + value.__name__).encode())
+        elif isinstance(value, types.FunctionType):
+            h.update(b'function')
+            code_digest(h, value.__code__)
+            for item in (value.__defaults__ or ()) + tuple(sorted((value.__kwdefaults__ or {}).items())):
+                digest(h, item, seen)
+            for cell in value.__closure__ or ():
+                try:
+                    digest(h, cell.cell_contents, seen)
+                except ValueError:
+                    h.update(b'empty cell')
+        elif isinstance(value, type):
+            h.update(('class:' + value.__qualname__).encode())
+            for base in value.__bases__:
+                if base.__module__ == '__main__':
+                    digest(h, base, seen)
+                else:
+                    h.update((base.__module__ + '.' + base.__qualname__).encode())
+            for attr, item in sorted(vars(value).items()):
+                if attr in ('__dict__', '__weakref__', '__doc__', '__module__', '__qualname__'):
+                    continue
+                h.update(attr.encode())
+                if isinstance(item, property):
+                    for accessor in (item.fget, item.fset, item.fdel):
+                        digest(h, accessor, seen)
+                else:
+                    digest(h, getattr(item, '__func__', item), seen)
+        else:
+            h.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    result = {}
+    for name in names:
+        if name not in ns:
+            result[name] = None
+            continue
+        value = ns[name]
+        if isinstance(value, types.ModuleType):
+            result[name] = 'module:' + value.__name__
+            continue
+        h = hashlib.sha256()
+        try:
+            digest(h, value, frozenset())
+            result[name] = h.hexdigest()
+        except Exception:
+            # Unpicklable values only match within the same object lifetime.
+            result[name] = 'id:' + type(value).__qualname__ + ':' + str(id(value))
+    sys.stdout.write(json.dumps(result))
+__nb_cache_fingerprint(%(names)s)
+del __nb_cache_fingerprint
+'''
+
+STORE_SNIPPET = '''
+def __nb_cache_store(names, path):
+    import json, pickle, sys, types
+    ns = get_ipython().user_ns
+    values = {}
+    for name in names:
+        if name not in ns:
+            continue
+        value = ns[name]
+        values[name] = ('__module__', value.__name__) if isinstance(value, types.ModuleType) else value
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        sys.stdout.write(json.dumps({'stored': False, 'error': str(e)}))
+        return
+    import os
+    os.replace(path + '.tmp', path)
+    sys.stdout.write(json.dumps({'stored': True}))
+__nb_cache_store(%(names)s, %(path)r)
+del __nb_cache_store
+'''
+
+RESTORE_SNIPPET = '''
+def __nb_cache_restore(path):
+    import importlib, pickle
+    ns = get_ipython().user_ns
+    with open(path, 'rb') as f:
+        values = pickle.load(f)
+    for name, value in values.items():
+        if isinstance(value, tuple) and len(value) == 2 and value[0] == '__module__':
+            value = importlib.import_module(value[1])
+        ns[name] = value
+__nb_cache_restore(%(path)r)
+del __nb_cache_restore
+'''
+
+
+class CellCache:
+    """
+    Opt-in memoization of cell results on local disk.
+    Entries are keyed by the notebook (and user, when known), the cell
+    source, a fingerprint of the values the cell reads from the kernel
+    namespace, and the size/mtime of any file the source names, so pickles
+    and outputs never cross between notebooks or users. An entry holds the
+    cell's outputs and a pickle of the names it defines. The store is kept under CELL_CACHE_MAX_BYTES by
+    evicting the least recently used entries.
+    """
+    _instance: Optional["CellCache"] = None
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        self.cache_dir = cache_dir or CELL_CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else CELL_CACHE_MAX_BYTES
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def get_cache(cls) -> "CellCache":
+        if cls._instance is None:
+            cls._instance = CellCache()
+        return cls._instance
+
+    def _paths(self, key: str):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.json', base + '.pkl'
+
+    @staticmethod
+    def _file_fingerprints(code: str) -> List[list]:
+        """size/mtime of files named by string literals, e.g. read_csv('public/uploads/a.csv')."""
+        fingerprints = []
+        for path in sorted(set(re.findall(r"""['"]([^'"\n]+)['"]""", code))):
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                fingerprints.append([path, stat.st_size, stat.st_mtime])
+        return fingerprints
+
+    async def key_for(self, nb: NotebookUtils, code: str, user_id: Optional[str] = None) -> str:
+        names = analyze_cell(code)
+        reads = sorted(names.reads)
+        values = json.loads(await nb.run_silent(FINGERPRINT_SNIPPET % {'names': json.dumps(reads)})) if reads else {}
+        key_source = json.dumps({
+            'notebook_id': nb.notebook_id,
+            'user_id': user_id,
+            'code': code,
+            'values': values,
+            'files': self._file_fingerprints(code),
+        }, sort_keys=True)
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        meta_path, values_path = self._paths(key)
+        if not (os.path.exists(meta_path) and os.path.exists(values_path)):
+            self.misses += 1
+            cache_requests.inc(result='miss')
+            return None
+        with open(meta_path) as f:
+            entry = json.load(f)
+        now = time.time()
+        # mtime doubles as the LRU clock.
+        os.utime(meta_path, (now, now))
+        os.utime(values_path, (now, now))
+        self.hits += 1
+        cache_requests.inc(result='hit')
+        return entry
+
+    async def restore(self, nb: NotebookUtils, key: str):
+        _, values_path = self._paths(key)
+        await nb.run_silent(RESTORE_SNIPPET % {'path': values_path})
+
+    async def store(self, nb: NotebookUtils, key: str, code: str, output: str, displays: List[dict]) -> bool:
+        meta_path, values_path = self._paths(key)
+        names = sorted(analyze_cell(code).defines)
+        result = json.loads(await nb.run_silent(STORE_SNIPPET % {'names': json.dumps(names), 'path': values_path}))
+        if not result.get('stored'):
+            logger.info(f"Not caching cell, namespace values are not picklable: {result.get('error')}")
+            return False
+
+        with open(meta_path, 'w') as f:
+            json.dump({'output': output, 'displays': displays, 'names': names, 'created_at': time.time()}, f)
+        self.stores += 1
+        await asyncio.to_thread(self.evict)
+        return True
+
+    def evict(self):
+        """Drop least recently used entries until the store fits in max_bytes."""
+        entries = {}
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            key = entry.name.split('.')[0]
+            size, last_used = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime))
+            total += stat.st_size
+
+        for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+            self.evictions += 1
+            cache_evictions.inc()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        size = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes,
+        }
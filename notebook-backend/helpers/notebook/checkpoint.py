@@ -0,0 +1,165 @@
+import os
+import json
+import asyncio
+import logging
+import tempfile
+from helpers.notebook.notebook import NotebookUtils
+from helpers.metrics import s3_request_seconds
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR') or os.path.join(tempfile.gettempdir(), 'notebook_checkpoints')
+# 'local' keeps checkpoints on this host only, 's3' also uploads them.
+CHECKPOINT_STORE = os.environ.get('CHECKPOINT_STORE', 'local')
+
+# Kernel-side helpers, run through NotebookUtils.run_silent.
+# Values are pickled with protocol 5 so large buffers (numpy arrays, pandas
+# blocks) are written out-of-band and stored raw, while the small pickle
+# stream is deflated. cloudpickle is used when the env has it, so that
+# functions and classes defined in the notebook survive too.
+CHECKPOINT_SNIPPET = '''
+def __nb_checkpoint(path):
+    import json, os, pickle, sys, types, zipfile
+    try:
+        import cloudpickle as dumper
+    except ImportError:
+        dumper = pickle
+    ip = get_ipython()
+    hidden = set(ip.user_ns_hidden)
+    modules, values, skipped, buffers = {}, {}, [], []
+    for name, value in list(ip.user_ns.items()):
+        if name.startswith('_') or name in hidden:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        start = len(buffers)
+        try:
+            data = dumper.dumps(value, protocol=5, buffer_callback=buffers.append)
+        except Exception:
+            del buffers[start:]
+            skipped.append(name)
+            continue
+        values[name] = (data, start, len(buffers))
+    with zipfile.ZipFile(path + '.tmp', 'w') as zf:
+        state = pickle.dumps({'modules': modules, 'values': values}, protocol=5)
+        zf.writestr('namespace.pkl', state, compress_type=zipfile.ZIP_DEFLATED)
+        for i, buffer in enumerate(buffers):
+            with zf.open('buffers/' + str(i), 'w', force_zip64=True) as f:
+                f.write(buffer.raw())
+    os.replace(path + '.tmp', path)
+    sys.stdout.write(json.dumps({
+        'variables': sorted(values) + sorted(modules),
+        'skipped': sorted(skipped),
+        'size_bytes': os.path.getsize(path),
+    }))
+__nb_checkpoint(%(path)r)
+del __nb_checkpoint
+'''
+
+RESTORE_SNIPPET = '''
+def __nb_restore(path):
+    import importlib, json, pickle, sys, zipfile
+    ns = get_ipython().user_ns
+    restored, failed = [], []
+    with zipfile.ZipFile(path) as zf:
+        state = pickle.loads(zf.read('namespace.pkl'))
+        for name, module in state['modules'].items():
+            try:
+                ns[name] = importlib.import_module(module)
+                restored.append(name)
+            except Exception:
+                failed.append(name)
+        for name, (data, start, end) in state['values'].items():
+            try:
+                buffers = [zf.read('buffers/' + str(i)) for i in range(start, end)]
+                ns[name] = pickle.loads(data, buffers=buffers)
+                restored.append(name)
+            except Exception:
+                failed.append(name)
+    sys.stdout.write(json.dumps({'restored': sorted(restored), 'failed': sorted(failed)}))
+__nb_restore(%(path)r)
+del __nb_restore
+'''
+
+
+def checkpoints_supported(nb: NotebookUtils) -> bool:
+    """
+    The kernel writes and reads the checkpoint file itself, so CHECKPOINT_DIR
+    must be on its filesystem; kernels on a kernel host don't share it.
+    """
+    return getattr(nb.kernel_manager, 'local', True)
+
+
+def _require_local_kernel(nb: NotebookUtils):
+    if not checkpoints_supported(nb):
+        raise RuntimeError("Checkpoints are not supported for kernels running on a kernel host")
+
+
+def _checked(name: str, value: str) -> str:
+    if not value or value in ('.', '..') or os.path.basename(value) != value:
+        raise ValueError(f"Invalid {name} '{value}'")
+    return value
+
+
+def checkpoint_path(user_id: str, notebook_id: str) -> str:
+    return os.path.join(CHECKPOINT_DIR, _checked('user id', user_id), f"{_checked('notebook id', notebook_id)}.zip")
+
+
+def checkpoint_s3_key(user_id: str, notebook_id: str) -> str:
+    return f"notebooks/{_checked('user id', user_id)}/checkpoints/{_checked('notebook id', notebook_id)}.zip"
+
+
+def _upload_checkpoint(user_id: str, notebook_id: str):
+    from helpers.aws.s3 import s3
+    with s3_request_seconds.time(operation='put_checkpoint'):
+        s3.s3.upload_file(checkpoint_path(user_id, notebook_id), s3.bucket_name, checkpoint_s3_key(user_id, notebook_id))
+
+
+def _download_checkpoint(user_id: str, notebook_id: str):
+    from helpers.aws.s3 import s3
+    with s3_request_seconds.time(operation='get_checkpoint'):
+        s3.s3.download_file(s3.bucket_name, checkpoint_s3_key(user_id, notebook_id), checkpoint_path(user_id, notebook_id))
+
+
+def discard_local_checkpoint(user_id: str, notebook_id: str, keep_only_copy: bool = False):
+    """
+    Delete the checkpoint file on this host. With keep_only_copy, a file that
+    isn't also in S3 is left alone, since it's the only copy there is.
+    """
+    if keep_only_copy and CHECKPOINT_STORE != 's3':
+        return
+    try:
+        os.remove(checkpoint_path(user_id, notebook_id))
+    except FileNotFoundError:
+        pass
+
+
+async def save_checkpoint(nb: NotebookUtils, user_id: str) -> dict:
+    """Serialize the picklable user namespace of the notebook's kernel."""
+    _require_local_kernel(nb)
+    path = checkpoint_path(user_id, nb.notebook_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    result = json.loads(await nb.run_silent(CHECKPOINT_SNIPPET % {'path': path}))
+    if CHECKPOINT_STORE == 's3':
+        await asyncio.to_thread(_upload_checkpoint, user_id, nb.notebook_id)
+    logger.info(f"Checkpointed notebook {nb.notebook_id}: {len(result['variables'])} variables, {result['size_bytes']} bytes")
+    return result
+
+
+async def restore_checkpoint(nb: NotebookUtils, user_id: str) -> dict:
+    """
+    Load the last checkpoint of the notebook into its (fresh) kernel. The
+    local file is deleted once loaded; with the s3 store it's fetched again
+    for the next restore.
+    """
+    _require_local_kernel(nb)
+    path = checkpoint_path(user_id, nb.notebook_id)
+    if CHECKPOINT_STORE == 's3' and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        await asyncio.to_thread(_download_checkpoint, user_id, nb.notebook_id)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No checkpoint found for notebook {nb.notebook_id}")
+    result = json.loads(await nb.run_silent(RESTORE_SNIPPET % {'path': path}))
+    await asyncio.to_thread(discard_local_checkpoint, user_id, nb.notebook_id)
+    return result
@@ -0,0 +1,133 @@
+import ast
+import builtins
+from typing import Iterable, List, Set, Tuple
+
+BUILTIN_NAMES = set(dir(builtins))
+
+
+class CellNames:
+    """Top-level names a cell defines and reads, from static analysis of its source."""
+
+    def __init__(self, defines: Set[str], reads: Set[str], opaque: bool = False):
+        self.defines = defines
+        self.reads = reads
+        # True when the source could not be parsed; such a cell is assumed to touch everything.
+        self.opaque = opaque
+
+
+class _NameCollector(ast.NodeVisitor):
+    def __init__(self):
+        self.defines: Set[str] = set()
+        self.reads: Set[str] = set()
+        self._scope_depth = 0
+
+    def _define(self, name: str):
+        if self._scope_depth == 0:
+            self.defines.add(name)
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            self.reads.add(node.id)
+        else:
+            self._define(node.id)
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self._define((alias.asname or alias.name).split('.')[0])
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        for alias in node.names:
+            if alias.name != '*':
+                self._define(alias.asname or alias.name)
+
+    def visit_Global(self, node: ast.Global):
+        self.defines.update(node.names)
+
+    def _visit_scope(self, node):
+        # Names bound inside functions and comprehensions are local; reads
+        # inside them still count since they may refer to globals.
+        self._scope_depth += 1
+        self.generic_visit(node)
+        self._scope_depth -= 1
+
+    def _visit_def(self, node):
+        self._define(node.name)
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self._scope_depth += 1
+        for child in ast.iter_child_nodes(node):
+            if child not in node.decorator_list:
+                self.visit(child)
+        self._scope_depth -= 1
+
+    visit_FunctionDef = _visit_def
+    visit_AsyncFunctionDef = _visit_def
+    visit_ClassDef = _visit_def
+    visit_Lambda = _visit_scope
+    visit_ListComp = _visit_scope
+    visit_SetComp = _visit_scope
+    visit_DictComp = _visit_scope
+    visit_GeneratorExp = _visit_scope
+
+    def visit_AugAssign(self, node: ast.AugAssign):
+        if isinstance(node.target, ast.Name):
+            self.reads.add(node.target.id)
+        self.generic_visit(node)
+
+    def _mutated_root(self, node) -> str:
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        return node.id if isinstance(node, ast.Name) else None
+
+    def visit_Assign(self, node: ast.Assign):
+        # `df['a'] = ...` and `obj.x = ...` mutate an existing name.
+        for target in node.targets:
+            if isinstance(target, (ast.Attribute, ast.Subscript)):
+                root = self._mutated_root(target)
+                if root:
+                    self._define(root)
+        self.generic_visit(node)
+
+    def visit_Expr(self, node: ast.Expr):
+        # A bare `x.method(...)` call at top level is assumed to mutate x.
+        if isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Attribute):
+            root = self._mutated_root(node.value.func.value)
+            if root:
+                self._define(root)
+        self.generic_visit(node)
+
+
+def analyze_cell(code: str) -> CellNames:
+    # Magic and shell lines are not Python.
+    source = '\n'.join(
+        '' if line.lstrip().startswith(('!', '%')) else line
+        for line in code.splitlines()
+    )
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return CellNames(set(), set(), opaque=True)
+
+    collector = _NameCollector()
+    collector.visit(tree)
+    return CellNames(collector.defines, collector.reads - BUILTIN_NAMES)
+
+
+def stale_cells(cells: List[Tuple[str, str]], changed: Iterable[str]) -> List[str]:
+    """
+    Given the notebook's (cell_id, code) pairs in order and the ids of changed
+    cells, return the ids that need to run: the changed cells and every cell
+    below them that reads a name defined by a cell already marked stale.
+    """
+    changed = set(changed)
+    stale: List[str] = []
+    stale_names: Set[str] = set()
+    everything_stale = False
+    for cell_id, code in cells:
+        names = analyze_cell(code)
+        if cell_id in changed or everything_stale or names.opaque and stale or names.reads & stale_names:
+            stale.append(cell_id)
+            stale_names |= names.defines
+            if names.opaque:
+                everything_stale = True
+    return stale
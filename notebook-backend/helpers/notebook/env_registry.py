@@ -0,0 +1,86 @@
+import os
+import json
+import sh
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CondaEnvRegistry:
+    """
+    In-process map of conda env name -> env path.
+    Filled from `conda env list` once (or from the persisted file when
+    CONDA_ENV_REGISTRY_PATH is set) and kept up to date as envs are
+    created and removed, so lookups are a dictionary read.
+    """
+    _instance: Optional["CondaEnvRegistry"] = None
+
+    def __init__(self, persist_path: str = None):
+        self.persist_path = persist_path or os.environ.get('CONDA_ENV_REGISTRY_PATH')
+        self._envs: Optional[Dict[str, str]] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_registry(cls) -> "CondaEnvRegistry":
+        if cls._instance is None:
+            cls._instance = CondaEnvRegistry()
+        return cls._instance
+
+    def _list_conda_envs(self) -> Dict[str, str]:
+        envs = json.loads(str(sh.conda("env", "list", "--json")))['envs']
+        return {os.path.basename(env): env for env in envs}
+
+    def _load_persisted(self) -> Optional[Dict[str, str]]:
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return None
+        try:
+            with open(self.persist_path) as f:
+                envs = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable env registry {self.persist_path}: {e}")
+            return None
+        # Drop envs that were removed behind our back.
+        return {name: path for name, path in envs.items() if os.path.isdir(path)}
+
+    def _persist(self):
+        if not self.persist_path:
+            return
+        tmp_path = f"{self.persist_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._envs, f)
+        os.replace(tmp_path, self.persist_path)
+
+    def _ensure_loaded(self):
+        if self._envs is None:
+            with self._lock:
+                if self._envs is None:
+                    envs = self._load_persisted()
+                    if envs is None:
+                        envs = self._list_conda_envs()
+                    self._envs = envs
+                    self._persist()
+
+    def get(self, name: str) -> Optional[str]:
+        self._ensure_loaded()
+        return self._envs.get(name)
+
+    def refresh(self):
+        """Re-read the env list from conda."""
+        envs = self._list_conda_envs()
+        with self._lock:
+            self._envs = envs
+            self._persist()
+
+    def add(self, name: str, path: str):
+        self._ensure_loaded()
+        with self._lock:
+            self._envs[name] = path
+            self._persist()
+
+    def remove(self, name: str):
+        self._ensure_loaded()
+        with self._lock:
+            self._envs.pop(name, None)
+            self._persist()
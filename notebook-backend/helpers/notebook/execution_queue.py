@@ -0,0 +1,357 @@
+import time
+import hashlib
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from helpers.notebook.notebook import NotebookUtils, EXECUTION_FINISHED_MARKER, is_magic_command
+from helpers.types import OutputExecutionMessage, OutputChunkMessage, OutputExecutionCompleteMessage, OutputQueuedMessage, OutputCancelledMessage, OutputRunCellsCompleteMessage, OutputDisplayMessage
+from helpers.notebook.mime import split_binary_outputs
+from helpers.notebook.output_buffer import CellOutputBuffer
+from helpers.notebook.cell_cache import CellCache
+from helpers.metrics import queue_wait_seconds, cell_execution_seconds, output_send_seconds
+
+logger = logging.getLogger(__name__)
+
+
+def source_hash(code: str) -> str:
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+
+class ExecutionRequest:
+    def __init__(self, cell_id: Optional[str], code: str, stream: bool = False, future: asyncio.Future = None, cache: bool = False,
+                 user_id: Optional[str] = None):
+        self.cell_id = cell_id
+        self.code = code
+        self.stream = stream
+        # Opt-in memoization through the CellCache, scoped to the notebook and user.
+        self.cache = cache
+        self.user_id = user_id
+        # Set for internal requests (e.g. posthog setup) that await the output instead of sending it.
+        self.future = future
+        self.submitted_at = time.perf_counter()
+
+    @property
+    def cell_ids(self) -> List[str]:
+        return [self.cell_id] if self.cell_id is not None else []
+
+
+class RunCellsRequest(ExecutionRequest):
+    """An ordered batch of cells ("run all") executed as one queue entry."""
+
+    def __init__(self, cells: List[Tuple[str, str]], stop_on_error: bool = True, stream: bool = False):
+        super().__init__(None, None, stream=stream)
+        self.cells = cells
+        self.stop_on_error = stop_on_error
+
+    @property
+    def cell_ids(self) -> List[str]:
+        return [cell_id for cell_id, _ in self.cells]
+
+
+class CellOutput:
+    """Output state of one cell while it runs."""
+
+    def __init__(self):
+        self.buffer = CellOutputBuffer()
+        self.started_at = time.perf_counter()
+        self.seq = 0
+        self.sent_chars = 0
+        self.sent_bytes = 0
+
+
+class KernelTaskRequest(ExecutionRequest):
+    """Internal work that talks to the kernel directly, e.g. checkpoint and restore."""
+
+    def __init__(self, task: Callable[[], Awaitable], future: asyncio.Future):
+        super().__init__(None, None, future=future)
+        self.task = task
+
+
+class ExecutionQueue:
+    """
+    Per-session FIFO of cells waiting for the kernel.
+    Clients can submit cells without waiting for earlier ones to finish; a
+    single worker feeds them to the kernel one after another so it never
+    idles between WebSocket round trips. Everything that reads the kernel's
+    iopub channel goes through here.
+    """
+
+    def __init__(self, nb: NotebookUtils):
+        self.nb = nb
+        # Where results go; rebound to the current WebSocket on every connect.
+        self.send: Optional[Callable[[dict], Awaitable[None]]] = None
+        self.send_bytes: Optional[Callable[[bytes], Awaitable[None]]] = None
+        self.current: Optional[ExecutionRequest] = None
+        self._pending: Deque[ExecutionRequest] = deque()
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        # cell_id -> hash of the source it last ran with, used to find changed cells.
+        self.executed_sources: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    def position(self, request: ExecutionRequest) -> int:
+        """0 while running, otherwise the number of requests ahead of it plus one."""
+        if request is self.current:
+            return 0
+        ahead = 1 if self.current is not None else 0
+        return ahead + self._pending.index(request) + 1
+
+    async def submit(self, request: ExecutionRequest) -> int:
+        request.submitted_at = time.perf_counter()
+        self._pending.append(request)
+        position = self.position(request)
+        for cell_id in request.cell_ids:
+            await self._send(OutputQueuedMessage(type='queued', cellId=cell_id, position=position).model_dump())
+        self.start()
+        self._wakeup.set()
+        return position
+
+    async def execute(self, code: str) -> str:
+        """Queue code behind the client's cells and return its aggregated output."""
+        future = asyncio.get_running_loop().create_future()
+        await self.submit(ExecutionRequest(None, code, future=future))
+        return await future
+
+    async def run_exclusive(self, task: Callable[[], Awaitable]):
+        """Run `task` once the cells ahead of it are done, with the kernel to itself."""
+        future = asyncio.get_running_loop().create_future()
+        await self.submit(KernelTaskRequest(task, future))
+        return await future
+
+    async def cancel_queued(self, cell_ids: List[str] = None) -> List[str]:
+        """
+        Drop queued (not running) client cells, all of them if no ids are given.
+        A run_cells batch is dropped as a whole if any of its cells matches.
+        """
+        cancelled = [
+            request for request in self._pending
+            if request.cell_ids and (cell_ids is None or set(request.cell_ids) & set(cell_ids))
+        ]
+        cancelled_ids = []
+        for request in cancelled:
+            self._pending.remove(request)
+            for cell_id in request.cell_ids:
+                await self._send(OutputCancelledMessage(type='cancelled', cellId=cell_id).model_dump())
+                cancelled_ids.append(cell_id)
+        if cancelled:
+            await self._send_positions()
+        return cancelled_ids
+
+    def changed_cells(self, cells: List[Tuple[str, str]]) -> List[str]:
+        """Ids of cells that never ran in this session or ran with different source."""
+        return [cell_id for cell_id, code in cells if self.executed_sources.get(cell_id) != source_hash(code)]
+
+    async def interrupt(self):
+        """Interrupt the running cell; queued cells still run afterwards."""
+        await self.nb.interrupt()
+
+    async def stop(self):
+        """Stop the worker; callers awaiting a running or queued request get CancelledError."""
+        if self._worker is not None:
+            self._worker.cancel()
+        requests = ([self.current] if self.current is not None else []) + list(self._pending)
+        for request in requests:
+            if request.future is not None and not request.future.done():
+                request.future.cancel()
+        self._pending.clear()
+
+    async def _send(self, message: dict):
+        if self.send is None:
+            return
+        try:
+            with output_send_seconds.time(kind=message.get('type')):
+                await self.send(message)
+        except Exception as e:
+            # The client went away; the cell keeps running and the result is dropped.
+            logger.warning(f"Could not deliver {message.get('type')} for notebook {self.nb.notebook_id}: {e}")
+
+    async def _send_display(self, cell_id: str, display: dict):
+        """Send a rich output, moving large binary payloads to binary frames first."""
+        data, frames = split_binary_outputs(cell_id, display['data']) if self.send_bytes else (display['data'], [])
+        for frame in frames:
+            try:
+                with output_send_seconds.time(kind='display_binary'):
+                    await self.send_bytes(frame)
+            except Exception as e:
+                logger.warning(f"Could not deliver binary output for cell {cell_id}: {e}")
+                return
+        await self._send(OutputDisplayMessage(type='display_data', cellId=cell_id, data=data, metadata=display['metadata']).model_dump())
+
+    async def _send_positions(self):
+        for request in self._pending:
+            for cell_id in request.cell_ids:
+                await self._send(OutputQueuedMessage(type='queued', cellId=cell_id, position=self.position(request)).model_dump())
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            request = self._pending.popleft()
+            self.current = request
+            queue_wait_seconds.observe(time.perf_counter() - request.submitted_at)
+            await self._send_positions()
+            try:
+                await self._execute(request)
+            except Exception as e:
+                logger.error(f"Error executing cell {request.cell_id}: {e}")
+                if request.future is not None and not request.future.done():
+                    request.future.set_exception(e)
+                else:
+                    for cell_id in request.cell_ids:
+                        await self._send(OutputExecutionMessage(type='output', cellId=cell_id, output=str(e)).model_dump())
+            finally:
+                self.current = None
+
+    async def _execute(self, request: ExecutionRequest):
+        if isinstance(request, RunCellsRequest):
+            await self._execute_cells(request)
+            return
+
+        if isinstance(request, KernelTaskRequest):
+            result = await request.task()
+            if not request.future.done():
+                request.future.set_result(result)
+            return
+
+        if request.future is not None:
+            with cell_execution_seconds.time(mode='internal'):
+                output = await self.nb.execute_code(code=request.code)
+            if not request.future.done():
+                request.future.set_result(output)
+            return
+
+        cache_key = None
+        if request.cache and not is_magic_command(request.code):
+            cache_key = await self._execute_cached(request)
+            if cache_key is None:
+                return
+
+        # Rich outputs are sent as they arrive in both modes.
+        cell_output = CellOutput()
+        displays = []
+        async for chunk in self.nb.execute_code_stream(code=request.code):
+            if isinstance(chunk, dict):
+                displays.append(chunk)
+                await self._send_display(request.cell_id, chunk)
+            else:
+                await self._write_output(request.cell_id, chunk, cell_output, request.stream)
+        duration = time.perf_counter() - cell_output.started_at
+        cell_execution_seconds.observe(duration, mode='cell')
+        await self._complete_output(request.cell_id, request.code, cell_output, request.stream, duration, ok=self.nb.last_error is None)
+
+        if cache_key and self.nb.last_error is None:
+            try:
+                await CellCache.get_cache().store(self.nb, cache_key, request.code, cell_output.buffer.getvalue(), displays)
+            except Exception as e:
+                logger.warning(f"Could not cache cell {request.cell_id}: {e}")
+
+    async def _execute_cached(self, request: ExecutionRequest) -> Optional[str]:
+        """
+        Replay the cell from the cache if possible. Returns None on a hit,
+        otherwise the key to store the result under once the cell has run
+        ('' if the cache cannot be used for this cell).
+        """
+        cell_output = CellOutput()
+        try:
+            cell_cache = CellCache.get_cache()
+            cache_key = await cell_cache.key_for(self.nb, request.code, user_id=request.user_id)
+            entry = cell_cache.lookup(cache_key)
+            if entry is None:
+                return cache_key
+            await cell_cache.restore(self.nb, cache_key)
+        except Exception as e:
+            logger.warning(f"Cell cache unavailable for cell {request.cell_id}, running it: {e}")
+            return ''
+
+        for display in entry['displays']:
+            await self._send_display(request.cell_id, display)
+        await self._write_output(request.cell_id, entry['output'], cell_output, request.stream)
+        duration = time.perf_counter() - cell_output.started_at
+        await self._complete_output(request.cell_id, request.code, cell_output, request.stream, duration, cached=True)
+        return None
+
+    async def _execute_cells(self, request: RunCellsRequest):
+        codes = dict(request.cells)
+        cell_outputs = {}
+        completed, skipped = [], []
+        errored = set()
+        failed = None
+        # Pipelined cells start when the previous one finishes.
+        cell_started_at = time.perf_counter()
+        async for cell_id, kind, text in self.nb.execute_cells_stream(request.cells, stop_on_error=request.stop_on_error):
+            if kind == 'display':
+                await self._send_display(cell_id, text)
+            elif kind in ('output', 'error'):
+                if kind == 'error':
+                    errored.add(cell_id)
+                    failed = failed or cell_id
+                cell_output = cell_outputs.setdefault(cell_id, CellOutput())
+                await self._write_output(cell_id, text, cell_output, request.stream)
+            elif kind == 'complete':
+                completed.append(cell_id)
+                cell_output = cell_outputs.pop(cell_id, None) or CellOutput()
+                duration = time.perf_counter() - cell_started_at
+                cell_started_at = time.perf_counter()
+                cell_execution_seconds.observe(duration, mode='run_cells')
+                await self._complete_output(cell_id, codes[cell_id], cell_output, request.stream, duration, ok=cell_id not in errored)
+            elif kind == 'skipped':
+                skipped.append(cell_id)
+                await self._send(OutputCancelledMessage(type='cancelled', cellId=cell_id).model_dump())
+
+        for cell_output in cell_outputs.values():
+            cell_output.buffer.close()
+        await self._send(OutputRunCellsCompleteMessage(type='run_cells_complete', completed=completed, skipped=skipped, failed=failed).model_dump())
+
+    async def _write_output(self, cell_id: str, text: str, cell_output: "CellOutput", stream: bool):
+        buffer = cell_output.buffer
+        was_spilled = buffer.spilled
+        buffer.write(text)
+        if not stream or was_spilled:
+            return
+        # Once the buffer spills, the rest only goes to disk; the chunk that
+        # crossed the cap is cut down to the head and the tail is sent on completion.
+        if buffer.spilled:
+            text = text[:max(0, buffer.head_chars - cell_output.sent_chars)]
+        if text:
+            await self._send(OutputChunkMessage(type='output_chunk', cellId=cell_id, seq=cell_output.seq, output=text).model_dump())
+            cell_output.seq += 1
+            cell_output.sent_chars += len(text)
+            cell_output.sent_bytes += len(text.encode('utf-8'))
+
+    async def _complete_output(self, cell_id: str, code: str, cell_output: "CellOutput", stream: bool, duration: float, cached: bool = False, ok: bool = True):
+        # A cell that raised still counts as changed, so run_stale re-runs it.
+        if ok:
+            self.executed_sources[cell_id] = source_hash(code)
+        else:
+            self.executed_sources.pop(cell_id, None)
+        buffer = cell_output.buffer
+        buffer.close()
+        if stream:
+            if buffer.spilled:
+                output = buffer.omitted_notice(cell_output.sent_bytes) + buffer.tail()
+                await self._send(OutputChunkMessage(type='output_chunk', cellId=cell_id, seq=cell_output.seq, output=output).model_dump())
+                cell_output.seq += 1
+            await self._send(OutputExecutionCompleteMessage(
+                type='execution_complete', cellId=cell_id, chunks=cell_output.seq,
+                output_handle=buffer.handle, output_size=buffer.size,
+                duration_ms=round(duration * 1000, 1), cached=cached
+            ).model_dump())
+        else:
+            output = buffer.getvalue()
+            if not is_magic_command(code):
+                output += EXECUTION_FINISHED_MARKER
+            await self._send(OutputExecutionMessage(
+                type='output', cellId=cell_id, output=output,
+                output_handle=buffer.handle, output_size=buffer.size,
+                duration_ms=round(duration * 1000, 1), cached=cached
+            ).model_dump())
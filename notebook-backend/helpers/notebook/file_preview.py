@@ -0,0 +1,172 @@
+import os
+import mmap
+import codecs
+import asyncio
+from contextlib import contextmanager
+from typing import AsyncIterator, Optional, Tuple
+
+# Most `!cat` will ever send for one file, whatever range was asked for.
+MAGIC_CAT_MAX_BYTES = int(os.environ.get('MAGIC_CAT_MAX_BYTES', 1024 * 1024))
+MAGIC_CAT_CHUNK_BYTES = 64 * 1024
+# Window used when counting lines, so the file is never copied whole.
+_COUNT_WINDOW_BYTES = 16 * 1024 * 1024
+
+CAT_USAGE = (
+    "Usage: !cat [--head N | --tail N | --bytes START:END | --summary] FILE...\n"
+    f"Output is capped at {MAGIC_CAT_MAX_BYTES} bytes per file."
+)
+
+
+@contextmanager
+def mapped(path: str):
+    """Read-only mmap of path, or None for an empty file (which can't be mapped)."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield None
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def head_range(mm: mmap.mmap, lines: int, limit: int) -> Tuple[int, int]:
+    end = 0
+    for _ in range(lines):
+        index = mm.find(b'\n', end)
+        if index == -1:
+            return 0, len(mm)
+        end = index + 1
+        # Past the cap nothing more will be sent anyway.
+        if end > limit:
+            break
+    return 0, end
+
+
+def tail_range(mm: mmap.mmap, lines: int, limit: int) -> Tuple[int, int]:
+    size = len(mm)
+    # A trailing newline ends the last line, it doesn't start a new one.
+    position = size - 1 if mm[size - 1:size] == b'\n' else size
+    start = position
+    for _ in range(lines):
+        index = mm.rfind(b'\n', 0, position)
+        if index == -1:
+            return 0, size
+        start = position = index
+        if size - start > limit:
+            break
+    return (start + 1 if lines else size), size
+
+
+def byte_range(spec: str, size: int) -> Tuple[int, int]:
+    """START:END with Python slice semantics, so -1000: is the last 1000 bytes."""
+    if ':' not in spec:
+        raise ValueError(f"Invalid byte range '{spec}', expected START:END")
+    start, end = spec.split(':', 1)
+    start, end, _ = slice(int(start) if start else None, int(end) if end else None).indices(size)
+    return start, max(start, end)
+
+
+def count_lines(mm: Optional[mmap.mmap]) -> int:
+    if mm is None:
+        return 0
+    size = len(mm)
+    lines = sum(mm[offset:offset + _COUNT_WINDOW_BYTES].count(b'\n') for offset in range(0, size, _COUNT_WINDOW_BYTES))
+    return lines + (mm[size - 1:size] != b'\n')
+
+
+def human_size(size: int) -> str:
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def summarize(path: str) -> str:
+    with mapped(path) as mm:
+        size = len(mm) if mm is not None else 0
+        lines = count_lines(mm)
+    return f"{path}: {human_size(size)} ({size:,} bytes), {lines:,} lines\n"
+
+
+async def preview(path: str, head: int = None, tail: int = None, byte_spec: str = None,
+                  summary: bool = False, limit: int = None) -> AsyncIterator[str]:
+    """
+    Stream part of a file as text in MAGIC_CAT_CHUNK_BYTES chunks, reading
+    through mmap so only the pages sent are touched. At most `limit` bytes are
+    sent; a notice says how much was left out.
+    """
+    limit = limit if limit is not None else MAGIC_CAT_MAX_BYTES
+    if os.path.isdir(path):
+        yield f"cat: {path}: Is a directory\n"
+        return
+    if not os.path.exists(path):
+        yield f"cat: {path}: No such file or directory\n"
+        return
+    if summary:
+        yield await asyncio.to_thread(summarize, path)
+        return
+
+    with mapped(path) as mm:
+        if mm is None:
+            return
+        size = len(mm)
+        if head is not None:
+            start, end = await asyncio.to_thread(head_range, mm, head, limit)
+        elif tail is not None:
+            start, end = await asyncio.to_thread(tail_range, mm, tail, limit)
+        elif byte_spec is not None:
+            start, end = byte_range(byte_spec, size)
+        else:
+            start, end = 0, size
+
+        if tail is not None and end - start > limit:
+            # Keep the end of the file, starting at a line boundary.
+            boundary = mm.find(b'\n', end - limit, end)
+            start = boundary + 1 if boundary != -1 else end - limit
+            yield f"... output capped at {human_size(limit)}, showing the last lines only.\n"
+        stop = min(end, start + limit)
+
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for offset in range(start, stop, MAGIC_CAT_CHUNK_BYTES):
+            data = await asyncio.to_thread(mm.__getitem__, slice(offset, min(offset + MAGIC_CAT_CHUNK_BYTES, stop)))
+            text = decoder.decode(data)
+            if text:
+                yield text
+        tail_text = decoder.decode(b'', final=True)
+        if tail_text:
+            yield tail_text
+        if end > stop:
+            # head_range stops scanning at the cap, so its end is only a lower bound.
+            left_out = "more lines" if head is not None else f"{end - stop:,} more bytes"
+            yield (
+                f"\n... output capped at {human_size(limit)}; {left_out} not shown. "
+                f"Use --head, --tail, --bytes or --summary to inspect {path}.\n"
+            )
+
+
+def parse_cat_args(args: list) -> Tuple[dict, list]:
+    """Split `!cat` arguments into preview() options and paths. Raises ValueError."""
+    options, paths = {}, []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ('--head', '--tail', '--bytes'):
+            if not args:
+                raise ValueError(f"{arg} needs a value")
+            value = args.pop(0)
+            if arg == '--bytes':
+                options['byte_spec'] = value
+            else:
+                options[arg[2:]] = int(value)
+                if options[arg[2:]] < 0:
+                    raise ValueError(f"{arg} needs a non-negative number of lines")
+        elif arg == '--summary':
+            options['summary'] = True
+        elif arg.startswith('-'):
+            raise ValueError(f"Unknown option {arg}")
+        else:
+            paths.append(arg)
+    if len(options) > 1:
+        raise ValueError("Use only one of --head, --tail, --bytes and --summary")
+    if not paths:
+        raise ValueError("No file specified")
+    return options, paths
@@ -0,0 +1,118 @@
+import os
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+import httpx
+from helpers.notebook.attached_kernel import AttachedKernelManager
+
+logger = logging.getLogger(__name__)
+
+KERNEL_HOST_TIMEOUT = float(os.environ.get('KERNEL_HOST_TIMEOUT', 30))
+
+
+class KernelHostClient:
+    """HTTP client for one kernel host agent (see kernel_host.py)."""
+
+    def __init__(self, url: str, token: str = None):
+        self.url = url.rstrip('/')
+        self.token = token if token is not None else os.environ.get('KERNEL_HOST_TOKEN', '')
+
+    async def _request(self, method: str, path: str, timeout: float = None, **kwargs) -> dict:
+        headers = {'X-Kernel-Host-Token': self.token} if self.token else {}
+        async with httpx.AsyncClient(timeout=timeout or KERNEL_HOST_TIMEOUT) as client:
+            response = await client.request(method, f"{self.url}{path}", headers=headers, **kwargs)
+            response.raise_for_status()
+            return response.json()
+
+    async def load(self) -> dict:
+        return await self._request('GET', '/load', timeout=2)
+
+    async def start_kernel(self, kernel_name: str, notebook_id: str) -> dict:
+        return await self._request('POST', '/kernels', json={'kernel_name': kernel_name, 'notebook_id': notebook_id})
+
+    async def interrupt_kernel(self, kernel_id: str) -> dict:
+        return await self._request('POST', f'/kernels/{kernel_id}/interrupt')
+
+    async def shutdown_kernel(self, kernel_id: str) -> dict:
+        return await self._request('DELETE', f'/kernels/{kernel_id}')
+
+
+class RemoteKernelManager(AttachedKernelManager):
+    """A kernel running on a kernel host; lifecycle calls go through its agent."""
+
+    def __init__(self, kernel_client, host: KernelHostClient, kernel_id: str):
+        super().__init__(kernel_client, pid=None, local=False)
+        self.host = host
+        self.kernel_id = kernel_id
+
+    async def interrupt_kernel(self):
+        await self.host.interrupt_kernel(self.kernel_id)
+
+    async def shutdown_kernel(self, now: bool = False, restart: bool = False):
+        await self.host.shutdown_kernel(self.kernel_id)
+        self._alive = False
+
+
+class KernelPlacement:
+    """
+    Picks the least-loaded kernel host for new kernels. Load is the share of
+    the host's kernel slots in use plus the share of its memory in use, so
+    hosts on the same machine are told apart by kernel count.
+    Hosts that don't answer or are full are skipped.
+    """
+
+    def __init__(self, hosts: List[str] = None, token: str = None):
+        if hosts is None:
+            hosts = [url.strip() for url in os.environ.get('KERNEL_HOSTS', '').split(',') if url.strip()]
+        self.hosts = [KernelHostClient(url, token) for url in hosts]
+        # Kernels being started right now, not yet visible in the hosts' load.
+        self._starting: Dict[str, int] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.hosts)
+
+    async def _load(self, host: KernelHostClient) -> Optional[dict]:
+        try:
+            return await host.load()
+        except Exception as e:
+            logger.warning(f"Kernel host {host.url} unavailable: {e}")
+            return None
+
+    def score(self, host: KernelHostClient, load: dict) -> Optional[float]:
+        kernels = load['kernels'] + self._starting.get(host.url, 0)
+        if kernels >= load['max_kernels']:
+            return None
+        memory_used = 1 - load['mem_available'] / load['mem_total'] if load.get('mem_total') else 0
+        return kernels / load['max_kernels'] + memory_used
+
+    async def loads(self) -> List[Tuple[KernelHostClient, Optional[dict]]]:
+        loads = await asyncio.gather(*(self._load(host) for host in self.hosts))
+        return list(zip(self.hosts, loads))
+
+    async def choose(self) -> List[KernelHostClient]:
+        """Available hosts, least loaded first."""
+        scored = []
+        for host, load in await self.loads():
+            score = self.score(host, load) if load else None
+            if score is not None:
+                scored.append((score, host))
+        return [host for _, host in sorted(scored, key=lambda item: item[0])]
+
+    async def start_kernel(self, kernel_name: str, notebook_id: str) -> Tuple[KernelHostClient, dict]:
+        for host in await self.choose():
+            self._starting[host.url] = self._starting.get(host.url, 0) + 1
+            try:
+                kernel = await host.start_kernel(kernel_name, notebook_id)
+                logger.info(f"Placed kernel for notebook {notebook_id} on {host.url}")
+                return host, kernel
+            except Exception as e:
+                logger.warning(f"Could not start kernel on {host.url}: {e}")
+            finally:
+                self._starting[host.url] -= 1
+        raise RuntimeError("No kernel host available")
+
+    async def stats(self) -> List[dict]:
+        return [
+            {'url': host.url, 'available': load is not None, 'score': self.score(host, load) if load else None, **(load or {})}
+            for host, load in await self.loads()
+        ]
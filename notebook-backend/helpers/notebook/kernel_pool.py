@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import uuid
+import shutil
+import asyncio
+import logging
+import tempfile
+from typing import List, Optional, Tuple
+from jupyter_client import AsyncKernelManager
+from jupyter_client.asynchronous import AsyncKernelClient
+from jupyter_client.kernelspec import KernelSpecManager
+from helpers.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Each pooled kernel runs in its own venv here, so `!pip install` in a pooled
+# notebook never touches the backend's environment or another notebook's.
+# A venv the notebook installed packages into is kept as the notebook's env
+# (see promote_pool_env) instead of being deleted with its kernel.
+KERNEL_POOL_ENV_DIR = os.environ.get('KERNEL_POOL_ENV_DIR') or os.path.join(tempfile.gettempdir(), 'notebook_kernel_pool')
+# Written into a promoted venv, holding the notebook id it belongs to.
+NOTEBOOK_ENV_MARKER = '.notebook_id'
+
+pool_acquires = registry.counter('notebook_kernel_pool_acquires_total', 'Sessions that asked the kernel pool for a kernel', ('result',))
+
+
+def kernel_env_path(kernel_manager: AsyncKernelManager) -> Optional[str]:
+    """Environment prefix of the interpreter a kernel was started with."""
+    argv = kernel_manager.kernel_spec.argv
+    return os.path.dirname(os.path.dirname(argv[0])) if os.path.isabs(argv[0]) else None
+
+
+def is_pool_env(env_path: Optional[str]) -> bool:
+    return bool(env_path) and os.path.dirname(os.path.abspath(env_path)) == os.path.abspath(KERNEL_POOL_ENV_DIR)
+
+
+def is_promoted_env(env_path: Optional[str]) -> bool:
+    return is_pool_env(env_path) and os.path.exists(os.path.join(env_path, NOTEBOOK_ENV_MARKER))
+
+
+def remove_pool_env(env_path: Optional[str]):
+    """Delete a pooled kernel's venv once its kernel is gone, unless a notebook kept it."""
+    if is_pool_env(env_path) and not is_promoted_env(env_path):
+        shutil.rmtree(env_path, ignore_errors=True)
+
+
+def _notebook_env_link(notebook_id: str) -> str:
+    if not notebook_id or notebook_id in ('.', '..') or os.path.basename(notebook_id) != notebook_id:
+        raise ValueError(f"Invalid notebook id '{notebook_id}'")
+    return os.path.join(KERNEL_POOL_ENV_DIR, 'notebooks', notebook_id)
+
+
+def notebook_env_path(notebook_id: str) -> Optional[str]:
+    """The venv promoted for the notebook, if it has one."""
+    link = _notebook_env_link(notebook_id)
+    if not os.path.islink(link):
+        return None
+    env_path = os.path.realpath(link)
+    return env_path if is_promoted_env(env_path) else None
+
+
+def promote_pool_env(env_path: Optional[str], notebook_id: str) -> bool:
+    """
+    Keep a pooled kernel's venv as the notebook's env, so packages installed
+    into it survive the kernel. Later sessions of the notebook start their
+    kernel in it. Returns False if env_path isn't a pool venv.
+    """
+    if not is_pool_env(env_path):
+        return False
+    if is_promoted_env(env_path):
+        return True
+    with open(os.path.join(env_path, NOTEBOOK_ENV_MARKER), 'w') as f:
+        f.write(notebook_id)
+    link = _notebook_env_link(notebook_id)
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    previous = notebook_env_path(notebook_id)
+    tmp_link = f"{link}.{uuid.uuid4().hex}"
+    os.symlink(env_path, tmp_link)
+    os.replace(tmp_link, link)
+    if previous and previous != os.path.realpath(env_path):
+        shutil.rmtree(previous, ignore_errors=True)
+    logger.info(f"Kept kernel env {env_path} as the env of notebook {notebook_id}")
+    return True
+
+
+async def create_kernel_env(kernel_name: str, env_dir: str = None) -> str:
+    """
+    A venv on top of the backend's site-packages, so ipykernel and the
+    preinstalled stack are there without copying them, with a kernelspec
+    that starts the kernel from the venv's python.
+    """
+    env_path = os.path.join(env_dir or KERNEL_POOL_ENV_DIR, f"pool_{uuid.uuid4().hex}")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'venv', '--system-site-packages', env_path,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        shutil.rmtree(env_path, ignore_errors=True)
+        raise RuntimeError(f"venv failed: {stderr.decode(errors='replace').strip()}")
+
+    spec = await asyncio.to_thread(KernelSpecManager().get_kernel_spec, kernel_name)
+    spec_dir = os.path.join(env_path, 'share', 'jupyter', 'kernels', kernel_name)
+    os.makedirs(spec_dir, exist_ok=True)
+    with open(os.path.join(spec_dir, 'kernel.json'), 'w') as f:
+        json.dump({
+            'argv': [os.path.join(env_path, 'bin', 'python'), *spec.argv[1:]],
+            'display_name': spec.display_name,
+            'language': spec.language,
+        }, f)
+    return env_path
+
+
+def env_kernel_manager(env_path: str, **kwargs) -> AsyncKernelManager:
+    """A kernel manager for the kernelspec inside a venv made by create_kernel_env."""
+    kernel_dir = os.path.join(env_path, 'share', 'jupyter', 'kernels')
+    return AsyncKernelManager(
+        kernel_name=os.listdir(kernel_dir)[0],
+        kernel_spec_manager=KernelSpecManager(kernel_dirs=[kernel_dir]),
+        **kwargs,
+    )
+
+
+class KernelPool:
+    """
+    Keeps a number of started, idle kernels ready so that a new notebook
+    session does not wait for conda and kernel startup.
+    Kernels handed out are never returned to the pool; a background task
+    starts replacements.
+    """
+
+    def __init__(self, kernel_name: str = None, size: int = None, env_dir: str = None):
+        self.kernel_name = kernel_name or os.environ.get('KERNEL_POOL_KERNEL_NAME', 'python3')
+        self.env_dir = env_dir or KERNEL_POOL_ENV_DIR
+        self.size = size if size is not None else int(os.environ.get('KERNEL_POOL_SIZE', 2))
+        self.hits = 0
+        self.misses = 0
+        self._idle: List[Tuple[AsyncKernelManager, AsyncKernelClient]] = []
+        self._refill_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def _start_kernel(self) -> Tuple[AsyncKernelManager, AsyncKernelClient]:
+        env_path = await create_kernel_env(self.kernel_name, self.env_dir)
+        try:
+            kernel_manager = env_kernel_manager(env_path)
+            await kernel_manager.start_kernel()
+            kernel_client = kernel_manager.client()
+            kernel_client.start_channels()
+            await kernel_client.wait_for_ready()
+        except Exception:
+            await asyncio.to_thread(remove_pool_env, env_path)
+            raise
+        return kernel_manager, kernel_client
+
+    async def _refill(self):
+        while not self._closed and len(self._idle) < self.size:
+            try:
+                self._idle.append(await self._start_kernel())
+            except Exception as e:
+                logger.error(f"Failed to start pooled kernel '{self.kernel_name}': {e}")
+                break
+
+    def refill(self):
+        """Schedule a background refill unless one is already running."""
+        if self._closed or self.size <= 0:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    def start(self):
+        self.refill()
+
+    def acquire(self) -> Optional[Tuple[AsyncKernelManager, AsyncKernelClient]]:
+        """Take an idle kernel from the pool, or None if the pool is empty."""
+        while self._idle:
+            kernel_manager, kernel_client = self._idle.pop(0)
+            if kernel_manager.has_kernel:
+                self.hits += 1
+                pool_acquires.inc(result='hit')
+                self.refill()
+                return kernel_manager, kernel_client
+            remove_pool_env(kernel_env_path(kernel_manager))
+        self.misses += 1
+        pool_acquires.inc(result='miss')
+        self.refill()
+        return None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'kernel_name': self.kernel_name,
+            'size': self.size,
+            'idle': len(self._idle),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    async def shutdown(self):
+        self._closed = True
+        if self._refill_task and not self._refill_task.done():
+            self._refill_task.cancel()
+        while self._idle:
+            kernel_manager, kernel_client = self._idle.pop()
+            kernel_client.stop_channels()
+            await kernel_manager.shutdown_kernel(now=True)
+            await asyncio.to_thread(remove_pool_env, kernel_env_path(kernel_manager))
@@ -1,121 +1,194 @@
 import os
-import json
-import sh
-from io import StringIO
+import codecs
+import asyncio
+import logging
 from pathlib import Path
-from typing import Tuple
+from typing import AsyncIterator, List, Optional, Set
+from helpers.notebook import file_preview, package_installer
+
+logger = logging.getLogger(__name__)
+
+MAGIC_COMMAND_TIMEOUT = float(os.environ.get('MAGIC_COMMAND_TIMEOUT', 1800))
+MAGIC_COMMAND_READ_SIZE = 4096
+
 
 class MagicCommandHandler:
-    """Handles magic commands using the sh library."""
-    
-    def __init__(self, env_path: str = None):
+    """
+    Handles magic commands by running them as asyncio subprocesses.
+    Output is streamed as it is produced, so a long `!pip install` shows its
+    progress and doesn't block the event loop.
+    """
+
+    def __init__(self, env_path: str = None, timeout: float = None):
+        self.requested_env_path = env_path
         self.env_path = env_path or str(Path.home())
         # Get pip path from env_path if provided, otherwise use default pip location
         self.pip_path = os.path.join(self.env_path, "bin", "pip") if env_path else "pip"
-        
+        self.python_path = package_installer.default_python_path(env_path)
+        self.timeout = timeout if timeout is not None else MAGIC_COMMAND_TIMEOUT
+        self._processes: Set[asyncio.subprocess.Process] = set()
+
         self._commands = {
             'ls': self._ls,
             'cat': self._cat,
             'top': self._top,
             'pip': self._pip
         }
-    
-    def execute(self, code: str) -> Tuple[str, str]:
-        """Execute a magic command and return (output, error)."""
+
+    @staticmethod
+    def parse(code: str):
         if not code.strip().startswith('!'):
             raise ValueError("Not a magic command")
-        
-        # Parse the command
         parts = code.strip()[1:].split(maxsplit=1)
-        command = parts[0]
+        command = parts[0] if parts else ''
         args = parts[1].split() if len(parts) > 1 else []
-        
+        return command, args
+
+    async def execute(self, code: str) -> str:
+        """Execute a magic command and return its whole output."""
+        output = ""
+        async for chunk in self.execute_stream(code):
+            output += chunk
+        return output
+
+    async def execute_stream(self, code: str) -> AsyncIterator[str]:
+        """Execute a magic command and yield its output as it arrives."""
+        command, args = self.parse(code)
+
         if command not in self._commands:
-            return f"Command '{command}' not supported. Only ls, cat, top, and pip are available."
-        
+            yield f"Command '{command}' not supported. Only ls, cat, top, and pip are available."
+            return
+
         try:
-            output = self._commands[command](args)
-            return output
+            async for chunk in self._commands[command](args):
+                yield chunk
         except Exception as e:
-            return str(e)
-    
-    def _ls(self, args: list) -> str:
-        """Execute ls command using sh."""
-        output_buffer = StringIO()
-        error_buffer = StringIO()
-        
-        try:
-            # If no path specified, use current directory
-            base_path = os.path.join('public', 'uploads')
-            
-            path = os.path.join(base_path, args[0]) if args else base_path
-            
-            # Handle ls flags
-            flags = [arg for arg in args if arg.startswith('-')]
-            
-            sh.ls(path, *flags, _out=output_buffer, _err=error_buffer)
-            
-            disclaimer = """
-                base path: `public/uploads`. Please use the full path to the file, e.g. `public/uploads/filename.csv` to perform pythonic file operations. \n\n
-            """
-            return disclaimer.lstrip() + output_buffer.getvalue().lstrip()
-            
-        except sh.ErrorReturnCode as e:
-            raise Exception(f"ls command failed: {error_buffer.getvalue()}")
-    
-    def _cat(self, args: list) -> str:
-        """Execute cat command using sh."""
-        if not args:
-            return "Error: No file specified"
-            
-        output_buffer = StringIO()
-        error_buffer = StringIO()
-        
-        try:
-            sh.cat(*args, _out=output_buffer, _err=error_buffer)
-            return output_buffer.getvalue()
-            
-        except sh.ErrorReturnCode as e:
-            raise Exception(f"cat command failed: {error_buffer.getvalue()}")
-    
-    def _top(self, args: list) -> str:
-        """Execute top command using sh."""
-        output_buffer = StringIO()
-        error_buffer = StringIO()
-        
+            yield str(e)
+
+    def cancel(self) -> bool:
+        """Kill the running commands. Returns False if nothing was running."""
+        running = [process for process in self._processes if process.returncode is None]
+        for process in running:
+            process.kill()
+        return bool(running)
+
+    async def _run(self, name: str, argv: List[str], env: Optional[dict] = None, merge_stderr: bool = True) -> AsyncIterator[str]:
+        """
+        Run argv and yield stdout and stderr interleaved. Without merge_stderr
+        only stdout is yielded, for output that is parsed (pip freeze), and
+        stderr is logged, or yielded after the output if the command fails.
+        The process is killed when it exceeds the timeout or the caller stops
+        iterating.
+        """
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL,
+            env={**os.environ, **(env or {})},
+        )
+        self._processes.add(process)
+        # Drained concurrently so a chatty stderr can't fill its pipe and stall the process.
+        stderr_task = None if merge_stderr else asyncio.create_task(process.stderr.read())
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout if self.timeout else None
         try:
-            # Run top in batch mode (-b) and limit to one iteration (-n 1)
-            sh.top('-b', '-n', '1', *args, _out=output_buffer, _err=error_buffer)
-            return output_buffer.getvalue()
-            
-        except sh.ErrorReturnCode as e:
-            raise Exception(f"top command failed: {error_buffer.getvalue()}")
-            
-    def _pip(self, args: list) -> str:
-        """Execute pip command using sh."""
-        output_buffer = StringIO()
-        error_buffer = StringIO()
-        
+            while True:
+                remaining = deadline - loop.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    process.kill()
+                    yield f"\n{name} command timed out after {self.timeout:g}s"
+                    return
+                try:
+                    data = await asyncio.wait_for(process.stdout.read(MAGIC_COMMAND_READ_SIZE), timeout=remaining)
+                except asyncio.TimeoutError:
+                    continue
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+            returncode = await process.wait()
+            if stderr_task is not None:
+                stderr = (await stderr_task).decode('utf-8', errors='replace')
+                if returncode != 0 and stderr:
+                    yield f"\n{stderr}"
+                elif stderr.strip():
+                    logger.info(f"{name} command stderr: {stderr.strip()}")
+            if returncode < 0:
+                yield f"\n{name} command was cancelled"
+            elif returncode != 0:
+                yield f"\n{name} command failed with exit code {returncode}"
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if stderr_task is not None and not stderr_task.done():
+                stderr_task.cancel()
+            self._processes.discard(process)
+
+    async def _ls(self, args: list) -> AsyncIterator[str]:
+        """Execute ls command."""
+        # If no path specified, use current directory
+        base_path = os.path.join('public', 'uploads')
+
+        # Handle ls flags
+        flags = [arg for arg in args if arg.startswith('-')]
+        paths = [arg for arg in args if not arg.startswith('-')]
+        path = os.path.join(base_path, paths[0]) if paths else base_path
+
+        disclaimer = """
+            base path: `public/uploads`. Please use the full path to the file, e.g. `public/uploads/filename.csv` to perform pythonic file operations. \n\n
+        """
+        yield disclaimer.lstrip()
+        async for chunk in self._run('ls', ['ls', path, *flags]):
+            yield chunk
+
+    async def _cat(self, args: list) -> AsyncIterator[str]:
+        """
+        Show a file, or part of it, without loading it into memory.
+        See file_preview.CAT_USAGE for the options.
+        """
         try:
-            # Get the pip command from the environment
-            pip_cmd = sh.Command(self.pip_path)
-            
-            # Execute pip with provided arguments
-            pip_cmd(
-                *args,
-                _out=output_buffer,
-                _err=error_buffer
-            )
-            
-            # Some pip commands write to stderr even on success
-            output = output_buffer.getvalue()
-            error = error_buffer.getvalue()
-            
-            return output if output else error
-            
-        except sh.ErrorReturnCode as e:
-            # Pip often provides useful error messages in stderr
-            error_msg = error_buffer.getvalue()
-            if error_msg:
-                raise Exception(f"pip command failed: {error_msg}")
-            raise Exception(f"pip command failed with exit code {e.exit_code}")
+            options, paths = file_preview.parse_cat_args(args)
+        except ValueError as e:
+            yield f"Error: {e}\n{file_preview.CAT_USAGE}"
+            return
+        for path in paths:
+            if len(paths) > 1 and not options.get('summary'):
+                yield f"==> {path} <==\n"
+            async for chunk in file_preview.preview(path, **options):
+                yield chunk
+
+    async def _top(self, args: list) -> AsyncIterator[str]:
+        """Execute top command."""
+        # Run top in batch mode (-b) and limit to one iteration (-n 1)
+        async for chunk in self._run('top', ['top', '-b', '-n', '1', *args]):
+            yield chunk
+
+    async def _pip(self, args: list) -> AsyncIterator[str]:
+        """
+        Execute pip command from the notebook's environment, using the shared
+        package cache. Installs skip requirements that are already satisfied
+        and go through uv when it is the configured installer.
+        """
+        # Unbuffered so download and install progress shows up as it happens.
+        env = {'PYTHONUNBUFFERED': '1', **package_installer.cache_env()}
+        # Package listings get parsed (e.g. into a lambda's requirements.txt),
+        # so pip's warnings stay out of them.
+        merge_stderr = not args or args[0] not in ('freeze', 'list')
+        if not args or args[0] != 'install':
+            argv = [self.pip_path, *args]
+        else:
+            install_args, skipped = await package_installer.plan_install(self.python_path, args[1:])
+            for spec in skipped:
+                yield f"Requirement already satisfied: {spec}\n"
+            if not install_args:
+                return
+            argv = package_installer.install_argv(self.python_path, self.pip_path, install_args)
+        async for chunk in self._run('pip', argv, env=env, merge_stderr=merge_stderr):
+            yield chunk
@@ -0,0 +1,40 @@
+import os
+import json
+import uuid
+import base64
+import struct
+from typing import List, Tuple
+
+# Jupyter ships these base64-encoded inside the JSON message. Clients that
+# connect with ?binary_frames=1 get them as raw bytes in binary frames; others
+# keep getting base64 inside the JSON display message.
+BINARY_MIME_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'application/pdf')
+BINARY_FRAME_MIN_BYTES = int(os.environ.get('BINARY_FRAME_MIN_BYTES', 1024))
+
+
+def encode_binary_frame(header: dict, payload: bytes) -> bytes:
+    """
+    Binary WebSocket frame layout:
+        4-byte big-endian header length | UTF-8 JSON header | raw payload
+    """
+    header_bytes = json.dumps(header).encode('utf-8')
+    return struct.pack('>I', len(header_bytes)) + header_bytes + payload
+
+
+def split_binary_outputs(cell_id: str, data: dict) -> Tuple[dict, List[bytes]]:
+    """
+    Replace large binary payloads in a MIME bundle with a reference to a
+    binary frame. Returns the JSON-safe bundle and the frames to send.
+    """
+    bundle = dict(data)
+    frames = []
+    for mime in BINARY_MIME_TYPES:
+        encoded = bundle.get(mime)
+        if not isinstance(encoded, str) or len(encoded) < BINARY_FRAME_MIN_BYTES:
+            continue
+        binary_id = str(uuid.uuid4())
+        payload = base64.b64decode(encoded)
+        header = {'type': 'display_binary', 'cellId': cell_id, 'binary_id': binary_id, 'mime': mime}
+        frames.append(encode_binary_frame(header, payload))
+        bundle[mime] = {'binary_id': binary_id, 'size': len(payload)}
+    return bundle, frames
@@ -1,15 +1,40 @@
 import os
+import re
 import json
 import sh
 import sys
+import asyncio
+import queue
+import logging
 from io import StringIO
 from jupyter_client.kernelspec import KernelSpecManager
-from jupyter_client import KernelManager
+from jupyter_client import AsyncKernelManager
+from jupyter_client.asynchronous import AsyncKernelClient
 from helpers.aws.s3 import s3
 from pathlib import Path
-from typing import Tuple
+from typing import AsyncIterator, List, Optional, Tuple, Union
 from helpers.notebook.magic_command import MagicCommandHandler
+from helpers.notebook.kernel_pool import KernelPool, env_kernel_manager, is_pool_env, kernel_env_path, notebook_env_path, promote_pool_env, remove_pool_env
+from helpers.notebook.env_registry import CondaEnvRegistry
+from helpers.notebook.base_env import clone_base_env
+from helpers.notebook.attached_kernel import AttachedKernelManager
+from helpers.notebook.kernel_placement import KernelHostClient, KernelPlacement, RemoteKernelManager
+from helpers.notebook.notebook_document import NotebookDocumentStore
 from helpers.supabase.client import get_supabase_client
+from helpers.metrics import supabase_request_seconds
+
+logger = logging.getLogger(__name__)
+
+EXECUTION_FINISHED_MARKER = '# Execution finished\n'
+# `!pip install` or `%pip install` lines, which change the kernel's env.
+PIP_INSTALL_LINE = re.compile(r'^\s*[!%]pip\s+install\b', re.MULTILINE)
+# Seconds without kernel output between checks that the kernel is still alive.
+KERNEL_LIVENESS_INTERVAL = max(1, int(os.environ.get('KERNEL_LIVENESS_INTERVAL') or 5))
+
+
+def is_magic_command(code: str) -> bool:
+    return code.strip().startswith('!')
+
 
 class NotebookUtils():
     def __init__(self, notebook_id: str):
@@ -18,20 +43,31 @@ class NotebookUtils():
         self.magic_command_handler = None
         self.kernel_client = None
         self.kernel_manager = None
+        # Set when the kernel comes from the pool and runs in that kernel's own
+        # throwaway venv rather than the notebook's env.
+        self.kernel_env_path = None
+        # Error content of the last kernel execution, None if it succeeded.
+        self.last_error = None
     
     @property
     def relevant_env_path(self):
-        curr_envs = {os.path.basename(env): env for env in json.loads(sh.conda("env", "list", "--json"))['envs']}
-        relevant_env_path = curr_envs.get(self.env_name, None)
-        return relevant_env_path
+        return CondaEnvRegistry.get_registry().get(self.env_name)
         
     def initialize_relevant_env_path(self):
         # TODO: Block cell execution if env is not initialized.
+        registry = CondaEnvRegistry.get_registry()
         if not self.relevant_env_path:
-            sh.conda(
-                "create", "-n", self.env_name, "python=3.9", "ipykernel",
-                _out=sys.stdout, _err=sys.stderr, force=True
-            )
+            # The env may have been created by another process; check conda
+            # itself before a forced create would wipe it.
+            registry.refresh()
+
+        if not self.relevant_env_path:
+            if not clone_base_env(self.env_name):
+                sh.conda(
+                    "create", "-n", self.env_name, "python=3.9", "ipykernel",
+                    _out=sys.stdout, _err=sys.stderr, force=True
+                )
+            registry.refresh()
             
             relevant_env_path_python = os.path.join(self.relevant_env_path, "bin", "python3")
                 
@@ -46,66 +82,339 @@ class NotebookUtils():
         
         return self.relevant_env_path
     
-    def initialize_kernel(self):
-        self.initialize_relevant_env_path()
+    def remove_env(self):
+        sh.conda("env", "remove", "-n", self.env_name, "-y", _out=sys.stdout, _err=sys.stderr)
+        CondaEnvRegistry.get_registry().remove(self.env_name)
+
+    async def initialize_kernel(self, kernel_pool: KernelPool = None, placement: KernelPlacement = None):
+        # With kernel hosts configured, kernels run on the least-loaded host.
+        if placement:
+            try:
+                return await self.start_remote_kernel(placement)
+            except Exception as e:
+                logger.warning(f"Falling back to a local kernel for notebook {self.notebook_id}: {e}")
+
+        has_conda_env = await asyncio.to_thread(lambda: self.relevant_env_path)
+        # A pooled kernel's venv the notebook installed packages into is its env now.
+        promoted_env_path = None if has_conda_env else await asyncio.to_thread(notebook_env_path, self.notebook_id)
+        if promoted_env_path:
+            self.kernel_manager = env_kernel_manager(promoted_env_path)
+            await self.kernel_manager.start_kernel()
+            self.kernel_client = self.kernel_manager.client()
+            self.kernel_client.start_channels()
+            await self.kernel_client.wait_for_ready()
+            self.kernel_env_path = promoted_env_path
+            return self.kernel_manager, self.kernel_client
+
+        # Notebooks without their own env yet start on a pre-warmed kernel.
+        if kernel_pool is not None and not has_conda_env:
+            pooled = kernel_pool.acquire()
+            if pooled:
+                self.kernel_manager, self.kernel_client = pooled
+                self.kernel_env_path = kernel_env_path(self.kernel_manager)
+                return self.kernel_manager, self.kernel_client
+
+        # conda and the kernelspec lookup are blocking, keep them off the event loop.
+        await asyncio.to_thread(self.initialize_relevant_env_path)
 
         ksm = KernelSpecManager()
-        
-        if self.env_name not in ksm.find_kernel_specs():
+        kernel_specs = await asyncio.to_thread(ksm.find_kernel_specs)
+
+        if self.env_name not in kernel_specs:
             raise ValueError(f"Kernel '{self.env_name}' not found.")
         
-        self.kernel_manager = KernelManager(kernel_name=self.env_name)
-        self.kernel_manager.start_kernel()
+        self.kernel_manager = AsyncKernelManager(kernel_name=self.env_name)
+        await self.kernel_manager.start_kernel()
         self.kernel_client = self.kernel_manager.client()
         self.kernel_client.start_channels()
+        await self.kernel_client.wait_for_ready()
         return self.kernel_manager, self.kernel_client
     
-    async def execute_code(self, code: str) -> str:
+    async def attach_kernel(self, connection_info: dict, pid: Optional[int] = None, kernel_env_path: Optional[str] = None, local: bool = True):
+        """Connect to a kernel started elsewhere instead of starting a new one."""
+        kernel_client = AsyncKernelClient()
+        kernel_client.load_connection_info(connection_info)
+        kernel_client.start_channels()
         try:
-            if code.strip().startswith('!'):
-                self.magic_command_handler = MagicCommandHandler(self.relevant_env_path)
-                return self.magic_command_handler.execute(code)
-        except Exception as e:  
-            return "Error in the magic command: " + str(e)
-            
-        self.kernel_client.execute(code)
+            await kernel_client.wait_for_ready(timeout=10)
+        except Exception:
+            kernel_client.stop_channels()
+            raise
+        self.kernel_client = kernel_client
+        self.kernel_manager = AttachedKernelManager(kernel_client, pid=pid, local=local)
+        self.kernel_env_path = kernel_env_path
+        return self.kernel_manager, self.kernel_client
+
+    async def attach_remote_kernel(self, connection_info: dict, host: KernelHostClient, kernel_id: str):
+        """Connect to a kernel on a kernel host; lifecycle calls go through its agent."""
+        await self.attach_kernel(connection_info, local=False)
+        self.kernel_manager = RemoteKernelManager(self.kernel_client, host, kernel_id)
+        # The remote env path means nothing on this machine.
+        self.kernel_env_path = None
+        return self.kernel_manager, self.kernel_client
+
+    async def start_remote_kernel(self, placement: KernelPlacement):
+        host, kernel = await placement.start_kernel(self.env_name, self.notebook_id)
+        try:
+            return await self.attach_remote_kernel(kernel['connection_info'], host, kernel['kernel_id'])
+        except Exception:
+            await host.shutdown_kernel(kernel['kernel_id'])
+            raise
+
+    async def kernel_alive(self) -> bool:
+        if self.kernel_manager is None or not self.kernel_manager.has_kernel:
+            return False
+        try:
+            return await self.kernel_manager.is_alive()
+        except Exception as e:
+            logger.warning(f"Could not check the kernel of notebook {self.notebook_id}: {e}")
+            # Unknown is not dead; keep waiting.
+            return True
+
+    async def keep_env_if_installing(self, code: str):
+        """
+        A pooled kernel's venv is deleted with the kernel; once the notebook
+        installs packages into it, keep it as the notebook's env instead.
+        """
+        if is_pool_env(self.kernel_env_path) and PIP_INSTALL_LINE.search(code):
+            await asyncio.to_thread(promote_pool_env, self.kernel_env_path, self.notebook_id)
+
+    async def shutdown_kernel(self):
+        if self.kernel_client is not None:
+            self.kernel_client.stop_channels()
+        if self.kernel_manager is not None and self.kernel_manager.has_kernel:
+            await self.kernel_manager.shutdown_kernel()
+        # A pooled kernel's venv dies with it, unless the notebook kept it.
+        await asyncio.to_thread(remove_pool_env, self.kernel_env_path)
+        self.kernel_client = None
+        self.kernel_manager = None
+
+    async def execute_code(self, code: str) -> str:
         output = ""
+        async for chunk in self.execute_code_stream(code=code):
+            if isinstance(chunk, str):
+                output += chunk
+        if not is_magic_command(code):
+            output += EXECUTION_FINISHED_MARKER
+        return output
+
+    def get_magic_command_handler(self) -> MagicCommandHandler:
+        """The handler for this notebook, rebuilt only when its env changes."""
+        env_path = self.kernel_env_path or self.relevant_env_path
+        if self.magic_command_handler is None or self.magic_command_handler.requested_env_path != env_path:
+            self.magic_command_handler = MagicCommandHandler(env_path)
+        return self.magic_command_handler
+
+    @property
+    def remote_kernel(self) -> bool:
+        """True when the kernel runs on a kernel host rather than this machine."""
+        return not getattr(self.kernel_manager, 'local', True)
+
+    async def _execute_magic_command_stream(self, code: str) -> AsyncIterator[str]:
+        try:
+            await self.keep_env_if_installing(code)
+            if self.remote_kernel:
+                stream = self._execute_remote_magic_command_stream(code)
+            else:
+                stream = self.get_magic_command_handler().execute_stream(code)
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            yield "Error in the magic command: " + str(e)
+
+    async def _execute_remote_magic_command_stream(self, code: str) -> AsyncIterator[str]:
+        """
+        Magic commands for a kernel on a kernel host. Run here they would
+        touch this machine's files and envs, so pip goes through the kernel's
+        %pip, which installs into the kernel's own env on its host, and the
+        rest are refused.
+        """
+        command, args = MagicCommandHandler.parse(code)
+        if command != 'pip':
+            yield f"Command '{command}' is not available while the kernel runs on a kernel host. Only pip is, and it installs into the kernel's environment there."
+            return
+        msg_id = self.kernel_client.execute(f"%pip {' '.join(args)}", store_history=False)
+        async for _, msg_type, content in self._iopub_messages({msg_id}):
+            text = self._output_text(msg_type, content)
+            if text is not None:
+                yield text
+
+    async def interrupt(self):
+        """Stop a running magic command, or interrupt the kernel."""
+        if self.magic_command_handler is not None and self.magic_command_handler.cancel():
+            return
+        if self.kernel_manager is not None:
+            await self.kernel_manager.interrupt_kernel()
+
+    async def _iopub_messages(self, pending: set) -> AsyncIterator[Tuple[str, str, dict]]:
+        """
+        Yield (parent msg_id, msg_type, content) for iopub messages belonging to
+        the execute requests in `pending`, until each of them reports idle.
+        Callers may discard ids from `pending` to stop waiting for them.
+        If the kernel dies, the requests still pending end with a DeadKernelError.
+        """
         count = 0
-        while True:
-            print("waiting for message")
+        silent = 0
+        while pending:
             try:
-                msg = self.kernel_client.get_iopub_msg(timeout=1)
-                msg_type = msg['header']['msg_type']
-                content = msg['content']
-                if msg_type == 'status' and content['execution_state'] == 'busy':
-                    print("execution busy")
-                    count += 1
-                    if count > 5:
-                        continue
-                if msg_type == 'stream':
-                    print("stream", content)
-                    output += content['text']
-                elif msg_type == 'execute_result':
-                    print("execute_result", content)
-                    output += content['data']['text/plain']
-                elif msg_type == 'error':
-                    print("error", content)
-                    output += '\n'.join(content['traceback'])
-                elif msg_type == 'status' and content['execution_state'] == 'idle':
-                    # Execution finished
-                    output += '# Execution finished\n'
+                msg = await self.kernel_client.get_iopub_msg(timeout=1)
+            except queue.Empty:
+                silent += 1
+                # A kernel owned by another worker can be shut down without
+                # us hearing about it; don't wait on it forever.
+                if silent % KERNEL_LIVENESS_INTERVAL == 0 and not await self.kernel_alive():
+                    logger.warning(f"Kernel of notebook {self.notebook_id} died with {len(pending)} executions pending")
+                    for parent_id in list(pending):
+                        if parent_id not in pending:
+                            # The caller stopped waiting for it, e.g. skipped after an error.
+                            continue
+                        pending.discard(parent_id)
+                        yield parent_id, 'error', {
+                            'ename': 'DeadKernelError',
+                            'evalue': 'The kernel died',
+                            'traceback': ['DeadKernelError: The kernel died before the execution finished'],
+                        }
+                        yield parent_id, 'status', {'execution_state': 'idle'}
                     break
-                print(f"content: {content} \n\n")
+                continue
             except Exception as e:
                 if str(e).strip():
-                    print(f"error: {e} \n\n")
+                    logger.warning(f"Error reading kernel output: {e}")
                     count += 1
                     if count > 10:
                         break
                 continue
-        return output
 
-    async def save_notebook(self, data: dict):
+            silent = 0
+            parent_id = msg['parent_header'].get('msg_id')
+            if parent_id not in pending:
+                continue
+            msg_type = msg['header']['msg_type']
+            content = msg['content']
+            if msg_type == 'status' and content['execution_state'] == 'idle':
+                # Execution finished
+                pending.discard(parent_id)
+            yield parent_id, msg_type, content
+
+    @staticmethod
+    def _output_text(msg_type: str, content: dict) -> Optional[str]:
+        if msg_type == 'stream':
+            return content['text']
+        elif msg_type == 'execute_result':
+            return content['data'].get('text/plain')
+        elif msg_type == 'error':
+            return '\n'.join(content['traceback'])
+        return None
+
+    @staticmethod
+    def _output_display(msg_type: str, content: dict) -> Optional[dict]:
+        """
+        Rich MIME bundle of a display_data or execute_result message.
+        execute_result keeps sending text/plain as text, so it only produces a
+        display when it carries something richer.
+        """
+        if msg_type not in ('display_data', 'execute_result'):
+            return None
+        data = content.get('data', {})
+        if msg_type == 'execute_result' and set(data) <= {'text/plain'}:
+            return None
+        return {'data': data, 'metadata': content.get('metadata', {})}
+
+    async def execute_code_stream(self, code: str) -> AsyncIterator[Union[str, dict]]:
+        """
+        Execute code on the kernel and yield output chunks as they are produced.
+        Text is yielded as str, rich outputs as a {'data', 'metadata'} MIME bundle.
+        """
+        if is_magic_command(code):
+            async for chunk in self._execute_magic_command_stream(code):
+                yield chunk
+            return
+
+        self.last_error = None
+        await self.keep_env_if_installing(code)
+        msg_id = self.kernel_client.execute(code)
+        async for _, msg_type, content in self._iopub_messages({msg_id}):
+            if msg_type == 'error':
+                self.last_error = content
+            text = self._output_text(msg_type, content)
+            if text is not None:
+                yield text
+            display = self._output_display(msg_type, content)
+            if display is not None:
+                yield display
+
+    async def run_silent(self, code: str) -> str:
+        """
+        Run helper code without touching the execution count or history and
+        return what it wrote to stdout. Raises RuntimeError if it fails.
+        """
+        msg_id = self.kernel_client.execute(code, silent=True, store_history=False)
+        stdout = ''
+        error = None
+        async for _, msg_type, content in self._iopub_messages({msg_id}):
+            if msg_type == 'stream' and content.get('name') == 'stdout':
+                stdout += content['text']
+            elif msg_type == 'error':
+                error = f"{content['ename']}: {content['evalue']}"
+        if error:
+            raise RuntimeError(error)
+        return stdout
+
+    async def execute_cells_stream(self, cells: List[Tuple[str, str]], stop_on_error: bool = True) -> AsyncIterator[Tuple[str, str, Union[str, dict]]]:
+        """
+        Run (cell_id, code) pairs in order and yield (cell_id, kind, payload) where
+        kind is 'output', 'display', 'error', 'complete' or 'skipped'. The
+        payload is text, or a MIME bundle for 'display'.
+        Consecutive kernel cells are submitted together so the kernel moves
+        straight from one to the next; magic commands run between them.
+        After an error with stop_on_error, the kernel aborts the cells already
+        submitted and the remaining cells are reported as skipped.
+        """
+        index = 0
+        failed = False
+        while index < len(cells):
+            cell_id, code = cells[index]
+            if failed:
+                yield cell_id, 'skipped', ''
+                index += 1
+                continue
+
+            if is_magic_command(code):
+                async for chunk in self._execute_magic_command_stream(code):
+                    yield cell_id, 'output', chunk
+                yield cell_id, 'complete', ''
+                index += 1
+                continue
+
+            batch = []
+            while index < len(cells) and not is_magic_command(cells[index][1]):
+                batch.append(cells[index])
+                index += 1
+
+            await self.keep_env_if_installing('\n'.join(code for _, code in batch))
+            cell_ids = {self.kernel_client.execute(code, stop_on_error=stop_on_error): cell_id for cell_id, code in batch}
+            order = list(cell_ids)
+            pending = set(order)
+            async for msg_id, msg_type, content in self._iopub_messages(pending):
+                cell_id = cell_ids[msg_id]
+                text = self._output_text(msg_type, content)
+                if msg_type == 'error':
+                    failed = failed or stop_on_error
+                    yield cell_id, 'error', text
+                elif text is not None:
+                    yield cell_id, 'output', text
+                elif msg_type == 'status' and content['execution_state'] == 'idle':
+                    yield cell_id, 'complete', ''
+                    if failed:
+                        for skipped_id in order[order.index(msg_id) + 1:]:
+                            pending.discard(skipped_id)
+                            yield cell_ids[skipped_id], 'skipped', ''
+
+                display = self._output_display(msg_type, content)
+                if display is not None:
+                    yield cell_id, 'display', display
+
+    async def save_notebook(self, data: dict, documents: NotebookDocumentStore = None):
         try:
             notebook = data.get('cells')
             filename = data.get('filename')
@@ -118,10 +427,23 @@ class NotebookUtils():
             if not user_id:
                 return {"success": False, "message": "User ID is required."}
 
-            if not notebook:
+            # An empty list is a notebook whose cells were all deleted.
+            if notebook is None:
                 return {"success": False, "message": "No cells found in the file provided."}
+
+            if documents is not None:
+                # Keep the in-memory document authoritative for later patches;
+                # the save queue writes it in the background.
+                document = await documents.replace(notebook_id, user_id, notebook)
+                # This reply can't wait for the write, so report a write that
+                # failed since the last save; this save retries it.
+                save_error = document.save_error
+                documents.schedule_flush(document)
+                if save_error:
+                    return {"success": False, "message": f"Earlier changes could not be saved ({save_error}); saving again.", "version": document.version}
+                return {"success": True, "message": "Notebook saved successfully.", "version": document.version}
             
-            response = s3.save_or_update_notebook(notebook_id, user_id, notebook)
+            response = await asyncio.to_thread(s3.save_or_update_notebook, notebook_id, user_id, notebook)
             # print("response", response)
             
             # TODO: Save to s3 instead of local file system.
@@ -136,9 +458,11 @@ class NotebookUtils():
             return {"success": False, "message": str(e)}
 
 
-    async def load_notebook_handler(self, filename: str, notebook_id: str, user_id: str):
+    async def load_notebook_handler(self, filename: str, notebook_id: str, user_id: str, documents: NotebookDocumentStore = None):
         """
-        Load a notebook from S3
+        Load a notebook from S3, or from the document store when it holds
+        changes that may not be written yet. A clean document is refreshed
+        from S3, since another worker may have saved the notebook.
         Returns (success, content or error message)
         """
         if not notebook_id:
@@ -148,23 +472,29 @@ class NotebookUtils():
             return {"status": "error", "message": "User ID is required.", "notebook": []}
         
         
+        document = documents.peek(notebook_id, user_id) if documents is not None else None
+        if document is not None and document.dirty:
+            return {"status": "success", "notebook": document.cells, "version": document.version, "message": "Notebook loaded succesfully."}
+
         try:
             file_path = f"notebooks/{user_id}/{notebook_id}.json"
-            print(f"Attempting to load notebook from S3: {file_path}")  # Debug log
-            
-            response = s3.load_notebook(file_path)
-            print("loaded_notebook", len(response))
+            response = await asyncio.to_thread(s3.load_notebook, file_path)
     
             if response.get('statusCode') != 200:
                 return {"status": "error", "message": "Notebook not found in S3.", "notebook": []}
             
             notebook = json.loads(response.get('response'))
+            if documents is not None:
+                document = documents.seed(notebook_id, user_id, notebook)
+                return {"status": "success", "notebook": document.cells, "version": document.version, "message": "Notebook loaded succesfully."}
             return {"status": "success", "notebook": notebook, "message": "Notebook loaded succesfully."}
         except Exception as e:
             return {"status": "error", "message": str(e), "notebook": []}
             
     async def get_notebook_details(self):
         supabase = get_supabase_client()
-        response = supabase.table('notebooks').select('*').eq('id', self.notebook_id).single().execute()
-        print("response", response)
+        with supabase_request_seconds.time(operation='get_notebook_details'):
+            response = await asyncio.to_thread(
+                supabase.table('notebooks').select('*').eq('id', self.notebook_id).single().execute
+            )
         return response.data
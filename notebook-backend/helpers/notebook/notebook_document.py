@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from helpers.aws.s3 import s3
+from helpers.notebook.save_queue import WriteBehindSaveQueue
+
+logger = logging.getLogger(__name__)
+
+# Clean documents kept in memory beyond this many are dropped, LRU first.
+NOTEBOOK_DOCUMENTS_MAX = int(os.environ.get('NOTEBOOK_DOCUMENTS_MAX', 500))
+
+
+class PatchError(ValueError):
+    """A patch that can't be applied. `version` is the server's current version."""
+
+    def __init__(self, message: str, version: int, conflict: bool = False):
+        super().__init__(message)
+        self.version = version
+        self.conflict = conflict
+
+
+class NotebookDocument:
+    """
+    The authoritative cells of one notebook. Clients change it with patches
+    against a version number; every applied patch bumps the version.
+    """
+
+    def __init__(self, notebook_id: str, user_id: str, cells: List[dict], version: int = 1):
+        self.notebook_id = notebook_id
+        self.user_id = user_id
+        self.cells = list(cells)
+        self.version = version
+        self.persisted_version = version
+        # Why the last background write was given up, until a write succeeds.
+        self.save_error: Optional[str] = None
+        self.last_access = time.time()
+
+    @property
+    def dirty(self) -> bool:
+        return self.version != self.persisted_version
+
+    def _index(self, cells: List[dict], cell_id: str) -> int:
+        for index, cell in enumerate(cells):
+            if cell.get('id') == cell_id:
+                return index
+        raise PatchError(f"Cell {cell_id} not found", self.version)
+
+    def apply(self, ops: List[dict], base_version: int) -> int:
+        """
+        Apply insert, delete, move and update ops in order, all or nothing.
+        Returns the new version.
+        """
+        if base_version != self.version:
+            raise PatchError(f"Notebook is at version {self.version}, patch is against {base_version}", self.version, conflict=True)
+
+        cells = list(self.cells)
+        for op in ops:
+            kind = op.get('op')
+            if kind == 'insert':
+                cell = op.get('cell') or {}
+                if not cell.get('id'):
+                    raise PatchError("Inserted cell needs an id", self.version)
+                if any(existing.get('id') == cell['id'] for existing in cells):
+                    raise PatchError(f"Cell {cell['id']} already exists", self.version)
+                index = op.get('index', len(cells))
+                cells.insert(max(0, min(index, len(cells))), dict(cell))
+            elif kind == 'delete':
+                del cells[self._index(cells, op.get('cellId'))]
+            elif kind == 'move':
+                cell = cells.pop(self._index(cells, op.get('cellId')))
+                index = op.get('index', len(cells))
+                cells.insert(max(0, min(index, len(cells))), cell)
+            elif kind == 'update':
+                index = self._index(cells, op.get('cellId'))
+                fields = {key: value for key, value in (op.get('fields') or {}).items() if key != 'id'}
+                cells[index] = {**cells[index], **fields}
+            else:
+                raise PatchError(f"Unknown patch op '{kind}'", self.version)
+
+        self.cells = cells
+        self.version += 1
+        self.last_access = time.time()
+        return self.version
+
+    def replace(self, cells: List[dict]) -> int:
+        """A whole-notebook save from a client that doesn't patch."""
+        self.cells = list(cells)
+        self.version += 1
+        self.last_access = time.time()
+        return self.version
+
+    def reload(self, cells: List[dict]):
+        """Take cells another worker saved. Only for documents without unsaved changes."""
+        if self.dirty or cells == self.cells:
+            return
+        self.cells = list(cells)
+        self.version += 1
+        self.persisted_version = self.version
+
+
+class NotebookDocumentStore:
+    """
+    In-memory notebook documents, loaded from S3 on first use. Patches are
+    applied here and handed to the write-behind save queue, which writes only
+    the latest state, instead of rewriting the notebook on every keystroke.
+
+    Documents are keyed by (user_id, notebook_id), like their S3 objects.
+    Other workers may save the notebook too, so a document without unsaved
+    changes is checked against S3 (a conditional GET through the notebook
+    cache) before it is served or patched.
+    """
+
+    def __init__(self, save_queue: WriteBehindSaveQueue = None, max_documents: int = None):
+        self.save_queue = save_queue if save_queue is not None else WriteBehindSaveQueue()
+        self.max_documents = max_documents if max_documents is not None else NOTEBOOK_DOCUMENTS_MAX
+        self._documents: "OrderedDict[Tuple[str, str], NotebookDocument]" = OrderedDict()
+        self._loading: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        """Whether the (user_id, notebook_id) document is in memory."""
+        return key in self._documents
+
+    async def _read(self, notebook_id: str, user_id: str) -> List[dict]:
+        response = await asyncio.to_thread(s3.load_notebook, f"notebooks/{user_id}/{notebook_id}.json")
+        if response.get('statusCode') == 200:
+            return json.loads(response['response'])
+        if 'NoSuchKey' in str(response.get('message')):
+            # Not saved yet.
+            return []
+        # Starting from an empty notebook here would overwrite the real one on flush.
+        raise RuntimeError(f"Could not load notebook {notebook_id}: {response.get('message')}")
+
+    async def _load(self, notebook_id: str, user_id: str) -> NotebookDocument:
+        return NotebookDocument(notebook_id, user_id, await self._read(notebook_id, user_id))
+
+    async def get(self, notebook_id: str, user_id: str) -> NotebookDocument:
+        key = (user_id, notebook_id)
+        document = self._documents.get(key)
+        if document is None:
+            # Concurrent first requests share one S3 read.
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = asyncio.ensure_future(self._load(notebook_id, user_id))
+                self._loading[key] = loading
+                try:
+                    document = await loading
+                finally:
+                    self._loading.pop(key, None)
+                self._documents[key] = document
+                self._evict()
+            else:
+                document = await loading
+        elif not document.dirty:
+            document.reload(await self._read(notebook_id, user_id))
+        self._documents.move_to_end(key)
+        document.last_access = time.time()
+        return document
+
+    def peek(self, notebook_id: str, user_id: str) -> Optional[NotebookDocument]:
+        """The document if it is in memory, without loading it."""
+        return self._documents.get((user_id, notebook_id))
+
+    def seed(self, notebook_id: str, user_id: str, cells: List[dict]) -> NotebookDocument:
+        """Keep cells just read from S3, unless the document in memory has unsaved changes."""
+        key = (user_id, notebook_id)
+        document = self._documents.get(key)
+        if document is None:
+            document = NotebookDocument(notebook_id, user_id, cells)
+            self._documents[key] = document
+            self._evict()
+        else:
+            document.reload(cells)
+        return document
+
+    async def patch(self, notebook_id: str, user_id: str, base_version: int, ops: List[dict]) -> NotebookDocument:
+        document = await self.get(notebook_id, user_id)
+        document.apply(ops, base_version)
+        self.schedule_flush(document)
+        return document
+
+    async def replace(self, notebook_id: str, user_id: str, cells: List[dict]) -> NotebookDocument:
+        key = (user_id, notebook_id)
+        document = self._documents.get(key)
+        if document is None:
+            document = NotebookDocument(notebook_id, user_id, cells, version=0)
+            self._documents[key] = document
+            self._evict()
+        document.replace(cells)
+        return document
+
+    def schedule_flush(self, document: NotebookDocument):
+        def saved(version):
+            document.persisted_version = max(document.persisted_version, version)
+            document.save_error = None
+
+        def failed(error):
+            document.save_error = error
+
+        self.save_queue.enqueue(
+            document.notebook_id, document.user_id, document.cells,
+            version=document.version, on_saved=saved, on_failed=failed,
+        )
+
+    async def flush(self, notebook_id: str, user_id: str, timeout: float = None) -> bool:
+        """Write the notebook now if it has unsaved changes. Returns False on failure."""
+        return await self.save_queue.flush(notebook_id, user_id, timeout=timeout)
+
+    def _evict(self):
+        for key in list(self._documents):
+            if len(self._documents) <= self.max_documents:
+                break
+            if not self._documents[key].dirty:
+                del self._documents[key]
+
+    async def shutdown(self):
+        await self.save_queue.shutdown()
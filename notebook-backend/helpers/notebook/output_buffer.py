@@ -0,0 +1,150 @@
+import os
+import time
+import uuid
+import tempfile
+from collections import deque
+from itertools import islice
+from typing import Deque, List, Optional
+
+CELL_OUTPUT_MEMORY_LIMIT = int(os.environ.get('CELL_OUTPUT_MEMORY_LIMIT', 1024 * 1024))
+CELL_OUTPUT_HEAD_CHARS = int(os.environ.get('CELL_OUTPUT_HEAD_CHARS', 32 * 1024))
+CELL_OUTPUT_TAIL_CHARS = int(os.environ.get('CELL_OUTPUT_TAIL_CHARS', 32 * 1024))
+OUTPUT_SPILL_DIR = os.environ.get('OUTPUT_SPILL_DIR') or os.path.join(tempfile.gettempdir(), 'notebook_outputs')
+OUTPUT_SPILL_TTL = float(os.environ.get('OUTPUT_SPILL_TTL', 24 * 3600))
+OUTPUT_PAGE_DEFAULT_LIMIT = 64 * 1024
+# Largest page read_spilled_output returns, in bytes or lines; a line page
+# also stops once it holds this many bytes.
+OUTPUT_PAGE_MAX_LIMIT = int(os.environ.get('OUTPUT_PAGE_MAX_LIMIT', 1024 * 1024))
+
+
+def spill_path(handle: str) -> str:
+    # Handles are uuid hex strings; anything else could point outside the spill dir.
+    if len(handle) != 32 or not all(c in '0123456789abcdef' for c in handle):
+        raise ValueError(f"Invalid output handle '{handle}'")
+    return os.path.join(OUTPUT_SPILL_DIR, f"{handle}.txt")
+
+
+class CellOutputBuffer:
+    """
+    Collects a cell's text output in memory up to CELL_OUTPUT_MEMORY_LIMIT
+    bytes. Past that, the full output goes to a spill file and only the head
+    and a rolling tail stay in memory; the file can be paged through with
+    read_spilled_output using the buffer's handle.
+    """
+
+    def __init__(self, limit: int = None, head_chars: int = None, tail_chars: int = None):
+        self.limit = limit if limit is not None else CELL_OUTPUT_MEMORY_LIMIT
+        self.head_chars = head_chars if head_chars is not None else CELL_OUTPUT_HEAD_CHARS
+        self.tail_chars = tail_chars if tail_chars is not None else CELL_OUTPUT_TAIL_CHARS
+        self.size = 0
+        self.handle: Optional[str] = None
+        self._chunks: List[str] = []
+        self._file = None
+        self._head = ''
+        self._tail: Deque[str] = deque()
+        self._tail_length = 0
+
+    @property
+    def spilled(self) -> bool:
+        return self.handle is not None
+
+    def write(self, text: str):
+        self.size += len(text.encode('utf-8'))
+        if not self.spilled:
+            self._chunks.append(text)
+            if self.size > self.limit:
+                self._spill()
+            return
+        self._file.write(text)
+        self._push_tail(text)
+
+    def _spill(self):
+        self.handle = uuid.uuid4().hex
+        os.makedirs(OUTPUT_SPILL_DIR, exist_ok=True)
+        self._file = open(spill_path(self.handle), 'w', encoding='utf-8')
+        text = ''.join(self._chunks)
+        self._chunks = []
+        self._file.write(text)
+        self._head = text[:self.head_chars]
+        self._push_tail(text[len(self._head):])
+
+    def _push_tail(self, text: str):
+        self._tail.append(text)
+        self._tail_length += len(text)
+        while self._tail and self._tail_length - len(self._tail[0]) >= self.tail_chars:
+            self._tail_length -= len(self._tail.popleft())
+
+    def tail(self) -> str:
+        return ''.join(self._tail)[-self.tail_chars:]
+
+    def omitted_notice(self, head_bytes: int) -> str:
+        """Marker placed between a head of `head_bytes` and the tail."""
+        omitted = self.size - head_bytes - len(self.tail().encode('utf-8'))
+        return f"\n... output truncated, {omitted} bytes omitted (output handle {self.handle}) ...\n"
+
+    def getvalue(self) -> str:
+        if not self.spilled:
+            return ''.join(self._chunks)
+        return self._head + self.omitted_notice(len(self._head.encode('utf-8'))) + self.tail()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_spilled_output(handle: str, offset: int = 0, limit: int = OUTPUT_PAGE_DEFAULT_LIMIT, unit: str = 'bytes') -> dict:
+    """
+    Read a page of a spilled output by byte range or line range.
+    Raises ValueError for a bad handle, unit, offset or limit.
+    """
+    try:
+        offset, limit = int(offset), int(limit)
+    except (TypeError, ValueError):
+        raise ValueError("offset and limit must be integers")
+    if offset < 0:
+        raise ValueError("offset must be >= 0")
+    if not 0 < limit <= OUTPUT_PAGE_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {OUTPUT_PAGE_MAX_LIMIT}")
+
+    path = spill_path(handle)
+    total_bytes = os.path.getsize(path)
+    if unit == 'lines':
+        lines, size, eof = [], 0, True
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in islice(f, offset, None):
+                if len(lines) == limit or size >= OUTPUT_PAGE_MAX_LIMIT:
+                    eof = False
+                    break
+                lines.append(line)
+                size += len(line)
+        data = ''.join(lines)
+        next_offset = offset + len(lines)
+    elif unit == 'bytes':
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            raw = f.read(limit)
+        data = raw.decode('utf-8', errors='replace')
+        next_offset = offset + len(raw)
+        eof = next_offset >= total_bytes
+    else:
+        raise ValueError(f"Unknown unit '{unit}', expected 'bytes' or 'lines'")
+
+    return {
+        'handle': handle,
+        'unit': unit,
+        'offset': offset,
+        'next_offset': next_offset,
+        'total_bytes': total_bytes,
+        'data': data,
+        'eof': eof,
+    }
+
+
+def cleanup_spilled_outputs(max_age: float = OUTPUT_SPILL_TTL):
+    if not os.path.isdir(OUTPUT_SPILL_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(OUTPUT_SPILL_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
@@ -0,0 +1,120 @@
+import os
+import json
+import shutil
+import asyncio
+import logging
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# One download and wheel cache shared by every venv_kernel_* env, so a package
+# is fetched and built once per machine instead of once per notebook.
+PACKAGE_CACHE_DIR = os.environ.get('PACKAGE_CACHE_DIR') or os.path.join(Path.home(), '.cache', 'notebook-packages')
+# 'pip' or 'uv'. uv falls back to pip when the binary is not on PATH.
+PACKAGE_INSTALLER = os.environ.get('PACKAGE_INSTALLER', 'pip')
+
+# pip install options that change what "already installed" means.
+_NO_SKIP_OPTIONS = {'-U', '--upgrade', '--force-reinstall', '-I', '--ignore-installed', '-e', '--editable', '-r', '--requirement', '-c', '--constraint'}
+
+# Run with the env's own interpreter; prints the requirements it doesn't satisfy.
+_UNSATISFIED_SCRIPT = """
+import sys, json
+from importlib import metadata
+try:
+    from packaging.requirements import Requirement
+except ImportError:
+    from pip._vendor.packaging.requirements import Requirement
+missing = []
+for spec in json.loads(sys.argv[1]):
+    try:
+        requirement = Requirement(spec)
+        version = metadata.version(requirement.name)
+    except Exception:
+        missing.append(spec)
+        continue
+    # Extras may pull in packages we don't check for.
+    if requirement.extras or (requirement.specifier and not requirement.specifier.contains(version, prereleases=True)):
+        missing.append(spec)
+print(json.dumps(missing))
+"""
+
+
+def cache_env() -> dict:
+    """Environment variables pointing pip and uv at the shared cache."""
+    os.makedirs(PACKAGE_CACHE_DIR, exist_ok=True)
+    return {
+        'PIP_CACHE_DIR': os.path.join(PACKAGE_CACHE_DIR, 'pip'),
+        'UV_CACHE_DIR': os.path.join(PACKAGE_CACHE_DIR, 'uv'),
+        # uv hardlinks files out of its cache, so each package is stored once on disk.
+        'UV_LINK_MODE': 'hardlink',
+        'PIP_DISABLE_PIP_VERSION_CHECK': '1',
+    }
+
+
+def uv_path() -> Optional[str]:
+    return shutil.which('uv') if PACKAGE_INSTALLER == 'uv' else None
+
+
+def split_install_args(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Split `pip install` arguments into (options, requirement specs)."""
+    options, requirements = [], []
+    takes_value = False
+    for arg in args:
+        if takes_value:
+            options.append(arg)
+            takes_value = False
+        elif arg.startswith('-'):
+            options.append(arg)
+            # Options like `-i URL` or `--target DIR` take the next argument.
+            takes_value = arg in ('-i', '--index-url', '--extra-index-url', '-f', '--find-links', '-t', '--target', '-r', '--requirement', '-c', '--constraint', '-e', '--editable')
+        else:
+            requirements.append(arg)
+    return options, requirements
+
+
+async def unsatisfied_requirements(python_path: str, requirements: List[str]) -> List[str]:
+    """Requirements not already met in the env. Errors count as unmet."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            python_path, '-c', _UNSATISFIED_SCRIPT, json.dumps(requirements),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+    except OSError as e:
+        logger.warning(f"Could not check installed packages with {python_path}: {e}")
+        return requirements
+    if process.returncode != 0:
+        logger.warning(f"Could not check installed packages with {python_path}: {stderr.decode(errors='replace')}")
+        return requirements
+    return json.loads(stdout)
+
+
+def install_argv(python_path: str, pip_path: str, args: List[str]) -> List[str]:
+    """Command line for `pip install args` with the configured installer."""
+    uv = uv_path()
+    if uv:
+        return [uv, 'pip', 'install', '--python', python_path, *args]
+    return [pip_path, 'install', *args]
+
+
+async def plan_install(python_path: str, args: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Return (args to install with, requirements skipped as already satisfied).
+    Args are returned unchanged when they ask for an upgrade, reinstall or a
+    requirements file, since those can't be answered from installed metadata.
+    """
+    options, requirements = split_install_args(args)
+    if not requirements or _NO_SKIP_OPTIONS.intersection(options):
+        return args, []
+    # URLs, paths and wheels aren't plain requirement specs.
+    if any('/' in spec or spec.endswith(('.whl', '.tar.gz', '.zip')) for spec in requirements):
+        return args, []
+    missing = await unsatisfied_requirements(python_path, requirements)
+    skipped = [spec for spec in requirements if spec not in missing]
+    return (options + missing if missing else []), skipped
+
+
+def default_python_path(env_path: Optional[str]) -> str:
+    return os.path.join(env_path, 'bin', 'python') if env_path else 'python'
@@ -0,0 +1,230 @@
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+from helpers.aws.s3 import s3
+from helpers.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# A notebook is written once it has been quiet for SAVE_QUEUE_DEBOUNCE seconds,
+# and never later than SAVE_QUEUE_MAX_DELAY after its oldest unwritten change.
+SAVE_QUEUE_DEBOUNCE = float(os.environ.get('SAVE_QUEUE_DEBOUNCE', 2))
+SAVE_QUEUE_MAX_DELAY = float(os.environ.get('SAVE_QUEUE_MAX_DELAY', 10))
+SAVE_QUEUE_CONCURRENCY = int(os.environ.get('SAVE_QUEUE_CONCURRENCY', 4))
+# A single S3 + Supabase write taking longer than this is reported as slow.
+# Its thread can't be cancelled, so the notebook stays in flight until the
+# write returns; a retry or newer save started earlier could land before it.
+SAVE_QUEUE_WRITE_TIMEOUT = float(os.environ.get('SAVE_QUEUE_WRITE_TIMEOUT', 30))
+# Longest shutdown waits for the remaining writes.
+SAVE_QUEUE_SHUTDOWN_TIMEOUT = float(os.environ.get('SAVE_QUEUE_SHUTDOWN_TIMEOUT', 30))
+# Failed writes are retried after SAVE_QUEUE_RETRY_BACKOFF seconds, doubling up
+# to SAVE_QUEUE_RETRY_MAX_BACKOFF, and given up after SAVE_QUEUE_MAX_RETRIES.
+SAVE_QUEUE_MAX_RETRIES = int(os.environ.get('SAVE_QUEUE_MAX_RETRIES', 5))
+SAVE_QUEUE_RETRY_BACKOFF = float(os.environ.get('SAVE_QUEUE_RETRY_BACKOFF', 2))
+SAVE_QUEUE_RETRY_MAX_BACKOFF = float(os.environ.get('SAVE_QUEUE_RETRY_MAX_BACKOFF', 60))
+
+save_writes = registry.counter('notebook_save_queue_writes_total', 'Notebook writes by the save queue', ('result',))
+save_coalesced = registry.counter('notebook_save_queue_coalesced_total', 'Saves replaced by a newer state before being written')
+save_lag_seconds = registry.histogram('notebook_save_queue_lag_seconds', 'Time from the oldest change in a write to the write finishing')
+
+
+@dataclass
+class PendingSave:
+    notebook_id: str
+    user_id: str
+    cells: list
+    version: Optional[int]
+    first_queued_at: float
+    last_queued_at: float
+    on_saved: Optional[Callable[[Optional[int]], None]] = None
+    # Called with the error once the write is given up.
+    on_failed: Optional[Callable[[str], None]] = None
+    # Set by flush() to skip the debounce.
+    force: bool = False
+    # Earliest retry after a failed write.
+    not_before: float = 0
+    attempts: int = 0
+    waiters: List[asyncio.Future] = field(default_factory=list)
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        # Notebook ids are only unique per user, like their S3 keys.
+        return self.user_id, self.notebook_id
+
+
+class WriteBehindSaveQueue:
+    """
+    Writes notebooks to S3 and Supabase in the background. Only the latest
+    queued state of a notebook is written, and a notebook has at most one
+    write in flight, so writes land in order. Failed writes are retried with
+    exponential backoff; a write rejected as invalid (ValueError) or out of
+    retries is given up and reported through `on_failed`.
+    """
+
+    def __init__(self, debounce: float = None, max_delay: float = None, concurrency: int = None,
+                 write: Callable[[str, str, list], dict] = None):
+        self.debounce = debounce if debounce is not None else SAVE_QUEUE_DEBOUNCE
+        self.max_delay = max_delay if max_delay is not None else SAVE_QUEUE_MAX_DELAY
+        self.concurrency = concurrency if concurrency is not None else SAVE_QUEUE_CONCURRENCY
+        self._write = write or s3.save_or_update_notebook
+        # Keyed by (user_id, notebook_id).
+        self._pending: Dict[Tuple[str, str], PendingSave] = {}
+        self._in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def oldest_age(self) -> float:
+        if not self._pending:
+            return 0.0
+        return time.time() - min(save.first_queued_at for save in self._pending.values())
+
+    def enqueue(self, notebook_id: str, user_id: str, cells: list, version: Optional[int] = None,
+                on_saved: Callable[[Optional[int]], None] = None,
+                on_failed: Callable[[str], None] = None) -> asyncio.Future:
+        """
+        Queue the notebook's latest cells, replacing any state not written yet.
+        The returned future resolves once these cells, or newer ones, are written.
+        """
+        now = time.time()
+        future = asyncio.get_running_loop().create_future()
+        key = (user_id, notebook_id)
+        previous = self._pending.get(key)
+        if previous is not None:
+            save_coalesced.inc()
+        self._pending[key] = PendingSave(
+            notebook_id=notebook_id,
+            user_id=user_id,
+            cells=cells,
+            version=version,
+            first_queued_at=previous.first_queued_at if previous else now,
+            last_queued_at=now,
+            on_saved=on_saved,
+            on_failed=on_failed,
+            waiters=(previous.waiters if previous else []) + [future],
+            force=previous.force if previous else False,
+        )
+        self.start()
+        self._wakeup.set()
+        return future
+
+    async def flush(self, notebook_id: str = None, user_id: str = None, timeout: float = None) -> bool:
+        """
+        Write now instead of waiting for the debounce, for one user's notebook
+        or all of them. Returns False if a write failed or didn't finish in time.
+        """
+        keys = [(user_id, notebook_id)] if notebook_id else list(set(self._pending) | set(self._in_flight))
+        waiters = []
+        for key in keys:
+            if key in self._pending:
+                self._pending[key].force = True
+                waiters.append(self._pending[key].waiters[-1])
+            elif key in self._in_flight:
+                waiters.append(self._in_flight[key])
+        if not waiters:
+            return True
+        self._wakeup.set()
+        done, not_done = await asyncio.wait(waiters, timeout=timeout)
+        return not not_done and all(not task.cancelled() and task.exception() is None and task.result() is not False for task in done)
+
+    def _due(self, save: PendingSave, now: float) -> float:
+        """Seconds until the save should be written, <= 0 when due."""
+        due = 0 if save.force else min(save.last_queued_at + self.debounce, save.first_queued_at + self.max_delay) - now
+        return max(due, save.not_before - now)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            wait = self.debounce
+            for key, save in list(self._pending.items()):
+                if key in self._in_flight:
+                    continue
+                due = self._due(save, now)
+                if due <= 0 and len(self._in_flight) < self.concurrency:
+                    del self._pending[key]
+                    self._in_flight[key] = asyncio.create_task(self._write_save(save))
+                else:
+                    wait = min(wait, max(due, 0.05))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _write_save(self, save: PendingSave) -> bool:
+        save.attempts += 1
+        error = None
+        # Invalid input fails the same way every time, so it isn't retried.
+        permanent = False
+        write = asyncio.ensure_future(asyncio.to_thread(self._write, save.notebook_id, save.user_id, save.cells))
+        try:
+            try:
+                response = await asyncio.wait_for(asyncio.shield(write), timeout=SAVE_QUEUE_WRITE_TIMEOUT)
+            except asyncio.TimeoutError:
+                save_writes.inc(result='slow')
+                logger.warning(f"Write of notebook {save.notebook_id} is taking over {SAVE_QUEUE_WRITE_TIMEOUT:g}s, waiting for it")
+                response = await write
+            if response.get('statusCode') != 200:
+                error = f"status {response.get('statusCode')}"
+        except ValueError as e:
+            error = str(e)
+            permanent = True
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        finally:
+            self._in_flight.pop(save.key, None)
+            self._wakeup.set()
+
+        if error is not None:
+            save_writes.inc(result='error')
+            logger.error(f"Failed to write notebook {save.notebook_id} (attempt {save.attempts}): {error}")
+            newer = self._pending.get(save.key)
+            if newer is not None:
+                # The newer state's write will cover this one's waiters.
+                newer.waiters = save.waiters + newer.waiters
+                return False
+            if not self._closed and not permanent and save.attempts <= SAVE_QUEUE_MAX_RETRIES:
+                backoff = min(SAVE_QUEUE_RETRY_BACKOFF * 2 ** (save.attempts - 1), SAVE_QUEUE_RETRY_MAX_BACKOFF)
+                save.not_before = time.time() + backoff
+                self._pending[save.key] = save
+                return False
+            save_writes.inc(result='given_up')
+            logger.error(f"Gave up writing notebook {save.notebook_id} after {save.attempts} attempts: {error}")
+            if save.on_failed is not None:
+                save.on_failed(error)
+            for waiter in save.waiters:
+                if not waiter.done():
+                    waiter.set_result(False)
+            return False
+
+        save_writes.inc(result='ok')
+        save_lag_seconds.observe(time.time() - save.first_queued_at)
+        if save.on_saved is not None:
+            save.on_saved(save.version)
+        for waiter in save.waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+        return True
+
+    def start(self):
+        if not self._closed and (self._worker is None or self._worker.done()):
+            self._worker = asyncio.create_task(self._run())
+
+    async def shutdown(self, timeout: float = None):
+        """Write everything still queued, giving up after the timeout."""
+        timeout = timeout if timeout is not None else SAVE_QUEUE_SHUTDOWN_TIMEOUT
+        if not await self.flush(timeout=timeout):
+            logger.error(f"Save queue shut down with {len(self._pending)} notebooks unwritten")
+        self._closed = True
+        if self._worker is not None:
+            self._worker.cancel()
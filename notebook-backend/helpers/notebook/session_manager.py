@@ -0,0 +1,331 @@
+import os
+import time
+import asyncio
+import logging
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from helpers.notebook.notebook import NotebookUtils
+from helpers.notebook.execution_queue import ExecutionQueue
+from helpers.notebook.output_buffer import cleanup_spilled_outputs
+from helpers.notebook.checkpoint import checkpoints_supported, discard_local_checkpoint, save_checkpoint
+from helpers.notebook.attached_kernel import connection_info_to_json
+from helpers.notebook.kernel_placement import KernelHostClient, RemoteKernelManager
+from helpers.notebook.session_registry import WORKER_ID, get_session_registry, pid_alive, worker_alive
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+
+def process_rss(pid: int) -> Optional[int]:
+    """Resident set size in bytes of a process and its children."""
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            return sum(p.memory_info().rss for p in [process, *process.children(recursive=True)])
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class NotebookSession:
+    """
+    A live kernel and the NotebookUtils bound to it. Sessions attached to a
+    kernel owned by another worker are not `owned` and leave the kernel
+    running when removed.
+    """
+
+    def __init__(self, notebook_id: str, nb: NotebookUtils, owned: bool = True):
+        self.notebook_id = notebook_id
+        self.nb = nb
+        self.owned = owned
+        # Last user who sent the session a message; its checkpoints are theirs.
+        self.user_id: Optional[str] = None
+        self.execution_queue = ExecutionQueue(nb)
+        self.created_at = time.time()
+        self.last_activity = time.time()
+
+    @property
+    def km(self):
+        return self.nb.kernel_manager
+
+    @property
+    def kc(self):
+        return self.nb.kernel_client
+
+    @property
+    def kernel_pid(self) -> Optional[int]:
+        provisioner = getattr(self.km, 'provisioner', None)
+        return getattr(provisioner, 'pid', None) or getattr(self.km, 'pid', None)
+
+    def rss(self) -> Optional[int]:
+        pid = self.kernel_pid
+        return process_rss(pid) if pid else None
+
+    def touch(self):
+        self.last_activity = time.time()
+
+
+class NotebookSessionManager:
+    """
+    Owns the live notebook sessions. Sessions are kept in LRU order and are
+    shut down when idle for too long, or evicted when the number of live
+    kernels or their combined RSS exceeds the configured limits.
+    Sessions with a connected WebSocket are only evicted as a last resort.
+
+    Kernels are recorded in a session registry shared by all uvicorn
+    workers, so a notebook opened on another worker attaches to the
+    running kernel rather than starting a second one. Registry calls may
+    block on the shared database, so they run in threads.
+    """
+
+    def __init__(self, idle_timeout: float = None, max_kernels: int = None, memory_budget_mb: int = None, cull_interval: float = None):
+        self.idle_timeout = idle_timeout if idle_timeout is not None else float(os.environ.get('SESSION_IDLE_TIMEOUT', 3600))
+        self.max_kernels = max_kernels if max_kernels is not None else int(os.environ.get('SESSION_MAX_KERNELS', 20))
+        # 0 disables the memory budget.
+        self.memory_budget_mb = memory_budget_mb if memory_budget_mb is not None else int(os.environ.get('SESSION_MEMORY_BUDGET_MB', 0))
+        self.cull_interval = cull_interval if cull_interval is not None else float(os.environ.get('SESSION_CULL_INTERVAL', 60))
+        # Save the namespace of evicted kernels so a `restore` can bring it back.
+        self.checkpoint_on_evict = os.environ.get('CHECKPOINT_ON_EVICT', 'true').lower() == 'true'
+        # Eviction runs while another notebook's kernel is starting, so it can't wait long.
+        self.checkpoint_timeout = float(os.environ.get('CHECKPOINT_ON_EVICT_TIMEOUT', 30))
+        self._sessions: "OrderedDict[str, NotebookSession]" = OrderedDict()
+        self._connections: Dict[str, int] = {}
+        self._cull_task: Optional[asyncio.Task] = None
+        # Keeps connection count writes in the order the counts changed.
+        self._connections_lock = asyncio.Lock()
+        # Held while a notebook's session is being created; dropped once unused.
+        self._creation_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self.registry = get_session_registry()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, notebook_id: str) -> bool:
+        return notebook_id in self._sessions
+
+    def get(self, notebook_id: str) -> Optional[NotebookSession]:
+        session = self._sessions.get(notebook_id)
+        if session is not None:
+            self.touch(notebook_id)
+        return session
+
+    def touch(self, notebook_id: str):
+        session = self._sessions.get(notebook_id)
+        if session is not None:
+            session.touch()
+            self._sessions.move_to_end(notebook_id)
+            # Best effort and throttled by the registry; don't wait for it.
+            asyncio.get_running_loop().run_in_executor(None, self.registry.touch, notebook_id).add_done_callback(self._log_touch_error)
+
+    @staticmethod
+    def _log_touch_error(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"Could not record session activity: {future.exception()}")
+
+    def creation_lock(self, notebook_id: str) -> asyncio.Lock:
+        """Hold while starting a notebook's kernel, so concurrent connections start only one."""
+        lock = self._creation_locks.get(notebook_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._creation_locks[notebook_id] = lock
+        return lock
+
+    async def reattach(self, nb: NotebookUtils) -> Optional[NotebookSession]:
+        """
+        Attach `nb` to the notebook's kernel if another live worker owns one.
+        Returns None when the caller should start a kernel itself.
+        """
+        entry = await asyncio.to_thread(self.registry.lookup, nb.notebook_id)
+        if entry is None or entry['worker_id'] == WORKER_ID or not worker_alive(entry['worker_id']):
+            return None
+        if entry['kernel_pid'] and not pid_alive(entry['kernel_pid']):
+            return None
+        try:
+            if entry.get('kernel_host'):
+                # Interrupts and %pip must reach the kernel host, not this machine.
+                await nb.attach_remote_kernel(entry['connection_info'], KernelHostClient(entry['kernel_host']), entry['kernel_id'])
+            else:
+                await nb.attach_kernel(entry['connection_info'], pid=entry['kernel_pid'], kernel_env_path=entry['kernel_env_path'])
+        except Exception as e:
+            logger.warning(f"Could not attach to kernel of notebook {nb.notebook_id} owned by {entry['worker_id']}: {e}")
+            return None
+        return await self.add(nb.notebook_id, nb, owned=False)
+
+    async def add(self, notebook_id: str, nb: NotebookUtils, owned: bool = True) -> NotebookSession:
+        """
+        Track `nb`. An owned kernel is claimed in the registry first; if
+        another worker claimed the notebook meanwhile, our kernel is shut
+        down and `nb` attaches to theirs instead. If this worker already has a
+        session for the notebook, that one is kept and `nb`'s kernel let go.
+        """
+        existing = self._sessions.get(notebook_id)
+        if existing is not None and existing.nb is not nb:
+            logger.warning(f"Notebook {notebook_id} already has a session, letting go of the new kernel")
+            if owned:
+                await nb.shutdown_kernel()
+            else:
+                nb.kernel_client.stop_channels()
+            return existing
+        session = NotebookSession(notebook_id, nb, owned=owned)
+        if owned:
+            remote = nb.kernel_manager if isinstance(nb.kernel_manager, RemoteKernelManager) else None
+            claimed = await asyncio.to_thread(
+                self.registry.claim,
+                notebook_id,
+                connection_info_to_json(nb.kernel_manager.get_connection_info()),
+                session.kernel_pid,
+                nb.kernel_env_path,
+                kernel_host=remote.host.url if remote else None,
+                kernel_id=remote.kernel_id if remote else None,
+            )
+            if not claimed:
+                logger.info(f"Notebook {notebook_id} was claimed by another worker, attaching to its kernel")
+                await nb.shutdown_kernel()
+                attached = await self.reattach(nb)
+                if attached is None:
+                    raise RuntimeError(f"Notebook {notebook_id} is owned by another worker whose kernel can't be attached")
+                return attached
+        self._sessions[notebook_id] = session
+        await self.enforce_limits()
+        return session
+
+    async def _write_connections(self, notebook_id: str):
+        async with self._connections_lock:
+            await asyncio.to_thread(lambda: self.registry.set_connections(notebook_id, self._connections.get(notebook_id, 0)))
+
+    async def connect(self, notebook_id: str):
+        self._connections[notebook_id] = self._connections.get(notebook_id, 0) + 1
+        self.touch(notebook_id)
+        await self._write_connections(notebook_id)
+
+    async def disconnect(self, notebook_id: str):
+        count = self._connections.get(notebook_id, 0) - 1
+        if count > 0:
+            self._connections[notebook_id] = count
+        else:
+            self._connections.pop(notebook_id, None)
+        self.touch(notebook_id)
+        await self._write_connections(notebook_id)
+
+    def _connection_count(self, notebook_id: str) -> int:
+        return max(self._connections.get(notebook_id, 0), self.registry.connections(notebook_id))
+
+    async def connections(self, notebook_id: str) -> int:
+        """Open WebSockets for the notebook across all workers."""
+        return await asyncio.to_thread(self._connection_count, notebook_id)
+
+    async def remove(self, notebook_id: str, reason: str = 'removed'):
+        session = self._sessions.pop(notebook_id, None)
+        if session is None:
+            return
+        if not session.owned:
+            logger.info(f"Detaching from kernel of notebook {notebook_id} ({reason})")
+            await session.execution_queue.stop()
+            session.nb.kernel_client.stop_channels()
+            return
+        logger.info(f"Shutting down kernel for notebook {notebook_id} ({reason})")
+        try:
+            await asyncio.to_thread(self.registry.release, notebook_id)
+            # A busy kernel wouldn't run the checkpoint until its cell finishes.
+            busy = session.execution_queue.current is not None
+            await session.execution_queue.stop()
+            if self.checkpoint_on_evict and reason != 'server shutdown' and not busy and session.user_id and checkpoints_supported(session.nb):
+                try:
+                    await asyncio.wait_for(save_checkpoint(session.nb, session.user_id), timeout=self.checkpoint_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Checkpoint of notebook {notebook_id} took over {self.checkpoint_timeout}s, shutting down without it")
+                except Exception as e:
+                    logger.warning(f"Could not checkpoint notebook {notebook_id} before shutdown: {e}")
+            await session.nb.shutdown_kernel()
+            if session.user_id:
+                await asyncio.to_thread(discard_local_checkpoint, session.user_id, notebook_id, keep_only_copy=True)
+        except Exception as e:
+            logger.error(f"Error shutting down kernel for notebook {notebook_id}: {e}")
+
+    async def _eviction_order(self, exclude: Optional[str] = None) -> List[str]:
+        """LRU first, disconnected sessions before connected ones."""
+        candidates = [notebook_id for notebook_id in self._sessions if notebook_id != exclude]
+        connected = await asyncio.to_thread(lambda: {notebook_id: self._connection_count(notebook_id) > 0 for notebook_id in candidates})
+        return sorted(candidates, key=lambda notebook_id: connected[notebook_id])
+
+    def _total_rss(self) -> int:
+        return sum(session.rss() or 0 for session in self._sessions.values())
+
+    async def enforce_limits(self):
+        newest = next(reversed(self._sessions), None)
+        for notebook_id in await self._eviction_order(exclude=newest):
+            if len(self._sessions) <= self.max_kernels:
+                break
+            await self.remove(notebook_id, reason='max kernels reached')
+
+        if self.memory_budget_mb:
+            budget = self.memory_budget_mb * 1024 * 1024
+            for notebook_id in await self._eviction_order(exclude=newest):
+                if self._total_rss() <= budget:
+                    break
+                await self.remove(notebook_id, reason='memory budget exceeded')
+
+    async def cull_idle(self):
+        now = time.time()
+        for notebook_id, session in list(self._sessions.items()):
+            # Activity on other workers keeps the kernel alive too.
+            entry = await asyncio.to_thread(self.registry.lookup, notebook_id)
+            last_activity = max(session.last_activity, entry['last_activity'] if entry else 0)
+            if await self.connections(notebook_id) == 0 and now - last_activity > self.idle_timeout:
+                await self.remove(notebook_id, reason='idle timeout')
+        await self.enforce_limits()
+
+    async def _cull_loop(self):
+        while True:
+            await asyncio.sleep(self.cull_interval)
+            try:
+                await self.cull_idle()
+                await asyncio.to_thread(cleanup_spilled_outputs)
+            except Exception as e:
+                logger.error(f"Error culling idle sessions: {e}")
+
+    def start(self):
+        if self._cull_task is None or self._cull_task.done():
+            self._cull_task = asyncio.create_task(self._cull_loop())
+
+    async def shutdown(self):
+        if self._cull_task is not None:
+            self._cull_task.cancel()
+        for notebook_id in list(self._sessions):
+            await self.remove(notebook_id, reason='server shutdown')
+
+    async def list_sessions(self) -> List[dict]:
+        # Snapshot on the loop; connection counts and RSS are read in a thread.
+        sessions = list(reversed(self._sessions.items()))
+        return await asyncio.to_thread(self._describe_sessions, sessions)
+
+    def _describe_sessions(self, sessions: List[tuple]) -> List[dict]:
+        now = time.time()
+        return [
+            {
+                'notebook_id': notebook_id,
+                'worker_id': WORKER_ID,
+                'owned': session.owned,
+                'created_at': datetime.fromtimestamp(session.created_at, tz=timezone.utc).isoformat(),
+                'last_activity': datetime.fromtimestamp(session.last_activity, tz=timezone.utc).isoformat(),
+                'idle_seconds': round(now - session.last_activity, 1),
+                'connections': self._connection_count(notebook_id),
+                'queued_cells': len(session.execution_queue),
+                'kernel_pid': session.kernel_pid,
+                'rss_bytes': session.rss(),
+            }
+            for notebook_id, session in sessions
+        ]
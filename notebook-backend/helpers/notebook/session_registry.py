@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+SESSION_REGISTRY_BACKEND = os.environ.get('SESSION_REGISTRY_BACKEND', 'sqlite')
+SESSION_REGISTRY_PATH = os.environ.get('SESSION_REGISTRY_PATH', os.path.join(tempfile.gettempdir(), 'notebook_sessions.db'))
+# Minimum seconds between activity writes for the same notebook.
+SESSION_REGISTRY_TOUCH_INTERVAL = float(os.environ.get('SESSION_REGISTRY_TOUCH_INTERVAL', 5))
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def worker_alive(worker_id: str) -> bool:
+    host, _, pid = worker_id.rpartition(':')
+    if host != socket.gethostname():
+        # Can't check other hosts; trust their entry.
+        return True
+    return pid_alive(int(pid))
+
+
+class SessionRegistry(ABC):
+    """
+    Records which worker owns each notebook's kernel and how to connect to
+    it, so that any uvicorn worker can serve any notebook by attaching to
+    the kernel instead of starting a second one.
+    """
+
+    @abstractmethod
+    def claim(self, notebook_id: str, connection_info: dict, kernel_pid: Optional[int], kernel_env_path: Optional[str],
+              kernel_host: Optional[str] = None, kernel_id: Optional[str] = None) -> bool:
+        """
+        Record this worker's kernel for the notebook. `kernel_host` is the
+        agent URL and `kernel_id` its id there when the kernel runs on a
+        kernel host, None for a kernel on this machine. Returns False,
+        recording nothing, if another live worker already owns a running
+        kernel for it.
+        """
+
+    @abstractmethod
+    def release(self, notebook_id: str):
+        """Forget the notebook's kernel if this worker owns it."""
+
+    @abstractmethod
+    def lookup(self, notebook_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def touch(self, notebook_id: str):
+        ...
+
+    @abstractmethod
+    def set_connections(self, notebook_id: str, count: int):
+        """Number of WebSockets this worker has open for the notebook."""
+
+    @abstractmethod
+    def connections(self, notebook_id: str) -> int:
+        """Open WebSockets for the notebook across all live workers."""
+
+    @abstractmethod
+    def list_sessions(self) -> List[dict]:
+        ...
+
+
+class MemorySessionRegistry(SessionRegistry):
+    """Single-process registry, for running with one worker."""
+
+    def __init__(self):
+        self._sessions: Dict[str, dict] = {}
+        self._connections: Dict[str, int] = {}
+
+    def claim(self, notebook_id, connection_info, kernel_pid, kernel_env_path, kernel_host=None, kernel_id=None):
+        self._sessions[notebook_id] = {
+            'notebook_id': notebook_id,
+            'worker_id': WORKER_ID,
+            'connection_info': connection_info,
+            'kernel_pid': kernel_pid,
+            'kernel_env_path': kernel_env_path,
+            'last_activity': time.time(),
+            'kernel_host': kernel_host,
+            'kernel_id': kernel_id,
+        }
+        return True
+
+    def release(self, notebook_id):
+        self._sessions.pop(notebook_id, None)
+
+    def lookup(self, notebook_id):
+        return self._sessions.get(notebook_id)
+
+    def touch(self, notebook_id):
+        if notebook_id in self._sessions:
+            self._sessions[notebook_id]['last_activity'] = time.time()
+
+    def set_connections(self, notebook_id, count):
+        self._connections[notebook_id] = count
+
+    def connections(self, notebook_id):
+        return self._connections.get(notebook_id, 0)
+
+    def list_sessions(self):
+        return list(self._sessions.values())
+
+
+class SQLiteSessionRegistry(SessionRegistry):
+    """Registry shared by all workers on a host through a SQLite file."""
+
+    def __init__(self, path: str = None):
+        self.path = path or SESSION_REGISTRY_PATH
+        self._local = threading.local()
+        self._last_touch: Dict[str, float] = {}
+        with self._connect() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    notebook_id TEXT PRIMARY KEY,
+                    worker_id TEXT NOT NULL,
+                    connection_info TEXT NOT NULL,
+                    kernel_pid INTEGER,
+                    kernel_env_path TEXT,
+                    last_activity REAL NOT NULL,
+                    kernel_host TEXT,
+                    kernel_id TEXT
+                )
+            ''')
+            # Registries created before kernel hosts were recorded.
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(sessions)')}
+            for column in ('kernel_host', 'kernel_id'):
+                if column not in columns:
+                    db.execute(f'ALTER TABLE sessions ADD COLUMN {column} TEXT')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS connections (
+                    notebook_id TEXT NOT NULL,
+                    worker_id TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (notebook_id, worker_id)
+                )
+            ''')
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    def claim(self, notebook_id, connection_info, kernel_pid, kernel_env_path, kernel_host=None, kernel_id=None):
+        db = self._connect()
+        # Take the write lock before reading, so two workers starting the
+        # same notebook can't both see it unowned.
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT worker_id, kernel_pid FROM sessions WHERE notebook_id = ?', (notebook_id,)).fetchone()
+            owned_elsewhere = row is not None and row['worker_id'] != WORKER_ID and worker_alive(row['worker_id'])
+            if owned_elsewhere and row['kernel_pid']:
+                owned_elsewhere = pid_alive(row['kernel_pid'])
+            if owned_elsewhere:
+                db.execute('ROLLBACK')
+                return False
+            db.execute(
+                'INSERT OR REPLACE INTO sessions (notebook_id, worker_id, connection_info, kernel_pid, kernel_env_path, last_activity, kernel_host, kernel_id)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (notebook_id, WORKER_ID, json.dumps(connection_info), kernel_pid, kernel_env_path, time.time(), kernel_host, kernel_id)
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            raise
+        return True
+
+    def release(self, notebook_id):
+        db = self._connect()
+        db.execute('DELETE FROM sessions WHERE notebook_id = ? AND worker_id = ?', (notebook_id, WORKER_ID))
+        db.execute('DELETE FROM connections WHERE notebook_id = ? AND worker_id = ?', (notebook_id, WORKER_ID))
+
+    def lookup(self, notebook_id):
+        row = self._connect().execute('SELECT * FROM sessions WHERE notebook_id = ?', (notebook_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['connection_info'] = json.loads(entry['connection_info'])
+        return entry
+
+    def touch(self, notebook_id):
+        now = time.time()
+        if now - self._last_touch.get(notebook_id, 0) < SESSION_REGISTRY_TOUCH_INTERVAL:
+            return
+        self._last_touch[notebook_id] = now
+        self._connect().execute('UPDATE sessions SET last_activity = ? WHERE notebook_id = ?', (now, notebook_id))
+
+    def set_connections(self, notebook_id, count):
+        db = self._connect()
+        if count > 0:
+            db.execute('INSERT OR REPLACE INTO connections VALUES (?, ?, ?)', (notebook_id, WORKER_ID, count))
+        else:
+            db.execute('DELETE FROM connections WHERE notebook_id = ? AND worker_id = ?', (notebook_id, WORKER_ID))
+
+    def connections(self, notebook_id):
+        rows = self._connect().execute('SELECT worker_id, count FROM connections WHERE notebook_id = ?', (notebook_id,)).fetchall()
+        # Rows left behind by crashed workers don't count.
+        return sum(row['count'] for row in rows if worker_alive(row['worker_id']))
+
+    def list_sessions(self):
+        rows = self._connect().execute('SELECT notebook_id, worker_id, kernel_pid, kernel_env_path, last_activity, kernel_host FROM sessions').fetchall()
+        return [dict(row) for row in rows]
+
+
+def get_session_registry() -> SessionRegistry:
+    if SESSION_REGISTRY_BACKEND == 'memory':
+        return MemorySessionRegistry()
+    if SESSION_REGISTRY_BACKEND == 'sqlite':
+        return SQLiteSessionRegistry()
+    raise ValueError(f"Unknown SESSION_REGISTRY_BACKEND '{SESSION_REGISTRY_BACKEND}'")
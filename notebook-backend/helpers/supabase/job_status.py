@@ -11,14 +11,16 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 from supabase import Client
 from helpers.supabase.client import get_supabase_client
+from helpers.metrics import supabase_request_seconds
 supabase: Client = get_supabase_client()
 
 def get_all_jobs_for_user(user_id: UUID):
     try:
-        response = supabase.table('lambda_jobs') \
-            .select('request_id,input_params,completed,result,created_at,updated_at,completed_at,error, notebook_id') \
-            .eq('user_id', user_id) \
-            .execute()
+        with supabase_request_seconds.time(operation='get_all_jobs_for_user'):
+            response = supabase.table('lambda_jobs') \
+                .select('request_id,input_params,completed,result,created_at,updated_at,completed_at,error, notebook_id') \
+                .eq('user_id', user_id) \
+                .execute()
         
         jobs = [SupabaseJobDetails(**job) for job in response.data]
         job_list = SupabaseJobList(jobs=jobs)
@@ -37,12 +39,13 @@ def get_all_jobs_for_user(user_id: UUID):
 
 def get_job_by_request_id(request_id: str, user_id: UUID):
     try:
-        response = supabase.table('lambda_jobs') \
-            .select('request_id,input_params,completed,result,created_at,updated_at,completed_at,error,notebook_name,notebook_id') \
-            .eq('request_id', request_id) \
-            .eq('user_id', user_id) \
-            .single() \
-            .execute()
+        with supabase_request_seconds.time(operation='get_job_by_request_id'):
+            response = supabase.table('lambda_jobs') \
+                .select('request_id,input_params,completed,result,created_at,updated_at,completed_at,error,notebook_name,notebook_id') \
+                .eq('request_id', request_id) \
+                .eq('user_id', user_id) \
+                .single() \
+                .execute()
             
         if response.data:
             return {
@@ -71,10 +74,11 @@ def get_job_by_request_id(request_id: str, user_id: UUID):
 
 def get_all_jobs_for_notebook(notebook_id: UUID):
     try:
-        response = supabase.table('lambda_jobs') \
-            .select('request_id,input_params,completed,result,created_at,updated_at,completed_at,error,notebook_id') \
-            .eq('notebook_id', notebook_id) \
-            .execute()
+        with supabase_request_seconds.time(operation='get_all_jobs_for_notebook'):
+            response = supabase.table('lambda_jobs') \
+                .select('request_id,input_params,completed,result,created_at,updated_at,completed_at,error,notebook_id') \
+                .eq('notebook_id', notebook_id) \
+                .execute()
         
         jobs = [SupabaseJobDetails(**job) for job in response.data]
         job_list = SupabaseJobList(jobs=jobs)
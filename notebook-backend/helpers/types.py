@@ -5,17 +5,106 @@ class OutputExecutionMessage(BaseModel):
     type: str
     cellId: str
     output: str
+    # Set when the output exceeded the in-memory cap and was spilled to disk.
+    output_handle: Optional[str] = None
+    output_size: Optional[int] = None
+    duration_ms: Optional[float] = None
+    cached: bool = False
+
+class OutputChunkMessage(BaseModel):
+    type: str
+    cellId: str
+    seq: int
+    output: str
+
+class OutputExecutionCompleteMessage(BaseModel):
+    type: str
+    cellId: str
+    chunks: int
+    output_handle: Optional[str] = None
+    output_size: Optional[int] = None
+    duration_ms: Optional[float] = None
+    cached: bool = False
+
+class OutputPageMessage(BaseModel):
+    type: str
+    handle: str
+    unit: str
+    offset: int
+    next_offset: int
+    total_bytes: int
+    data: str
+    eof: bool
+
+class OutputDisplayMessage(BaseModel):
+    type: str
+    cellId: str
+    data: dict
+    metadata: dict = {}
+
+class OutputQueuedMessage(BaseModel):
+    type: str
+    cellId: str
+    position: int
+
+class OutputCancelledMessage(BaseModel):
+    type: str
+    cellId: str
+
+class OutputRunCellsCompleteMessage(BaseModel):
+    type: str
+    completed: list[str]
+    skipped: list[str]
+    failed: Optional[str] = None
+
+class OutputStaleCellsMessage(BaseModel):
+    type: str
+    changed: list[str]
+    stale: list[str]
+
+class OutputInterruptMessage(BaseModel):
+    type: str
+    success: bool
+    message: str
+
+class OutputCheckpointMessage(BaseModel):
+    type: str
+    success: bool
+    message: str
+    variables: list[str] = []
+    skipped: list[str] = []
+    size_bytes: Optional[int] = None
+
+class OutputRestoreMessage(BaseModel):
+    type: str
+    success: bool
+    message: str
+    restored: list[str] = []
+    failed: list[str] = []
 
 class OutputSaveMessage(BaseModel):
     type: str
     success: bool
     message: str
+    version: Optional[int] = None
 
 class OutputLoadMessage(BaseModel):
     type: str
     success: bool
     message: str
     cells: list
+    version: Optional[int] = None
+
+class OutputPatchMessage(BaseModel):
+    type: str
+    success: bool
+    message: str
+    version: Optional[int] = None
+    # Set on a version conflict, with the server's cells so the client can resync.
+    conflict: bool = False
+    cells: Optional[list] = None
+    # Why the last background write of the notebook failed, if it did.
+    save_error: Optional[str] = None
     
 class OutputGenerateLambdaMessage(BaseModel):
     type: str
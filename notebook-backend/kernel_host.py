@@ -0,0 +1,174 @@
+"""
+Kernel host agent. Runs kernels on this machine on behalf of the notebook
+backend and hands back their ZMQ connection info, so the backend can spread
+kernels across several hosts. Start one per machine:
+
+    KERNEL_HOST_PORT=8101 python kernel_host.py
+
+and list the agents in the backend's KERNEL_HOSTS.
+"""
+import os
+import uuid
+import asyncio
+import logging
+from typing import Dict, Optional
+from fastapi import FastAPI, Header, HTTPException
+from pydantic import BaseModel
+from jupyter_client import AsyncKernelManager
+from jupyter_client.kernelspec import KernelSpecManager
+from helpers.notebook.kernel_pool import create_kernel_env, env_kernel_manager, kernel_env_path, notebook_env_path, promote_pool_env
+from helpers.notebook.attached_kernel import connection_info_to_json
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+KERNEL_HOST_BIND_IP = os.environ.get('KERNEL_HOST_BIND_IP', '127.0.0.1')
+# Address the backend should use to reach the kernel ports.
+KERNEL_HOST_ADVERTISE_IP = os.environ.get('KERNEL_HOST_ADVERTISE_IP') or KERNEL_HOST_BIND_IP
+KERNEL_HOST_DEFAULT_KERNEL = os.environ.get('KERNEL_HOST_DEFAULT_KERNEL', 'python3')
+KERNEL_HOST_MAX_KERNELS = int(os.environ.get('KERNEL_HOST_MAX_KERNELS', 50))
+KERNEL_HOST_TOKEN = os.environ.get('KERNEL_HOST_TOKEN', '')
+
+app = FastAPI()
+kernels: Dict[str, AsyncKernelManager] = {}
+# Serializes creating notebook envs, so two starts can't both create one.
+env_lock = asyncio.Lock()
+
+
+class StartKernelRequest(BaseModel):
+    kernel_name: Optional[str] = None
+    notebook_id: Optional[str] = None
+
+
+def check_token(token: Optional[str]):
+    if KERNEL_HOST_TOKEN and token != KERNEL_HOST_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid kernel host token")
+
+
+def memory_info() -> dict:
+    if psutil is not None:
+        memory = psutil.virtual_memory()
+        return {'mem_total': memory.total, 'mem_available': memory.available}
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if key in ('MemTotal', 'MemAvailable'):
+                info['mem_total' if key == 'MemTotal' else 'mem_available'] = int(value.split()[0]) * 1024
+    return info
+
+
+def kernels_rss() -> Optional[int]:
+    if psutil is None:
+        return None
+    total = 0
+    for km in kernels.values():
+        if not km.has_kernel or km.provisioner is None:
+            continue
+        try:
+            process = psutil.Process(km.provisioner.pid)
+            total += sum(p.memory_info().rss for p in [process, *process.children(recursive=True)])
+        except psutil.Error:
+            pass
+    return total
+
+
+def get_kernel(kernel_id: str) -> AsyncKernelManager:
+    km = kernels.get(kernel_id)
+    if km is None:
+        raise HTTPException(status_code=404, detail=f"Kernel {kernel_id} not found")
+    return km
+
+
+@app.get("/load")
+async def load(x_kernel_host_token: Optional[str] = Header(None)):
+    check_token(x_kernel_host_token)
+    return {
+        'kernels': len(kernels),
+        'max_kernels': KERNEL_HOST_MAX_KERNELS,
+        'kernels_rss': kernels_rss(),
+        'cpu_count': os.cpu_count(),
+        'load_avg': os.getloadavg()[0],
+        **memory_info(),
+    }
+
+
+@app.post("/kernels")
+async def start_kernel(request: StartKernelRequest, x_kernel_host_token: Optional[str] = Header(None)):
+    check_token(x_kernel_host_token)
+    if len(kernels) >= KERNEL_HOST_MAX_KERNELS:
+        raise HTTPException(status_code=503, detail="Kernel host is full")
+
+    kernel_name = request.kernel_name
+    if kernel_name and kernel_name in KernelSpecManager().find_kernel_specs():
+        km = AsyncKernelManager(kernel_name=kernel_name, ip=KERNEL_HOST_BIND_IP)
+    else:
+        # The notebook's own env only exists where it was created. Rather
+        # than sharing the default kernel's env, whose %pip installs would
+        # reach every notebook on this host, give the notebook a venv here.
+        if not request.notebook_id:
+            raise HTTPException(status_code=400, detail=f"Kernel '{kernel_name}' not found and no notebook_id to create an env for")
+        try:
+            async with env_lock:
+                env_path = notebook_env_path(request.notebook_id)
+                if env_path is None:
+                    env_path = await create_kernel_env(KERNEL_HOST_DEFAULT_KERNEL)
+                    promote_pool_env(env_path, request.notebook_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        km = env_kernel_manager(env_path, ip=KERNEL_HOST_BIND_IP)
+        kernel_name = km.kernel_name
+
+    await km.start_kernel()
+    kernel_id = uuid.uuid4().hex
+    kernels[kernel_id] = km
+    logger.info(f"Started kernel {kernel_id} ({kernel_name}) for notebook {request.notebook_id}")
+
+    connection_info = connection_info_to_json(km.get_connection_info())
+    connection_info['ip'] = KERNEL_HOST_ADVERTISE_IP
+    return {
+        'kernel_id': kernel_id,
+        'kernel_name': kernel_name,
+        'connection_info': connection_info,
+        'pid': km.provisioner.pid,
+        'env_path': kernel_env_path(km),
+    }
+
+
+@app.post("/kernels/{kernel_id}/interrupt")
+async def interrupt_kernel(kernel_id: str, x_kernel_host_token: Optional[str] = Header(None)):
+    check_token(x_kernel_host_token)
+    await get_kernel(kernel_id).interrupt_kernel()
+    return {'kernel_id': kernel_id, 'status': 'interrupted'}
+
+
+@app.delete("/kernels/{kernel_id}")
+async def shutdown_kernel(kernel_id: str, x_kernel_host_token: Optional[str] = Header(None)):
+    check_token(x_kernel_host_token)
+    km = get_kernel(kernel_id)
+    kernels.pop(kernel_id, None)
+    if km.has_kernel:
+        await km.shutdown_kernel(now=True)
+    return {'kernel_id': kernel_id, 'status': 'shutdown'}
+
+
+@app.on_event("shutdown")
+async def shutdown_kernels():
+    for kernel_id in list(kernels):
+        km = kernels.pop(kernel_id)
+        if km.has_kernel:
+            await km.shutdown_kernel(now=True)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "kernel_host:app",
+        host=KERNEL_HOST_BIND_IP,
+        port=int(os.environ.get('KERNEL_HOST_PORT', 8101)),
+        log_level="info",
+    )
@@ -1,12 +1,27 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import os
+import asyncio
 from helpers.lambda_generator import lambda_generator
+from helpers.lambda_generator.requirements import infer_requirements, freeze_requirements
 from helpers.supabase import job_status
-from helpers.types import OutputExecutionMessage, OutputSaveMessage, OutputLoadMessage, OutputGenerateLambdaMessage, OutputPosthogSetupMessage, ScheduledJob, NotebookDetails
+from helpers.types import OutputInterruptMessage, OutputCheckpointMessage, OutputRestoreMessage, OutputStaleCellsMessage, OutputPageMessage, OutputSaveMessage, OutputLoadMessage, OutputPatchMessage, OutputGenerateLambdaMessage, OutputPosthogSetupMessage, ScheduledJob, NotebookDetails
 from uuid import UUID
 from helpers.notebook import notebook
+from helpers.aws.s3 import s3
+from helpers.notebook.kernel_pool import KernelPool
+from helpers.notebook.session_manager import NotebookSessionManager
+from helpers.notebook.kernel_placement import KernelPlacement
+from helpers.notebook.notebook_document import NotebookDocumentStore, PatchError
+from helpers.notebook.save_queue import SAVE_QUEUE_WRITE_TIMEOUT
+from helpers.notebook.execution_queue import ExecutionRequest, RunCellsRequest
+from helpers.notebook.output_buffer import read_spilled_output, OUTPUT_PAGE_DEFAULT_LIMIT
+from helpers.notebook.dependency_graph import stale_cells
+from helpers.notebook.cell_cache import CellCache
+from helpers.notebook.checkpoint import save_checkpoint, restore_checkpoint
 from connectors.helpers.aws.s3.helpers import S3Helper
+from helpers import metrics
 import logging
 from helpers.scheduler.notebook_scheduler import NotebookScheduler
 from typing import List
@@ -14,6 +29,7 @@ logging.basicConfig(level=logging.INFO)
 
 app = FastAPI()
 scheduler = NotebookScheduler()  # Single instance
+kernel_pool = KernelPool()  # Pre-warmed kernels for new sessions
 # Enable CORS for frontend communication
 app.add_middleware(
     CORSMiddleware,
@@ -22,8 +38,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-# Dictionary to manage kernels per session
-notebook_sessions = {}
+# Live kernels per notebook, culled when idle or over the kernel/memory limits
+session_manager = NotebookSessionManager()
+kernel_placement = KernelPlacement()
+notebook_documents = NotebookDocumentStore()
+
+metrics.registry.gauge('notebook_live_sessions', 'Notebook sessions with a live kernel').set_function(lambda: len(session_manager))
+metrics.registry.gauge('notebook_kernel_pool_idle', 'Idle kernels waiting in the pool').set_function(lambda: kernel_pool.stats()['idle'])
+metrics.registry.gauge('notebook_save_queue_depth', 'Notebooks with changes waiting to be written').set_function(lambda: len(notebook_documents.save_queue))
+metrics.registry.gauge('notebook_save_queue_in_flight', 'Notebook writes in progress').set_function(lambda: notebook_documents.save_queue.in_flight)
+metrics.registry.gauge('notebook_save_queue_oldest_seconds', 'Age of the oldest unwritten notebook change').set_function(lambda: notebook_documents.save_queue.oldest_age())
+metrics.registry.gauge('notebook_cache_hit_ratio', 'Share of notebook loads answered from the cache').set_function(lambda: s3.notebook_cache.hit_ratio())
+metrics.registry.gauge('notebook_cache_entries', 'Notebooks in the in-memory cache').set_function(lambda: len(s3.notebook_cache))
+metrics.registry.gauge('notebook_cache_bytes', 'Bytes of notebook JSON in the in-memory cache').set_function(lambda: s3.notebook_cache.size_bytes)
 
 @app.websocket("/ws/{session_id}/{notebook_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str, notebook_id: str):
@@ -34,36 +61,121 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str, notebook_id:
     
     print(f"New connection with session ID: {session_id} and notebook ID: {notebook_id}")
 
+    binary_frames = websocket.query_params.get('binary_frames', '').lower() in ('1', 'true')
+
+    async def resolve_session():
+        if notebook_id not in session_manager:
+            # Another connection to the notebook may be starting its kernel already.
+            async with session_manager.creation_lock(notebook_id):
+                if notebook_id not in session_manager:
+                    nb = notebook.NotebookUtils(notebook_id)
+                    # Another worker may already be running this notebook's kernel.
+                    if await session_manager.reattach(nb) is None:
+                        await websocket.send_json({"type": "init", "message": "Kernel initializing. Please wait."})
+                        await nb.initialize_kernel(kernel_pool=kernel_pool, placement=kernel_placement)
+                        await session_manager.add(notebook_id, nb)
+        session = session_manager.get(notebook_id)
+        session.execution_queue.send = websocket.send_json
+        # Binary frames only for clients that asked for them; JSON-only
+        # clients get images base64-encoded in the display message.
+        session.execution_queue.send_bytes = websocket.send_bytes if binary_frames else None
+        return session
+
+    await session_manager.connect(notebook_id)
     try:
         while True:
-            if notebook_id not in notebook_sessions:
-                nb = notebook.NotebookUtils(notebook_id)
-                await websocket.send_json({"type": "init", "message": "Kernel initializing. Please wait."})
-                kernel_manager, kernel_client = nb.initialize_kernel()
-                notebook_sessions[notebook_id] = {'km': kernel_manager, 'kc': kernel_client, 'nb': nb}
-            
-            nb = notebook_sessions[notebook_id]['nb']
+            # Start the kernel before the first message arrives.
+            await resolve_session()
 
             data = await websocket.receive_json()
+            # The session may have been evicted while waiting for the message;
+            # resolve it again so the message never reaches a shut-down kernel.
+            session = await resolve_session()
+            if data.get('user_id'):
+                session.user_id = data['user_id']
+            nb = session.nb
+            execution_queue = session.execution_queue
             
             if data['type'] == 'execute':
-                code = data['code']
-                output = await nb.execute_code(code=code)
+                # Queued so the client can keep sending cells, interrupts and saves while it runs.
+                await execution_queue.submit(ExecutionRequest(data['cellId'], data['code'], stream=data.get('stream', False), cache=data.get('cache', False), user_id=data.get('user_id')))
+
+            elif data['type'] == 'run_cells':
+                cells = [(cell['cellId'], cell['code']) for cell in data.get('cells', [])]
+                await execution_queue.submit(RunCellsRequest(cells, stop_on_error=data.get('stop_on_error', True), stream=data.get('stream', False)))
+
+            elif data['type'] == 'run_stale':
+                # Re-run only the changed cells and the cells that depend on them.
+                cells = [(cell['cellId'], cell['code']) for cell in data.get('cells', [])]
+                changed = data.get('changed') or execution_queue.changed_cells(cells)
+                stale = set(stale_cells(cells, changed))
+                await websocket.send_json(OutputStaleCellsMessage(type='stale_cells', changed=changed, stale=[cell_id for cell_id, _ in cells if cell_id in stale]).model_dump())
+                stale_batch = [(cell_id, code) for cell_id, code in cells if cell_id in stale]
+                if stale_batch:
+                    await execution_queue.submit(RunCellsRequest(stale_batch, stop_on_error=data.get('stop_on_error', True), stream=data.get('stream', False)))
+
+            elif data['type'] == 'checkpoint':
+                try:
+                    result = await execution_queue.run_exclusive(lambda: save_checkpoint(nb, data.get('user_id') or session.user_id))
+                    response = OutputCheckpointMessage(type='checkpoint_saved', success=True, message="Checkpoint saved", **result)
+                except Exception as e:
+                    response = OutputCheckpointMessage(type='checkpoint_saved', success=False, message=str(e))
+                await websocket.send_json(response.model_dump())
+
+            elif data['type'] == 'restore':
+                try:
+                    result = await execution_queue.run_exclusive(lambda: restore_checkpoint(nb, data.get('user_id') or session.user_id))
+                    response = OutputRestoreMessage(type='checkpoint_restored', success=True, message="Checkpoint restored", **result)
+                except Exception as e:
+                    response = OutputRestoreMessage(type='checkpoint_restored', success=False, message=str(e))
+                await websocket.send_json(response.model_dump())
+
+            elif data['type'] == 'fetch_output':
+                try:
+                    page = await asyncio.to_thread(
+                        read_spilled_output, data['handle'],
+                        offset=data.get('offset', 0), limit=data.get('limit', OUTPUT_PAGE_DEFAULT_LIMIT), unit=data.get('unit', 'bytes')
+                    )
+                    await websocket.send_json(OutputPageMessage(type='output_page', **page).model_dump())
+                except (ValueError, OSError) as e:
+                    await websocket.send_json({"type": "error", "message": f"Could not fetch output: {e}"})
 
-                print(f"Sending output: {output}, type: {type(output)}, cellId: {data['cellId']}\n\n")
-                msgOutput = OutputExecutionMessage(type='output', cellId=data['cellId'], output=output)
-                await websocket.send_json(msgOutput.model_dump())
+            elif data['type'] == 'interrupt':
+                try:
+                    await execution_queue.interrupt()
+                    response = OutputInterruptMessage(type='interrupted', success=True, message="Kernel interrupted")
+                except Exception as e:
+                    response = OutputInterruptMessage(type='interrupted', success=False, message=str(e))
+                await websocket.send_json(response.model_dump())
+
+            elif data['type'] == 'cancel_queued':
+                await execution_queue.cancel_queued(data.get('cellIds'))
             
             elif data['type'] == 'save_notebook':
-                response = await nb.save_notebook(data)
+                response = await nb.save_notebook(data, documents=notebook_documents)
                 # print("response", response)
-                response = OutputSaveMessage(type='notebook_saved', success=response['success'], message=response['message'])
+                response = OutputSaveMessage(type='notebook_saved', success=response['success'], message=response['message'], version=response.get('version'))
+                await websocket.send_json(response.model_dump())
+
+            elif data['type'] == 'patch_notebook':
+                # Cell-level changes against a version; written to S3 in the background.
+                try:
+                    document = await notebook_documents.patch(data['notebook_id'], data['user_id'], data['base_version'], data.get('ops', []))
+                    response = OutputPatchMessage(type='notebook_patched', success=True, message="Notebook patched", version=document.version, save_error=document.save_error)
+                except PatchError as e:
+                    document = notebook_documents.peek(data['notebook_id'], data['user_id']) if e.conflict else None
+                    response = OutputPatchMessage(
+                        type='notebook_patched', success=False, message=str(e), version=e.version,
+                        conflict=e.conflict, cells=document.cells if document else None
+                    )
+                except Exception as e:
+                    response = OutputPatchMessage(type='notebook_patched', success=False, message=str(e))
                 await websocket.send_json(response.model_dump())
                 
             elif data['type'] == 'load_notebook':
-                response = await nb.load_notebook_handler(data['filename'], data['notebook_id'], data['user_id'])
+                response = await nb.load_notebook_handler(data['filename'], data['notebook_id'], data['user_id'], documents=notebook_documents)
                 # print("response", response)
-                output = OutputLoadMessage(type='notebook_loaded', success=response['status'] == 'success', message=response['message'], cells=response['notebook'])
+                output = OutputLoadMessage(type='notebook_loaded', success=response['status'] == 'success', message=response['message'], cells=response['notebook'], version=response.get('version'))
                 await websocket.send_json(output.model_dump())
 
             elif data['type'] == 'posthog_setup':
@@ -107,7 +219,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str, notebook_id:
                 
                 # Handle dependencies
                 # TODO: Handle dependencies better.
-                posthog_dependencies = await nb.execute_code(code='!pip install pydantic requests')
+                posthog_dependencies = await execution_queue.execute(code='!pip install pydantic requests')
                 print(f"posthog_dependencies: {posthog_dependencies}")
 
                 #Task 2: Setup PostHog in the notebook
@@ -124,17 +236,22 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str, notebook_id:
                 ipython.user_ns['posthog_adapter'] = posthog_service.adapter
                 """
                 logging.info(f"Injecting PostHog setup code into the notebook: {posthog_setup_code}")
-                output = await nb.execute_code(code=posthog_setup_code)
+                output = await execution_queue.execute(code=posthog_setup_code)
                 logging.info(f"output: {output}")
 
                 response = OutputPosthogSetupMessage(type='posthog_setup', success=True, message="PostHog setup complete")
                 await websocket.send_json(response.model_dump())
                 
             elif data['type'] == 'deploy_lambda':
-                # TODO: Better dependency management here.
                 # TODO: Get status/msg directly from function.
                 # TODO: Make a base lambda layer for basic dependencies.
-                dependencies = await nb.execute_code(code='!pip list --format=freeze')
+                # Only ship what the code imports, not everything ever installed in the env.
+                try:
+                    dependencies, requirements_report = await execution_queue.run_exclusive(lambda: infer_requirements(nb, data['all_code']))
+                    print(f"lambda requirements: {requirements_report}")
+                except Exception as e:
+                    print(f"Could not infer lambda requirements, shipping the full env: {e}")
+                    dependencies = freeze_requirements(await execution_queue.execute(code='!pip list --format=freeze'))
                 lambda_handler = lambda_generator.LambdaGenerator(data['all_code'], data['user_id'], data['notebook_name'], data['notebook_id'], dependencies)
                 status = False
 
@@ -168,8 +285,13 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str, notebook_id:
     except WebSocketDisconnect:
         pass
     finally:
-        # Optionally, you can decide when to shut down the kernel
-        pass
+        # The kernel outlives the connection so a reload keeps its state;
+        # the session manager shuts it down once it has been idle long enough.
+        session = session_manager.get(notebook_id)
+        if session is not None and session.execution_queue.send == websocket.send_json:
+            session.execution_queue.send = None
+            session.execution_queue.send_bytes = None
+        await session_manager.disconnect(notebook_id)
 
 @app.get("/status/jobs/{user_id}")
 async def status_endpoint_jobs_for_user(user_id: UUID):
@@ -184,20 +306,101 @@ async def status_endpoint_job_by_request_id(user_id: int, request_id: str):
 async def status_endpoint_jobs_for_notebook(notebook_id: UUID): 
     return job_status.get_all_jobs_for_notebook(notebook_id)
 
+@app.get("/outputs/{handle}")
+async def get_spilled_output(handle: str, offset: int = 0, limit: int = OUTPUT_PAGE_DEFAULT_LIMIT, unit: str = 'bytes'):
+    try:
+        return await asyncio.to_thread(read_spilled_output, handle, offset=offset, limit=limit, unit=unit)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Output not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return metrics.registry.render()
+
+@app.get("/sessions")
+async def list_sessions():
+    return await session_manager.list_sessions()
+
+@app.get("/cell_cache/stats")
+async def cell_cache_stats():
+    return await asyncio.to_thread(CellCache.get_cache().stats)
+
+@app.get("/kernel_pool/stats")
+async def kernel_pool_stats():
+    return kernel_pool.stats()
+
+@app.get("/kernel_hosts")
+async def kernel_hosts():
+    return await kernel_placement.stats()
+
 @app.on_event("startup")
 async def start_scheduler():
     scheduler.start()
 
+@app.on_event("startup")
+async def start_kernel_pool():
+    kernel_pool.start()
+
 @app.on_event("shutdown")
 async def shutdown_scheduler():
     scheduler.shutdown()
 
+@app.on_event("startup")
+async def start_session_manager():
+    session_manager.start()
+
+@app.on_event("shutdown")
+async def shutdown_kernel_pool():
+    await kernel_pool.shutdown()
+
+@app.on_event("shutdown")
+async def shutdown_session_manager():
+    await session_manager.shutdown()
+
+@app.on_event("shutdown")
+async def flush_notebook_documents():
+    await notebook_documents.shutdown()
+
 @app.get("/notebook_details/{notebook_id}")
 async def get_notebook_details(notebook_id: str) -> NotebookDetails:
     nb = notebook.NotebookUtils(notebook_id)
     details = await nb.get_notebook_details()
     return NotebookDetails(**details)
 
+@app.get("/notebook_versions/{user_id}/{notebook_id}")
+async def list_notebook_versions(user_id: str, notebook_id: str):
+    return await asyncio.to_thread(s3.notebook_history.list_versions, user_id, notebook_id)
+
+@app.get("/notebook_versions/{user_id}/{notebook_id}/{version_id}")
+async def get_notebook_version(user_id: str, notebook_id: str, version_id: str):
+    try:
+        cells = await asyncio.to_thread(s3.notebook_history.load_version, user_id, notebook_id, version_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if cells is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    return {"version_id": version_id, "notebook": cells}
+
+@app.post("/notebook_versions/{user_id}/{notebook_id}/{version_id}/restore")
+async def restore_notebook_version(user_id: str, notebook_id: str, version_id: str):
+    try:
+        cells = await asyncio.to_thread(s3.notebook_history.load_version, user_id, notebook_id, version_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if cells is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    # Goes through the document store so open sessions see the restored cells
+    # (their next patch conflicts and reloads), and is recorded as the newest version.
+    # The store is keyed by user as well, so this only ever touches user_id's notebook.
+    document = await notebook_documents.replace(notebook_id, user_id, cells)
+    notebook_documents.schedule_flush(document)
+    if not await notebook_documents.flush(notebook_id, user_id, timeout=SAVE_QUEUE_WRITE_TIMEOUT):
+        detail = "Failed to save the restored notebook"
+        raise HTTPException(status_code=500, detail=f"{detail}: {document.save_error}" if document.save_error else detail)
+    return {"status": "success", "notebook": document.cells, "version": document.version}
+
 @app.get("/notebook_job_schedule/{notebook_id}")
 async def get_schedules(notebook_id: str) -> List[ScheduledJob]:
     schedules = await scheduler.get_schedules(notebook_id)
@@ -247,11 +450,16 @@ if __name__ == "__main__":
         os.makedirs('notebooks')
 
     import uvicorn
+    # Kernels are shared across workers through the session registry.
+    # uvicorn can't reload with more than one worker.
+    workers = int(os.environ.get('UVICORN_WORKERS', 1))
+    reload = workers == 1 and os.environ.get('UVICORN_RELOAD', 'true').lower() == 'true'
     uvicorn.run(
         "main:app", 
         host="0.0.0.0", 
         port=8000,
-        reload=True,
+        workers=workers,
+        reload=reload,
         reload_excludes=[
             "lambda_dumps/**",
             "**/lambda_dumps/**",